@@ -0,0 +1,233 @@
+"""
+Caches of MQTT payloads by topic.
+"""
+
+import copy
+import enum
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import pydantic
+
+from bell.avr.mqtt.serializer import deserialize_payload
+
+# marks an entry that hasn't been deserialized yet
+_UNDECODED = object()
+
+_IMMUTABLE_TYPES = (str, bytes, int, float, type(None), enum.Enum)
+
+
+def _is_immutable(value: Any) -> bool:
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return True
+    if isinstance(value, tuple):
+        return all(_is_immutable(item) for item in value)
+    return False
+
+
+def snapshot_payload(payload: Any) -> Any:
+    """
+    Returns a copy of a payload that later changes to the payload do not
+    affect. Payloads whose fields are all immutable, like most telemetry, only
+    need a shallow copy. Anything else is deep copied.
+    """
+    if isinstance(payload, pydantic.BaseModel):
+        if all(_is_immutable(value) for value in payload.__dict__.values()):
+            return payload.model_copy()
+        return payload.model_copy(deep=True)
+
+    if isinstance(payload, dict):
+        if all(_is_immutable(value) for value in payload.values()):
+            return payload.copy()
+        return copy.deepcopy(payload)
+
+    if _is_immutable(payload):
+        return payload
+    return copy.deepcopy(payload)
+
+
+class SentCache:
+    """
+    The serialized payload last sent on each topic, used for
+    `bell.avr.mqtt.module.MQTTModule.sent_cache`.
+
+    Payloads are kept as the data that was sent, so sending a message never
+    needs to copy the payload. They are only turned back into a payload class
+    the first time they are read with `get`, and every read returns its own
+    copy, so changing it doesn't change the cache.
+    """
+
+    def __init__(self) -> None:
+        # topic to (serialized payload, payload or _UNDECODED)
+        self._entries: Dict[str, Tuple[Union[str, bytes], Any]] = {}
+
+    def put(self, topic: str, payload: Union[str, bytes]) -> None:
+        """
+        Store the serialized payload sent on a topic. This is called
+        automatically for every message published with `send_message`.
+        """
+        self._entries[topic] = (payload, _UNDECODED)
+
+    def get(self, topic: str, default: Any = None) -> Any:
+        """
+        Returns the last payload sent on a topic, deserialized like a received
+        message would be, or `default` if nothing has been sent on it.
+        """
+        entry = self._entries.get(topic)
+        if entry is None:
+            return default
+
+        serialized, value = entry
+        if value is _UNDECODED:
+            value = deserialize_payload(topic, serialized)  # type: ignore
+            # only memoize if a newer message hasn't been sent meanwhile
+            if self._entries.get(topic) is entry:
+                self._entries[topic] = (serialized, value)
+
+        return snapshot_payload(value)
+
+    def __contains__(self, topic: object) -> bool:
+        return topic in self._entries
+
+
+class ReceivedMessage(NamedTuple):
+    """
+    The last message received on a topic, see `ReceiveCache.get_message`.
+    """
+
+    payload: Any
+    """
+    The deserialized payload.
+    """
+    received_at: float
+    """
+    When the message was received, in seconds from `time.monotonic`.
+    """
+    sequence: int
+    """
+    Number of messages received on the topic so far, including this one.
+    """
+
+
+class ReceiveCache(Mapping[str, Any]):
+    """
+    Read-only dictionary of topics to the last payload received on them, used
+    for `bell.avr.mqtt.client.MQTTClient.receive_cache`.
+
+    Each entry is an immutable tuple that is replaced as a whole when a new
+    message arrives, so reads never need a lock and never see a payload mixed
+    with another message's timestamp. Payloads that callbacks decoded are
+    kept as is, and others are only deserialized the first time they are read.
+
+    Example:
+
+    ```python
+    position = self.receive_cache.get_fresh("avr/fusion/position/local", max_age=0.5)
+    if position is None:
+        # no position in the last half second
+        return
+    ```
+    """
+
+    def __init__(self) -> None:
+        # topic to (raw payload, received at, sequence, payload or _UNDECODED)
+        self._entries: Dict[str, Tuple[bytes, float, int, Any]] = {}
+        # entries are written from network threads and callback workers, and
+        # replaced only if they are still the entry that was read
+        self._lock = threading.Lock()
+
+    def put(
+        self, topic: str, payload: bytes, received_at: Optional[float] = None
+    ) -> None:
+        """
+        Record a raw payload received on a topic. This is called automatically
+        for every message received.
+        """
+        if received_at is None:
+            received_at = time.monotonic()
+
+        with self._lock:
+            previous = self._entries.get(topic)
+            sequence = previous[2] + 1 if previous is not None else 1
+            self._entries[topic] = (payload, received_at, sequence, _UNDECODED)
+
+    def put_decoded(self, topic: str, payload: bytes, value: Any) -> None:
+        """
+        Record the deserialized form of a raw payload given to `put`, so it
+        isn't deserialized again when read. This is called automatically when
+        callbacks decode a message. Does nothing if a newer message has
+        arrived on the topic, or the topic isn't cached.
+        """
+        with self._lock:
+            entry = self._entries.get(topic)
+            if entry is not None and entry[0] is payload and entry[3] is _UNDECODED:
+                self._entries[topic] = (payload, entry[1], entry[2], value)
+
+    def get_message(self, topic: str) -> Optional[ReceivedMessage]:
+        """
+        Returns the last message received on a topic with its receive time and
+        sequence number, or `None` if nothing has been received on it.
+        """
+        entry = self._entries.get(topic)
+        if entry is None:
+            return None
+
+        raw, received_at, sequence, value = entry
+        if value is _UNDECODED:
+            value = deserialize_payload(topic, raw)
+            # only memoize if a newer message hasn't arrived meanwhile
+            with self._lock:
+                if self._entries.get(topic) is entry:
+                    self._entries[topic] = (raw, received_at, sequence, value)
+
+        return ReceivedMessage(value, received_at, sequence)
+
+    def get_fresh(self, topic: str, max_age: float, default: Any = None) -> Any:
+        """
+        Returns the last payload received on a topic if it was received within
+        the last `max_age` seconds, otherwise `default`.
+        """
+        entry = self._entries.get(topic)
+        if entry is None or time.monotonic() - entry[1] > max_age:
+            return default
+
+        message = self.get_message(topic)
+        assert message is not None
+        return message.payload
+
+    def age(self, topic: str) -> Optional[float]:
+        """
+        Returns how many seconds ago the last message on a topic was received,
+        or `None` if nothing has been received on it.
+        """
+        entry = self._entries.get(topic)
+        if entry is None:
+            return None
+
+        return time.monotonic() - entry[1]
+
+    def __getitem__(self, topic: str) -> Any:
+        message = self.get_message(topic)
+        if message is None:
+            raise KeyError(topic)
+
+        return message.payload
+
+    def __contains__(self, topic: object) -> bool:
+        return topic in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,75 +1,279 @@
 from __future__ import annotations
 
+import dataclasses
+import json
 import os
+import threading
+import time
 import uuid
-from typing import Any, Optional, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 import paho.mqtt.client as paho_mqtt
 from loguru import logger
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
-from bell.avr.mqtt.constants import _MQTTTopicCallableTypedDict
+from bell.avr.mqtt.cache import ReceiveCache
+from bell.avr.mqtt.constants import MQTTTopicDelivery, _MQTTTopicCallableTypedDict
+from bell.avr.mqtt.delivery import DeliveryPolicy, DeliveryStats
+from bell.avr.mqtt.dispatcher import (
+    TopicCallbacks,
+    _call_handlers,
+    _Handler,
+    topic_matches,
+)
+from bell.avr.mqtt.executor import OrderedExecutor, OverflowPolicy
+from bell.avr.mqtt.latency import LatencyTracker
+from bell.avr.mqtt.offline import OfflinePolicy, OfflineQueue, ReconnectBackoff
+from bell.avr.mqtt.serializer import deserialize_payload
+from bell.avr.mqtt.throttle import PublishPolicy, PublishStats, PublishThrottle
 from bell.avr.utils.env import get_env_int
 
+# how many times a topic is published before it is given a topic alias,
+# so aliases aren't used up by topics that are only published once
+_TOPIC_ALIAS_MIN_PUBLISHES = 3
+
+# MQTT v5 user property carrying the time a message was sent, with
+# `latency_tracking`
+_SENT_TIME_PROPERTY = "avr-sent"
+
+# marks messages published with `_publish` rather than `send_message`, which
+# aren't cached
+_NO_MESSAGE = object()
+
+
+@dataclasses.dataclass
+class _TopicAliases:
+    """
+    Topic aliases of one connection, which only last until it reconnects.
+    """
+
+    # how many aliases the broker accepts
+    maximum: int = 0
+    # topic: alias
+    aliases: Dict[str, int] = dataclasses.field(default_factory=dict)
+    # how often topics without an alias have been published
+    publish_counts: Dict[str, int] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class DecodeStats:
+    """
+    Counters of incoming messages, see `MQTTClient.decode_stats`.
+    """
+
+    decoded: int = 0
+    """
+    Number of messages that were deserialized.
+    """
+    skipped: int = 0
+    """
+    Number of messages that were not deserialized because nothing needed them.
+    """
+    conflated: Dict[str, int] = dataclasses.field(default_factory=dict)
+    """
+    Number of messages per topic that were replaced by a newer message before
+    their callbacks ran, see `MQTTClient.conflate_topics`.
+    """
+
 
 class MQTTClient:
     """
     This class is *not meant to be used directly*! This meant to serve as the
     foundation for MQTT interactions. Please use the
-    `bell.avr.mqtt.module.MQTTModule`
+    `bell.avr.mqtt.module.MQTTModule`,
+    `bell.avr.mqtt.async_module.AsyncMQTTModule`
     or `bell.avr.mqtt.qt_widget.MQTTWidget` classes instead.
     """
 
     def __init__(self):
-        # create the MQTT client
-        # Currently using MQTT v3.1.1
-        # No reason we can't use v5, just type hinting needs to change
-        # for some `on_` functions.
-        self._mqtt_client = paho_mqtt.Client(
-            client_id=f"{self.__class__.__name__}_{uuid.uuid4()}",
-            protocol=paho_mqtt.MQTTv311,
-        )
+        self._mqtt_v5 = False
+        # set once connecting, after which the protocol can't change
+        self._connecting = False
 
-        # set up the on connect handler
-        self._mqtt_client.on_connect = self.on_connect
+        # create the MQTT client
+        self._mqtt_client = self._create_client()
 
         # dictionary of MQTT topics to callback functions
         # this is intended to be overwritten by the child class
-        self.topic_callbacks: _MQTTTopicCallableTypedDict = {}
+        self.topic_callbacks = {}
+
+        self.subscribe_to_all_topics: bool = False
         """
-        This dictionary is where you can put a mapping of topics and functions
-        to run when a message is recieved on that topic. The function must expect
-        the payload for that topic as it's only argument. If the payload is
-        `bell.avr.mqtt.payloads.AVREmptyMessage`, then the function does
-        not need to expect any arguments.
+        Set this to `True` to subscribe to ALL MQTT topics.
 
-        This MUST be set after `super().__init__()`
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.subscribe_to_all_topics = True
+        ```
+        """
+
+        self.subscribe_to_all_avr_topics: bool = False
+        """
+        Set this to `True` to subscribe to all MQTT topics starting with `avr/`.
 
         Example:
 
         ```python
         from bell.avr.mqtt.client import MQTTClient
-        from bell.avr.mqtt.payloads import AVRFCMBattery
 
         class MyClient(MQTTClient):
             def __init__(self):
                 super().__init__()
 
-                self.topic_callbacks = {
-                    "avr/fcm/battery": self.handle_battery,
-                    "avr/pcm/laser/fire": self.handle_laser
+                self.subscribe_to_all_avr_topics = True
+        ```
+        """
+
+        self.subscribe_topics: Set[str] = set()
+        """
+        Topics, or topic filters, to subscribe to in addition to those in
+        `topic_callbacks`. This is useful for topics that are only read from
+        `receive_cache`, without a callback.
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.subscribe_topics = {"avr/fusion/position/local"}
+                self.receive_cache_topics = {"avr/fusion/position/local"}
+        ```
+        """
+
+        self.receive_cache = ReceiveCache()
+        """
+        The last payload received on each topic in `receive_cache_topics`,
+        with when it was received. See `bell.avr.mqtt.cache.ReceiveCache`.
+        This lets a control loop read the latest state whenever it needs it,
+        rather than storing it from a callback.
+
+        Example:
+
+        ```python
+        position = self.receive_cache.get_fresh("avr/fusion/position/local", max_age=0.5)
+        ```
+        """
+
+        self.receive_cache_topics: Set[str] = set()
+        """
+        Topics, or topic filters, whose messages are kept in `receive_cache`.
+        Nothing is kept by default. The cache holds one message per topic, so
+        avoid broad filters like `#` that match an unbounded number of topics.
+
+        Payloads that callbacks decode are cached as the same object the
+        callbacks were given, so they shouldn't change it.
+        """
+
+        self.enable_verbose_logging: bool = False
+        """
+        Set this to `True` to enable verbose logging.
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.enable_verbose_logging = True
+        ```
+        """
+
+        self.binary_payload_topics: Set[str] = set()
+        """
+        Topics in this set are sent in the compact binary format rather than
+        JSON. This is only possible for topics whose payloads consist solely of
+        numbers and booleans, such as `avr/fusion/position/local`. Receivers
+        detect the format automatically, so only the sender needs to opt in.
+        See `bell.avr.mqtt.serializer`.
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.binary_payload_topics = {
+                    "avr/fusion/position/local",
+                    "avr/fusion/attitude/quaternion",
                 }
+        ```
+        """
 
-            def handle_battery(self, payload: AVRFCMBattery) -> None:
-                ...
+        self.decode_stats = DecodeStats()
+        """
+        Counts how many incoming messages were deserialized, and how many were
+        skipped because no callback in `topic_callbacks` matched their topic.
+        Payloads are only deserialized once something needs them, so
+        subscribing to lots of topics costs little more than receiving them.
+        """
 
-            def handle_laser(self) -> None:
-                ...
+        self.callback_workers: int = 0
+        """
+        Set this to a number of threads to run callbacks in a worker pool,
+        rather than on the thread that talks to the MQTT broker. Messages on the
+        same topic are still handled one at a time and in order, while different
+        topics are handled in parallel. This stops a slow callback, such as one
+        processing images, from holding up keepalives and every other topic.
+        Payloads are also deserialized by the workers.
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.callback_workers = 4
+                self.callback_queue_size = 10
         ```
         """
 
-        self.subscribe_to_all_topics: bool = False
+        self.callback_queue_size: int = 100
         """
-        Set this to `True` to subscribe to ALL MQTT topics.
+        When `callback_workers` is set, the maximum number of messages per topic
+        waiting for a worker. 0 means no limit. Once full, messages are dropped
+        according to `callback_overflow`, so receiving never blocks.
+        """
+
+        self.callback_overflow: OverflowPolicy = "drop_oldest"
+        """
+        When `callback_workers` is set, which message to drop when a topic's
+        queue is full. `"drop_oldest"` drops the oldest waiting message, and
+        `"drop_newest"` drops the message that just arrived.
+        The number dropped is counted in `callback_executor`.
+        """
+
+        self.conflate_topics: Set[str] = set()
+        """
+        Topics, or topic filters, for which only the newest message matters.
+        When callbacks for these topics can't keep up, messages waiting to be
+        handled are replaced by newer ones rather than queueing up, so callbacks
+        always see the freshest data. This is what control loops want for
+        topics like `avr/fusion/position/local`.
+
+        Callbacks for these topics always run in a worker thread, with
+        `callback_workers` threads, or 1 if it is not set. The number of
+        messages skipped per topic is counted in `decode_stats`.
 
         Example:
 
@@ -80,13 +284,60 @@ class MQTTClient:
             def __init__(self):
                 super().__init__()
 
-                self.subscribe_to_all_topics = True
+                self.conflate_topics = {"avr/fusion/position/local", "avr/apriltags/#"}
         ```
         """
 
-        self.subscribe_to_all_avr_topics: bool = False
+        self.callback_executor: Optional[OrderedExecutor] = None
         """
-        Set this to `True` to subscribe to all MQTT topics starting with `avr/`.
+        The `bell.avr.mqtt.executor.OrderedExecutor` running callbacks, created
+        with the first message when `callback_workers`, `conflate_topics` or
+        `connection_shards` is set.
+        """
+        # shards create the executor from several network threads
+        self._executor_lock = threading.Lock()
+
+        self.publish_stats = PublishStats()
+        """
+        Counts how many messages were published, and how many were suppressed
+        by `publish_policies`.
+        """
+
+        self._publish_throttle = PublishThrottle(self._publish_now, self.publish_stats)
+
+        # counters in `decode_stats`, `publish_stats` and `delivery_stats` are
+        # updated from every network thread and callback worker
+        self._stats_lock = threading.Lock()
+
+        self.message_expiry: Dict[str, int] = {}
+        """
+        When `mqtt_v5` is set, the number of seconds after which the broker
+        should drop messages on these topics, or topic filters, that haven't
+        been delivered yet, rather than delivering them late.
+
+        Example:
+
+        ```python
+        self.message_expiry = {"avr/fusion/#": 1}
+        ```
+        """
+
+        # topic aliases of each connection
+        self._topic_aliases: Dict[paho_mqtt.Client, _TopicAliases] = {}
+        # aliases must reach the broker in the order they're assigned
+        self._topic_alias_lock = threading.Lock()
+
+        self.latency_tracking: bool = False
+        """
+        Set this to `True` to measure how long messages take from being
+        published to their callbacks finishing. Messages received are timed
+        through each stage, into histograms in `latency`.
+        See `bell.avr.mqtt.latency`.
+
+        To measure network time, the sender needs this and `mqtt_v5` enabled,
+        so messages carry the time they were sent in an MQTT v5 user property.
+        Payloads are never changed, and receivers without this enabled never
+        look at the property.
 
         Example:
 
@@ -97,63 +348,422 @@ class MQTTClient:
             def __init__(self):
                 super().__init__()
 
-                self.subscribe_to_all_avr_topics = True
+                self.mqtt_v5 = True
+                self.latency_tracking = True
+                self.latency_report_interval = 10
         ```
         """
 
-        self.enable_verbose_logging: bool = False
+        self.latency = LatencyTracker()
         """
-        Set this to `True` to enable verbose logging.
+        Latency histograms per topic and stage, recorded when
+        `latency_tracking` is enabled.
+        See `bell.avr.mqtt.latency.LatencyTracker`.
+        """
+
+        self.latency_report_interval: float = 0
+        """
+        When `latency_tracking` is enabled, publish a summary of `latency` as
+        JSON to `latency_report_topic` this often, in seconds, from a timer
+        rather than the thread receiving messages. 0 means never.
+        """
+
+        self.latency_report_topic: str = f"avr/latency/{self.__class__.__name__}"
+        """
+        Topic latency reports are published to.
+        """
+
+        # whether latency reports are scheduled, until stopped
+        self._latency_reporting = False
+
+        self.delivery_policies: Dict[str, DeliveryPolicy] = {}
+        """
+        This dictionary sets the QoS and retain flag messages are published with
+        on topics, or topic filters, in place of the defaults from
+        `bell.avr.mqtt.constants.MQTTTopicDelivery`, which for example send
+        actions like `avr/fcm/action/kill` with QoS 1.
+        See `bell.avr.mqtt.delivery.DeliveryPolicy`.
+
+        Subscriptions are made with the highest QoS of the topics they cover,
+        so these should be set before connecting.
 
         Example:
 
         ```python
         from bell.avr.mqtt.client import MQTTClient
+        from bell.avr.mqtt.delivery import DeliveryPolicy
 
         class MyClient(MQTTClient):
             def __init__(self):
                 super().__init__()
 
-                self.enable_verbose_logging = True
+                self.delivery_policies = {
+                    "avr/pcm/#": DeliveryPolicy(qos=1),
+                    "avr/fcm/battery": DeliveryPolicy(retain=True),
+                }
+        ```
+        """
+
+        self.max_inflight_messages: int = 20
+        """
+        How many messages with a QoS above 0 can be waiting for the broker to
+        acknowledge them. Messages past this are queued until earlier ones are
+        acknowledged. Applied when connecting.
+        """
+
+        self.max_queued_messages: int = 0
+        """
+        How many messages with a QoS above 0 can be waiting for the broker to
+        acknowledge them, counting the ones in flight as well as the ones
+        queued behind `max_inflight_messages`. Messages past this are not
+        published, and counted in `delivery_stats`. 0 means no limit.
+        Applied when connecting.
+        """
+
+        self._delivery_rejected = 0
+        # client: {mid: info} of messages with a QoS above 0 that the broker
+        # has not acknowledged yet, removed by `on_publish`
+        self._unacknowledged: Dict[
+            paho_mqtt.Client, Dict[int, paho_mqtt.MQTTMessageInfo]
+        ] = {}
+
+        self.connection_shards: Dict[str, Set[str]] = {}
+        """
+        Extra connections to the broker, by name, with the topics, or topic
+        filters, that are published and subscribed to over them rather than
+        the main connection. Each connection has its own socket and network
+        thread, so large messages on one, like images, don't hold up small
+        messages on another. Set this before connecting.
+
+        Subscriptions are made on the connection covering them. Wildcard
+        subscriptions spanning several connections, like
+        `subscribe_to_all_topics`, are made on the main connection. Messages
+        that arrive on both the main connection and a shard subscribed to
+        them are only handled once, from the shard.
+
+        Callbacks still run one at a time: messages from every connection are
+        handed to `callback_executor`, with a single thread unless
+        `callback_workers` is set, and `callback_queue_size` applies.
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.connection_shards = {
+                    "images": {"avr/thermal/reading", "avr/camera/#"},
+                }
         ```
         """
 
+        # shard name: client, created when connecting
+        self._shard_clients: Dict[str, paho_mqtt.Client] = {}
+        # topic: the client it is sent or subscribed to on
+        self._topic_clients: Dict[str, paho_mqtt.Client] = {}
+        # shard client: topic filters subscribed to on it
+        self._shard_subscriptions: Dict[paho_mqtt.Client, Set[str]] = {}
+        # topic: the client whose messages on it are handled
+        self._topic_receivers: Dict[str, paho_mqtt.Client] = {}
+
+        self.retry_connect: bool = False
+        """
+        Set this to `True` to connect in the background, retrying with
+        `reconnect_backoff` until the broker can be reached, rather than
+        raising an error if it can't, such as while it is still starting.
+        The same backoff is used to reconnect after losing the connection.
+
+        Messages published while disconnected are held, according to
+        `offline_policies`, and sent once connected. Subscriptions are made
+        again on every connection.
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.retry_connect = True
+                self.offline_policies = {"avr/pcm/#": "drop_oldest"}
+        ```
+        """
+
+        self.reconnect_backoff = ReconnectBackoff()
+        """
+        How long to wait between attempts to connect when `retry_connect` is
+        set. See `bell.avr.mqtt.offline.ReconnectBackoff`.
+        """
+
+        self.offline_queue_size: int = 100
+        """
+        How many messages are held for each connection while disconnected,
+        when `retry_connect` is set. Past this, the oldest messages that can be
+        are dropped.
+        """
+
+        self.offline_policies: Dict[str, OfflinePolicy] = {}
+        """
+        This dictionary sets what happens to messages on topics, or topic
+        filters, that are published while disconnected, when `retry_connect`
+        is set. See `bell.avr.mqtt.offline.OfflinePolicy`.
+
+        Topics not in here are `never_drop` if they are published with a QoS
+        above 0, like actions, and `keep_latest` otherwise.
+        """
+
+        # clients connected to the broker, when retry_connect is set
+        self._online: Set[paho_mqtt.Client] = set()
+        # client: messages published while it was disconnected
+        self._offline_queues: Dict[paho_mqtt.Client, OfflineQueue] = {}
+        # messages held while offline must be sent before any others
+        self._offline_lock = threading.Lock()
+
         # record if we were started with loop forever
         self._looped_forever = False
+        # the thread running loop forever
+        self._loop_thread: Optional[int] = None
+
+    @property
+    def publish_policies(self) -> Dict[str, PublishPolicy]:
+        """
+        This dictionary limits how often messages are sent on a topic.
+        Keys are topics or topic filters, and values are
+        `bell.avr.mqtt.throttle.PublishPolicy`s. Messages sent faster than a
+        policy's `max_rate` are dropped, or with `coalesce` set, only the last
+        of them is sent as soon as the rate allows. Suppressed messages are
+        counted in `publish_stats`.
+
+        This is useful when sending messages from a tight loop, and replaces
+        wrapping `send_message` with `bell.avr.utils.timing.rate_limit`.
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+        from bell.avr.mqtt.throttle import PublishPolicy
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.publish_policies = {
+                    "avr/pcm/color/set": PublishPolicy(max_rate=10, coalesce=True),
+                    "avr/pcm/servo/#": PublishPolicy(max_rate=50),
+                }
+        ```
+        """
+        return self._publish_throttle.policies
+
+    @publish_policies.setter
+    def publish_policies(self, value: Dict[str, PublishPolicy]) -> None:
+        self._publish_throttle.policies = value
+
+    @property
+    def mqtt_v5(self) -> bool:
+        """
+        Set this to `True` to connect with MQTT v5 rather than v3.1.1.
+        This enables `message_expiry`, and topic aliases: once a topic has been
+        published a few times, it is given a number that is sent in place of
+        the topic string, which can be most of a small message. Aliases are
+        only used for as many topics as the broker allows.
+
+        Subscribers don't need to use MQTT v5 to receive these messages.
+
+        paho picks the protocol when a client is created, so setting this
+        creates the client again. Set it before connecting, as in the example.
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.mqtt_v5 = True
+        ```
+        """
+        return self._mqtt_v5
+
+    @mqtt_v5.setter
+    def mqtt_v5(self, value: bool) -> None:
+        if value == self._mqtt_v5:
+            return
+        if self._connecting:
+            raise ValueError("mqtt_v5 must be set before connecting")
+
+        self._mqtt_v5 = value
+        self._mqtt_client = self._create_client()
+
+    @property
+    def delivery_stats(self) -> DeliveryStats:
+        """
+        How many messages with a QoS above 0 are waiting for the broker to
+        acknowledge them, or waiting to be sent.
+        See `bell.avr.mqtt.delivery.DeliveryStats`.
+        """
+        stats = DeliveryStats(rejected=self._delivery_rejected)
+        for queue in list(self._offline_queues.values()):
+            stats.offline += len(queue)
+            stats.offline_dropped += queue.dropped
+
+        with self._stats_lock:
+            for messages in self._unacknowledged.values():
+                # acknowledged messages are only removed once `_send` has
+                # seen them, if the acknowledgement beat it there
+                waiting = sum(not info.is_published() for info in messages.values())
+                in_flight = waiting
+                if self.max_inflight_messages > 0:
+                    in_flight = min(waiting, self.max_inflight_messages)
+                stats.in_flight += in_flight
+                stats.queued += waiting - in_flight
+        return stats
+
+    @property
+    def topic_callbacks(self) -> _MQTTTopicCallableTypedDict:
+        """
+        This dictionary is where you can put a mapping of topics and functions
+        to run when a message is recieved on that topic. The function must expect
+        the payload for that topic as it's only argument. If the payload is
+        `bell.avr.mqtt.payloads.AVREmptyMessage`, then the function does
+        not need to expect any arguments.
+
+        This MUST be set after `super().__init__()`
+
+        Example:
+
+        ```python
+        from bell.avr.mqtt.client import MQTTClient
+        from bell.avr.mqtt.payloads import AVRFCMBattery
+
+        class MyClient(MQTTClient):
+            def __init__(self):
+                super().__init__()
+
+                self.topic_callbacks = {
+                    "avr/fcm/battery": self.handle_battery,
+                    "avr/pcm/laser/fire": self.handle_laser
+                }
+
+            def handle_battery(self, payload: AVRFCMBattery) -> None:
+                ...
+
+            def handle_laser(self) -> None:
+                ...
+        ```
+
+        Keys can also be MQTT topic filters with the `+` and `#` wildcards,
+        and values can be a list of functions to run them all. If several keys
+        match a topic, the functions for all of them are run.
+
+        ```python
+        self.topic_callbacks = {
+            "avr/fusion/#": self.handle_fusion,
+            "avr/fcm/battery": [self.handle_battery, self.log_battery],
+        }
+        ```
+
+        Functions that require an argument are always given the payload, and
+        functions without any parameters never are. A function with an
+        optional argument, like `def handle(self, payload=None)`, is given the
+        payload unless it is empty, which suits wildcards covering topics
+        with and without payloads.
+
+        Lists of functions can't be changed in place, assign them again
+        instead. See `bell.avr.mqtt.dispatcher.TopicCallbacks`.
+        """
+        return self._topic_callbacks  # type: ignore
+
+    @topic_callbacks.setter
+    def topic_callbacks(self, value: _MQTTTopicCallableTypedDict) -> None:
+        # compile into a dispatch table that is kept in sync with changes
+        self._topic_callbacks = TopicCallbacks(value)
 
     def on_connect(
-        self, client: paho_mqtt.Client, userdata: Any, flags: dict, rc: int
+        self,
+        client: paho_mqtt.Client,
+        userdata: Any,
+        flags: dict,
+        rc: int,
+        properties: Optional[Properties] = None,
     ) -> None:
         """
-        On connection callback. Subscribes to MQTT topics in `self.topic_callbacks`,
-        plus the `subscribe_to_all_topics` and `subscribe_to_all_avr_topics`
-        flags.
+        On connection callback. Subscribes to MQTT topics in `self.topic_callbacks`
+        and `self.subscribe_topics`, plus the `subscribe_to_all_topics` and
+        `subscribe_to_all_avr_topics` flags.
+
+        `properties` are only given with MQTT v5.
         """
         logger.debug(f"Connected with result {rc}")
 
-        for topic in self.topic_callbacks.keys():
-            client.subscribe(topic)
+        # topic aliases only last for a connection
+        with self._topic_alias_lock:
+            self._topic_aliases[client] = _TopicAliases(
+                getattr(properties, "TopicAliasMaximum", 0)
+            )
+
+        topics = list(self.topic_callbacks.keys())
+        topics.extend(t for t in self.subscribe_topics if t not in self.topic_callbacks)
+
+        topics = [topic for topic in topics if self._client_for_topic(topic) is client]
+        if client is not self._mqtt_client:
+            # recorded first, so the main connection stops handling these
+            # topics before the shard's own copies can arrive
+            self._shard_subscriptions[client] = set(topics)
+            self._topic_receivers.clear()
+
+        for topic in topics:
+            client.subscribe(topic, qos=self._subscription_qos(topic))
             logger.success(f"Subscribed to: {topic}")
 
-        if self.subscribe_to_all_topics:
-            client.subscribe("#")
-            logger.success("Subscribed to all topics")
+        if client is self._mqtt_client:
+            if self.subscribe_to_all_topics:
+                client.subscribe("#", qos=self._subscription_qos("#"))
+                logger.success("Subscribed to all topics")
+
+            elif self.subscribe_to_all_avr_topics:
+                client.subscribe("avr/#", qos=self._subscription_qos("avr/#"))
+                logger.success("Subscribed to: avr/#")
 
-        elif self.subscribe_to_all_avr_topics:
-            client.subscribe("avr/#")
-            logger.success("Subscribed to: avr/#")
+        if self.retry_connect and rc == paho_mqtt.CONNACK_ACCEPTED:
+            self._send_offline(client)
 
     def on_disconnect(
         self,
         client: paho_mqtt.Client,
         userdata: Any,
         rc: int,
+        properties: Optional[Properties] = None,
     ) -> None:
         """
         Callback when the MQTT client disconnects.
+        `properties` are only given with MQTT v5.
         """
         logger.debug("Disconnected from MQTT server")
 
+        with self._offline_lock:
+            self._online.discard(client)
+
+        # aliases only last for a connection, and `on_connect` sets them up
+        # again with what the broker allows next time
+        with self._topic_alias_lock:
+            self._topic_aliases.pop(client, None)
+
+    def on_publish(self, client: paho_mqtt.Client, userdata: Any, mid: int) -> None:
+        """
+        Callback when a message has been sent, or acknowledged by the broker
+        for a QoS above 0. This is called automatically.
+        """
+        with self._stats_lock:
+            self._unacknowledged.get(client, {}).pop(mid, None)
+
     def connect_(self, host: Optional[str] = None, port: Optional[int] = None) -> None:
         """
         Connect the MQTT client to the broker. This method cannot be named "connect"
@@ -170,13 +780,32 @@ class MQTTClient:
         if self.enable_verbose_logging:
             logger.info(f"Connecting to MQTT broker at {host}:{port}")
 
-        self._mqtt_client.connect(host=host, port=port, keepalive=60)
+        self._connecting = True
+
+        for name in self.connection_shards:
+            if name not in self._shard_clients:
+                self._shard_clients[name] = self._create_client(name)
+        self._topic_clients.clear()
+
+        for client in self._connections():
+            client.max_inflight_messages_set(self.max_inflight_messages)
+            client.max_queued_messages_set(self.max_queued_messages)
+
+            if self.retry_connect:
+                client.reconnect_delay_set(*self.reconnect_backoff.delays())
+                # the network loop connects, and retries until it can
+                client.connect_async(host=host, port=port, keepalive=60)
+            else:
+                client.connect(host=host, port=port, keepalive=60)
 
-        logger.success("Connected to MQTT broker")
+            # if an on_message callback has been defined, connect it
+            if hasattr(self, "on_message"):
+                client.on_message = self.on_message  # type: ignore
 
-        # if an on_message callback has been defined, connect it
-        if hasattr(self, "on_message"):
-            self._mqtt_client.on_message = self.on_message  # type: ignore
+        if self.retry_connect:
+            logger.info("Connecting to MQTT broker in the background")
+        else:
+            logger.success("Connected to MQTT broker")
 
     def stop(self) -> None:
         """
@@ -185,8 +814,16 @@ class MQTTClient:
         if self.enable_verbose_logging:
             logger.info("Disconnecting from MQTT server")
 
-        self._mqtt_client.disconnect()
-        self._mqtt_client.loop_stop()
+        for client in self._connections():
+            client.disconnect()
+            client.loop_stop()
+
+        self._latency_reporting = False
+
+        with self._executor_lock:
+            executor, self.callback_executor = self.callback_executor, None
+        if executor is not None:
+            executor.shutdown()
 
         if self.enable_verbose_logging:
             logger.info("Disconnected from MQTT server")
@@ -205,9 +842,14 @@ class MQTTClient:
         """
         # connect the MQTT client
         self.connect_(host, port)
+        self._start_latency_reports()
+        # shards run in the background
+        for client in self._shard_clients.values():
+            client.loop_start()
         # run forever
         self._looped_forever = True
-        self._mqtt_client.loop_forever()
+        self._loop_thread = threading.get_ident()
+        self._mqtt_client.loop_forever(retry_first_connection=self.retry_connect)
 
     def run_non_blocking(
         self, host: Optional[str] = None, port: Optional[int] = None
@@ -225,24 +867,485 @@ class MQTTClient:
         """
         # connect the MQTT client
         self.connect_(host, port)
+        self._start_latency_reports()
         # run in background
-        self._mqtt_client.loop_start()
+        for client in self._connections():
+            client.loop_start()
 
-    def _publish(
-        self, topic: str, payload: Union[str, bytes], force_write: bool = False
+    def _process_message(
+        self, topic: str, payload: bytes, sent: Optional[float] = None
     ) -> None:
+        """
+        Deserialize a raw incoming payload and dispatch it to the matching
+        callbacks. The payload is left undecoded if no callbacks match.
+        `sent` is the time the message was sent, from `_sent_time`.
+        """
+        received = None
+        if self.latency_tracking:
+            received = time.time()
+            if sent is not None:
+                self.latency.record(topic, "network", received - sent)
+
+        if self.receive_cache_topics and self._in_topics(
+            self.receive_cache_topics, topic
+        ):
+            self.receive_cache.put(topic, payload)
+
+        handlers = self._match_callbacks(topic)
+        if not handlers:
+            with self._stats_lock:
+                self.decode_stats.skipped += 1
+            return
+
+        if self.conflate_topics and self._in_topics(self.conflate_topics, topic):
+            if self._get_executor().submit_latest(
+                topic, self._handle_message, topic, payload, handlers, received, sent
+            ):
+                with self._stats_lock:
+                    conflated = self.decode_stats.conflated
+                    conflated[topic] = conflated.get(topic, 0) + 1
+            return
+
+        # with shards, messages arrive on several network threads, so
+        # callbacks are run from the executor to keep them one at a time
+        if self.callback_workers or self._shard_clients:
+            self._get_executor().submit(
+                topic, self._handle_message, topic, payload, handlers, received, sent
+            )
+            return
+
+        self._handle_message(topic, payload, handlers, received, sent)
+
+    def _match_callbacks(self, topic: str) -> Tuple[_Handler, ...]:
+        """
+        Returns the handlers in `topic_callbacks` for a topic.
+        """
+        topic_callbacks = self.topic_callbacks
+        if not isinstance(topic_callbacks, TopicCallbacks):
+            # a `topic_callbacks` class attribute hides the property, so
+            # assigning it leaves a plain dictionary, compiled every time
+            topic_callbacks = TopicCallbacks(topic_callbacks)
+        return topic_callbacks.match(topic)
+
+    @staticmethod
+    def _in_topics(topic_filters: Set[str], topic: str) -> bool:
+        """
+        Returns whether a topic is in a set of topics, or topic filters.
+        """
+        return topic in topic_filters or any(
+            topic_matches(topic_filter, topic)
+            for topic_filter in topic_filters
+            if "+" in topic_filter or "#" in topic_filter
+        )
+
+    def _get_executor(self) -> OrderedExecutor:
+        executor = self.callback_executor
+        if executor is None:
+            with self._executor_lock:
+                executor = self.callback_executor
+                if executor is None:
+                    executor = self.callback_executor = OrderedExecutor(
+                        max(self.callback_workers, 1),
+                        self.callback_queue_size,
+                        self.callback_overflow,
+                        name=f"{self.__class__.__name__}_callbacks",
+                    )
+
+        return executor
+
+    def _handle_message(
+        self,
+        topic: str,
+        payload: bytes,
+        handlers: Tuple[_Handler, ...],
+        received: Optional[float] = None,
+        sent: Optional[float] = None,
+    ) -> None:
+        if received is not None:
+            self._handle_message_timed(topic, payload, handlers, received, sent)
+            return
+
+        decoded = deserialize_payload(topic, payload)
+        with self._stats_lock:
+            self.decode_stats.decoded += 1
+        self.receive_cache.put_decoded(topic, payload, decoded)
+
+        self._run_handlers(topic, handlers, decoded)
+
+    def _run_handlers(
+        self, topic: str, handlers: Tuple[_Handler, ...], payload: Any
+    ) -> None:
+        """
+        Run the callbacks for a decoded message.
+        """
+        _call_handlers(handlers, payload)
+
+    def _handle_message_timed(
+        self,
+        topic: str,
+        payload: bytes,
+        handlers: Tuple[_Handler, ...],
+        received: float,
+        sent: Optional[float],
+    ) -> None:
+        start = time.time()
+        decoded = deserialize_payload(topic, payload)
+        with self._stats_lock:
+            self.decode_stats.decoded += 1
+        self.receive_cache.put_decoded(topic, payload, decoded)
+        decoded_at = time.time()
+
+        self._run_handlers(topic, handlers, decoded)
+        done = time.time()
+
+        latency = self.latency
+        latency.record(topic, "dispatch", start - received)
+        latency.record(topic, "decode", decoded_at - start)
+        latency.record(topic, "handler", done - decoded_at)
+        if sent is not None:
+            latency.record(topic, "total", done - sent)
+
+    def _sent_time(self, msg: paho_mqtt.MQTTMessage) -> Optional[float]:
+        """
+        Returns the time a message was sent, if `latency_tracking` is enabled
+        and the sender added it.
+        """
+        if not self.latency_tracking:
+            return None
+
+        # MQTT v3.1.1 messages have no properties at all
+        properties = getattr(msg, "properties", None)
+        for name, value in getattr(properties, "UserProperty", ()):
+            if name == _SENT_TIME_PROPERTY:
+                try:
+                    return float(value)
+                except ValueError:
+                    return None
+
+        return None
+
+    def _start_latency_reports(self) -> None:
+        if (
+            self.latency_tracking
+            and self.latency_report_interval > 0
+            and not self._latency_reporting
+        ):
+            self._latency_reporting = True
+            self._publish_throttle.call_later(
+                self.latency_report_interval, self._report_latency
+            )
+
+    def _report_latency(self) -> None:
+        if not self._latency_reporting:
+            return
+
+        try:
+            self.publish_latency_report()
+        finally:
+            self._publish_throttle.call_later(
+                self.latency_report_interval, self._report_latency
+            )
+
+    def publish_latency_report(self) -> None:
+        """
+        Publish a summary of `latency` as JSON to `latency_report_topic`.
+        This is done automatically with `latency_report_interval`.
+        """
+        self._publish(self.latency_report_topic, json.dumps(self.latency.summary()))
+
+    def _publish(
+        self,
+        topic: str,
+        payload: Union[str, bytes],
+        force_write: bool = False,
+        message: Any = _NO_MESSAGE,
+    ) -> Optional[paho_mqtt.MQTTMessageInfo]:
         """
         Raw publish function that expects a topic and a payload as a string or bytes.
+        Returns `None` if the message was suppressed or held back by
+        `publish_policies`.
+
+        `message` is the payload before it was serialized, given by
+        `send_message`, which is passed to `_cache_sent` once it is published.
+        """
+        return self._publish_throttle.publish(topic, payload, force_write, message)
+
+    def _publish_now(
+        self,
+        topic: str,
+        payload: Union[str, bytes],
+        force_write: bool = False,
+        message: Any = _NO_MESSAGE,
+    ) -> Optional[paho_mqtt.MQTTMessageInfo]:
+        client = self._client_for_topic(topic)
+
+        if self.retry_connect:
+            with self._offline_lock:
+                if client not in self._online:
+                    self._hold_offline(client, topic, payload, message)
+                    return None
+
+        return self._send(client, topic, payload, force_write, message)
+
+    def _cache_sent(self, topic: str, payload: Union[str, bytes], message: Any) -> None:
         """
+        Called with messages from `send_message` once they have been published,
+        with the serialized payload and the payload that was given.
+        Modules override this to keep their `message_cache`.
+        """
+
+    def _send(
+        self,
+        client: paho_mqtt.Client,
+        topic: str,
+        payload: Union[str, bytes],
+        force_write: bool = False,
+        message: Any = _NO_MESSAGE,
+    ) -> paho_mqtt.MQTTMessageInfo:
+        with self._stats_lock:
+            self.publish_stats.published += 1
+
         if self.enable_verbose_logging:
             logger.debug(f"Publishing message to {topic}: {payload}")
 
-        self._mqtt_client.publish(topic, payload)
+        policy = self._delivery_policy(topic)
+        if self.mqtt_v5:
+            info = self._publish_v5(
+                client,
+                topic,
+                payload,
+                policy.qos,
+                policy.retain,
+                time.time() if self.latency_tracking else None,
+            )
+        else:
+            info = client.publish(topic, payload, qos=policy.qos, retain=policy.retain)
+
+        if info.rc == paho_mqtt.MQTT_ERR_QUEUE_SIZE:
+            with self._stats_lock:
+                self._delivery_rejected += 1
+            logger.warning(f"Message to {topic} dropped, publish queue is full")
+        else:
+            if policy.qos > 0:
+                with self._stats_lock:
+                    messages = self._unacknowledged.setdefault(client, {})
+                    messages[info.mid] = info
+                    # the broker can acknowledge it before this point
+                    if info.is_published():
+                        del messages[info.mid]
+
+            if message is not _NO_MESSAGE:
+                self._cache_sent(topic, payload, message)
 
         # https://github.com/eclipse/paho.mqtt.python/blob/9782ab81fe7ee3a05e74c7f3e1d03d5611ea4be4/src/paho/mqtt/client.py#L1563
         # pre-emptively write network data while still in a callback, bypassing
         # the thread mutex.
-        # can only be used if run with .loop_forever()
+        # can only be used if run with .loop_forever(), from the thread running it,
+        # not from timers or other threads publishing
         # https://www.bellavrforum.org/t/sending-messages-to-pcc-from-sandbox/311/8
-        if self._looped_forever or force_write:
-            self._mqtt_client.loop_write()
+        if force_write or (
+            self._looped_forever
+            and client is self._mqtt_client
+            and threading.get_ident() == self._loop_thread
+        ):
+            client.loop_write()
+
+        return info
+
+    def _hold_offline(
+        self,
+        client: paho_mqtt.Client,
+        topic: str,
+        payload: Union[str, bytes],
+        message: Any,
+    ) -> None:
+        """
+        Queue a message published while a client is disconnected.
+        """
+        queue = self._offline_queues.get(client)
+        if queue is None:
+            queue = OfflineQueue(self.offline_queue_size)
+            self._offline_queues[client] = queue
+
+        policy = self._match_topic(self.offline_policies, topic)
+        if policy is None:
+            qos = self._delivery_policy(topic).qos
+            policy = "never_drop" if qos > 0 else "keep_latest"
+
+        # the queue doesn't look inside what it holds
+        queue.put(topic, (payload, message), policy)
+
+    def _send_offline(self, client: paho_mqtt.Client) -> None:
+        """
+        Send the messages held while a client was disconnected, and send
+        new messages straight away from now on.
+        """
+        with self._offline_lock:
+            queue = self._offline_queues.get(client)
+            if queue is not None and len(queue):
+                messages = queue.drain()
+                logger.info(f"Sending {len(messages)} messages held while offline")
+                for topic, (payload, message) in messages:
+                    self._send(client, topic, payload, message=message)
+
+            self._online.add(client)
+
+    def _publish_v5(
+        self,
+        client: paho_mqtt.Client,
+        topic: str,
+        payload: Union[str, bytes],
+        qos: int,
+        retain: bool,
+        sent: Optional[float] = None,
+    ) -> paho_mqtt.MQTTMessageInfo:
+        properties = Properties(PacketTypes.PUBLISH)
+
+        if sent is not None:
+            properties.UserProperty = (_SENT_TIME_PROPERTY, repr(sent))
+
+        expiry = self._match_topic(self.message_expiry, topic)
+        if expiry is not None:
+            properties.MessageExpiryInterval = expiry
+
+        if qos > 0:
+            # paho resends unacknowledged messages after reconnecting, when
+            # aliases from the old connection no longer mean anything
+            return client.publish(
+                topic, payload, qos=qos, retain=retain, properties=properties
+            )
+
+        with self._topic_alias_lock:
+            state = self._topic_aliases.get(client)
+            if state is None:
+                # not connected yet
+                return client.publish(
+                    topic, payload, retain=retain, properties=properties
+                )
+
+            aliases = state.aliases
+            alias = aliases.get(topic)
+            if alias is not None:
+                # the broker already knows the topic for this alias
+                properties.TopicAlias = alias
+                return client.publish("", payload, retain=retain, properties=properties)
+
+            if len(aliases) < state.maximum:
+                count = state.publish_counts.get(topic, 0) + 1
+                state.publish_counts[topic] = count
+
+                if count >= _TOPIC_ALIAS_MIN_PUBLISHES:
+                    # sending the topic with a new alias sets it up
+                    aliases[topic] = properties.TopicAlias = len(aliases) + 1
+                    del state.publish_counts[topic]
+
+            return client.publish(topic, payload, retain=retain, properties=properties)
+
+    def _create_client(self, shard: Optional[str] = None) -> paho_mqtt.Client:
+        name = (
+            self.__class__.__name__
+            if shard is None
+            else f"{self.__class__.__name__}_{shard}"
+        )
+        # Using MQTT v3.1.1 unless `mqtt_v5` is set
+        client = paho_mqtt.Client(
+            client_id=f"{name}_{uuid.uuid4()}",
+            protocol=paho_mqtt.MQTTv5 if self._mqtt_v5 else paho_mqtt.MQTTv311,
+        )
+
+        # set up the connection handlers
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_publish = self.on_publish
+        return client
+
+    def _connections(self) -> List[paho_mqtt.Client]:
+        """
+        Returns the main client, followed by the clients of `connection_shards`.
+        """
+        return [self._mqtt_client, *self._shard_clients.values()]
+
+    def _client_for_topic(self, topic: str) -> paho_mqtt.Client:
+        """
+        Returns the client a topic, or topic filter, is sent or subscribed to
+        on, from `connection_shards`.
+        """
+        client = self._topic_clients.get(topic)
+        if client is not None:
+            return client
+
+        client = self._mqtt_client
+        for name, topic_filters in self.connection_shards.items():
+            if name in self._shard_clients and any(
+                topic_filter == topic or topic_matches(topic_filter, topic)
+                for topic_filter in topic_filters
+            ):
+                client = self._shard_clients[name]
+                break
+
+        self._topic_clients[topic] = client
+        return client
+
+    def _receives(self, client: paho_mqtt.Client, topic: str) -> bool:
+        """
+        Returns whether messages on a topic arriving on a client should be
+        handled. With `connection_shards`, a message can arrive both on a
+        shard and through a wildcard subscription on the main connection,
+        and only the shard handles it.
+        """
+        if not self._shard_subscriptions:
+            return True
+
+        receiver = self._topic_receivers.get(topic)
+        if receiver is None:
+            receiver = self._mqtt_client
+            for shard, topic_filters in self._shard_subscriptions.items():
+                if self._in_topics(topic_filters, topic):
+                    receiver = shard
+                    break
+
+            self._topic_receivers[topic] = receiver
+
+        return receiver is client
+
+    def _delivery_policy(self, topic: str) -> DeliveryPolicy:
+        """
+        Returns the delivery policy for a topic from `delivery_policies`, or
+        the default for it.
+        """
+        policy = self._match_topic(self.delivery_policies, topic)
+        if policy is None:
+            policy = MQTTTopicDelivery.get(topic, DeliveryPolicy())
+        return policy
+
+    def _subscription_qos(self, topic_filter: str) -> int:
+        """
+        Returns the highest QoS of the topics a subscription covers.
+        """
+        qos = self._delivery_policy(topic_filter).qos
+        for topic in {**MQTTTopicDelivery, **self.delivery_policies}:
+            if (
+                "+" not in topic
+                and "#" not in topic
+                and topic_matches(topic_filter, topic)
+            ):
+                qos = max(qos, self._delivery_policy(topic).qos)
+        return qos
+
+    @staticmethod
+    def _match_topic(values: Dict[str, Any], topic: str) -> Any:
+        """
+        Returns the value for a topic from a dictionary keyed by topics or
+        topic filters, or `None`.
+        """
+        value = values.get(topic)
+        if value is not None:
+            return value
+
+        for topic_filter, value in values.items():
+            if ("+" in topic_filter or "#" in topic_filter) and topic_matches(
+                topic_filter, topic
+            ):
+                return value
+
+        return None
@@ -0,0 +1,70 @@
+"""
+Delivery guarantees for MQTT topics. Defaults for each topic come from the
+MQTT bindings in the AsyncAPI definition, as
+`bell.avr.mqtt.constants.MQTTTopicDelivery`, and can be changed per module
+with `bell.avr.mqtt.client.MQTTClient.delivery_policies`.
+"""
+
+import dataclasses
+
+
+@dataclasses.dataclass(frozen=True)
+class DeliveryPolicy:
+    """
+    How messages on a topic are published.
+    """
+
+    qos: int = 0
+    """
+    MQTT quality of service. 0 sends messages once with no acknowledgement,
+    which suits telemetry that is replaced by the next message anyway.
+    1 resends messages until the broker acknowledges them, which suits
+    commands like `avr/fcm/action/kill`. Subscriptions are made with the
+    highest QoS of the topics they cover, so messages are not downgraded.
+    """
+    retain: bool = False
+    """
+    Whether the broker keeps the last message, and sends it to clients that
+    subscribe later. This suits state that changes rarely. No topic is
+    retained by default, since a retained message outlives the module that
+    sent it. Set it in
+    `bell.avr.mqtt.client.MQTTClient.delivery_policies` to opt in.
+    """
+
+    def __post_init__(self) -> None:
+        if self.qos not in (0, 1, 2):
+            raise ValueError("QoS must be 0, 1 or 2")
+
+
+@dataclasses.dataclass
+class DeliveryStats:
+    """
+    Snapshot of messages with a QoS above 0 that the broker has not
+    acknowledged yet, see `bell.avr.mqtt.client.MQTTClient.delivery_stats`.
+    """
+
+    in_flight: int = 0
+    """
+    Number of messages waiting for the broker to acknowledge them, up to
+    `max_inflight_messages`.
+    """
+    queued: int = 0
+    """
+    Number of messages waiting past `max_inflight_messages`, which paho
+    holds back until earlier ones are acknowledged.
+    """
+    rejected: int = 0
+    """
+    Total number of messages that were not published, because
+    `max_queued_messages` were already waiting, in flight or queued.
+    """
+    offline: int = 0
+    """
+    Number of messages held while disconnected, see
+    `bell.avr.mqtt.client.MQTTClient.retry_connect`.
+    """
+    offline_dropped: int = 0
+    """
+    Total number of messages dropped while disconnected, because
+    `offline_queue_size` messages were already held.
+    """
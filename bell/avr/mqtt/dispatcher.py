@@ -1,21 +1,268 @@
-from typing import Any
+"""
+Routing of incoming MQTT messages to the callbacks registered for them.
+Topic keys may be exact topics, or MQTT topic filters using the `+`
+(single level) and `#` (multi level) wildcards.
+
+Callbacks are called with the payload as their only argument, or with no
+arguments if the payload is a `bell.avr.mqtt.payloads.AVREmptyMessage`.
+Which one is worked out from each callback's signature when the callbacks
+are compiled: callbacks that require an argument always get the payload,
+and callbacks without any parameters never do.
+Callbacks may also be `async def` functions when used with
+`bell.avr.mqtt.async_module.AsyncMQTTModule`.
+"""
+
+import inspect
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 from bell.avr.mqtt.constants import _MQTTTopicCallableTypedDict
 from bell.avr.mqtt.payloads import AVREmptyMessage
 
+# upper bound on the number of distinct topics remembered by `TopicCallbacks.match`
+_MATCH_CACHE_SIZE = 1024
+
+# how a callback is called
+_CALL_NO_ARGS = 0
+_CALL_WITH_PAYLOAD = 1
+# decided per message, by whether the payload is empty
+_CALL_BY_PAYLOAD = 2
+
+# the order a callback was added in, the callback, and how it is called
+_Handler = Tuple[int, Callable, int]
+
+
+def _resolve_arity(callback: Callable) -> int:
+    """
+    Work out once how a callback is called, from its signature.
+    """
+    try:
+        signature = inspect.signature(callback)
+    except (TypeError, ValueError):
+        # builtins and the like
+        return _CALL_BY_PAYLOAD
+
+    positional = [
+        parameter
+        for parameter in signature.parameters.values()
+        if parameter.kind
+        in (
+            inspect.Parameter.POSITIONAL_ONLY,
+            inspect.Parameter.POSITIONAL_OR_KEYWORD,
+            inspect.Parameter.VAR_POSITIONAL,
+        )
+    ]
+
+    if not positional:
+        return _CALL_NO_ARGS
+    if (
+        positional[0].kind != inspect.Parameter.VAR_POSITIONAL
+        and positional[0].default is inspect.Parameter.empty
+    ):
+        return _CALL_WITH_PAYLOAD
+    return _CALL_BY_PAYLOAD
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """
+    Returns whether a topic matches an MQTT topic filter, which can contain
+    the `+` and `#` wildcards.
+
+    Example:
+
+    ```python
+    from bell.avr.mqtt.dispatcher import topic_matches
+
+    topic_matches("avr/fusion/#", "avr/fusion/position/local")
+    # True
+    topic_matches("avr/+/battery", "avr/fcm/battery")
+    # True
+    ```
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+
+    # wildcards at the first level do not match topics starting with $
+    if topic.startswith("$") and filter_levels[0] in {"+", "#"}:
+        return False
+
+    for i, filter_level in enumerate(filter_levels):
+        if filter_level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if filter_level != "+" and filter_level != topic_levels[i]:
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+
+class _TrieNode:
+    __slots__ = ("children", "handlers")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _TrieNode] = {}
+        self.handlers: List[_Handler] = []
+
+
+class TopicCallbacks(dict):
+    """
+    Dictionary of topics (or topic filters) to callbacks that compiles itself
+    into a topic trie the first time a message is dispatched, and again after
+    it is modified. Values may be a single callback, or a list of callbacks
+    which are all run in order.
+
+    Lists are read when the trie is built, so changing a list in place
+    has no effect until the dictionary itself is modified. Assign the list
+    again instead, such as `topic_callbacks[topic] = [*callbacks, new]`.
+
+    `bell.avr.mqtt.client.MQTTClient.topic_callbacks` is automatically converted
+    to this class, so there is normally no need to create it directly.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._root: Optional[_TrieNode] = None
+        self._match_cache: Dict[str, Tuple[_Handler, ...]] = {}
+
+    def _invalidate(self) -> None:
+        self._root = None
+        self._match_cache = {}
+
+    def _compile(self) -> _TrieNode:
+        root = _TrieNode()
+        index = 0
+
+        for topic_filter, callbacks in self.items():
+            if not isinstance(callbacks, (list, tuple)):
+                callbacks = [callbacks]
+
+            node = root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, _TrieNode())
+
+            for callback in callbacks:
+                node.handlers.append((index, callback, _resolve_arity(callback)))
+                index += 1
+
+        self._root = root
+        return root
+
+    def _collect(
+        self, node: _TrieNode, levels: List[str], i: int, out: List[_Handler]
+    ) -> None:
+        wildcards = i != 0 or not levels[0].startswith("$")
+
+        # "#" also matches the parent level
+        multi = node.children.get("#")
+        if multi is not None and wildcards:
+            out.extend(multi.handlers)
+
+        if i == len(levels):
+            out.extend(node.handlers)
+            return
+
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._collect(child, levels, i + 1, out)
+
+        single = node.children.get("+")
+        if single is not None and wildcards:
+            self._collect(single, levels, i + 1, out)
+
+    def match(self, topic: str) -> Tuple[_Handler, ...]:
+        """
+        Returns the handlers registered for a topic, in the order they were
+        added. The result for each topic is remembered until the dictionary
+        is next modified.
+        """
+        handlers = self._match_cache.get(topic)
+        if handlers is not None:
+            return handlers
+
+        root = self._root
+        if root is None:
+            root = self._compile()
+
+        matched: List[_Handler] = []
+        self._collect(root, topic.split("/"), 0, matched)
+        handlers = tuple(sorted(matched, key=lambda h: h[0]))
+
+        if len(self._match_cache) >= _MATCH_CACHE_SIZE:
+            self._match_cache = {}
+        self._match_cache[topic] = handlers
+
+        return handlers
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        super().__setitem__(key, value)
+        self._invalidate()
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        self._invalidate()
+
+    def __ior__(self, other: Any) -> "TopicCallbacks":
+        super().__ior__(other)
+        self._invalidate()
+        return self
+
+    def clear(self) -> None:
+        super().clear()
+        self._invalidate()
+
+    def pop(self, *args: Any) -> Any:
+        value = super().pop(*args)
+        self._invalidate()
+        return value
+
+    def popitem(self) -> Tuple[str, Any]:
+        item = super().popitem()
+        self._invalidate()
+        return item
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        value = super().setdefault(key, default)
+        self._invalidate()
+        return value
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        super().update(*args, **kwargs)
+        self._invalidate()
+
+
+def _call_handlers(handlers: Tuple[_Handler, ...], payload: Any) -> List[Awaitable]:
+    """
+    Run the handlers for a payload. Returns the awaitables produced by any
+    `async def` callbacks, for the caller to schedule.
+    """
+    pending = []
+    empty = None
+
+    for _, callback, arity in handlers:
+        if arity == _CALL_BY_PAYLOAD:
+            if empty is None:
+                empty = isinstance(payload, AVREmptyMessage)
+            arity = _CALL_NO_ARGS if empty else _CALL_WITH_PAYLOAD
+
+        result = callback(payload) if arity == _CALL_WITH_PAYLOAD else callback()
+
+        if result is not None and inspect.isawaitable(result):
+            pending.append(result)
+
+    return pending
+
 
 def dispatch_message(
     topic_callbacks: _MQTTTopicCallableTypedDict, topic: str, payload: Any
 ) -> None:
     """
     Given a dictionary of topics and callbacks,
-    this executes the appropriate callback with the correct arguments.
+    this executes the appropriate callbacks with the correct arguments.
+
+    If `topic_callbacks` is not a `TopicCallbacks` instance, it is compiled
+    on every call, so prefer passing a `TopicCallbacks`.
     """
-    if topic not in topic_callbacks:
-        return
+    if not isinstance(topic_callbacks, TopicCallbacks):
+        topic_callbacks = TopicCallbacks(topic_callbacks)  # type: ignore
 
-    # execute callback
-    if isinstance(payload, AVREmptyMessage):
-        topic_callbacks[topic]()
-    else:
-        topic_callbacks[topic](payload)
+    _call_handlers(topic_callbacks.match(topic), payload)  # type: ignore
@@ -0,0 +1,184 @@
+"""
+Worker pool for running MQTT callbacks off of paho's network thread.
+See `bell.avr.mqtt.client.MQTTClient.callback_workers`.
+"""
+
+import collections
+import queue
+import threading
+from typing import Any, Callable, Deque, Dict, List, Literal, Optional, Tuple
+
+from loguru import logger
+
+OverflowPolicy = Literal["drop_oldest", "drop_newest"]
+"""
+What to do with a new job when the queue for its key is full. `drop_oldest`
+discards the oldest job that has not started yet, `drop_newest` discards the
+new job.
+"""
+
+_Job = Tuple[Callable, Tuple[Any, ...]]
+
+
+class OrderedExecutor:
+    """
+    Thread pool that runs jobs submitted with the same key one at a time,
+    in the order they were submitted, while jobs with different keys run in
+    parallel. `submit` never blocks; when a key already has `max_queue` jobs
+    waiting, one is dropped according to `overflow`.
+
+    Example:
+
+    ```python
+    from bell.avr.mqtt.executor import OrderedExecutor
+
+    executor = OrderedExecutor(workers=4, max_queue=10)
+    executor.submit("avr/vio/image/capture", process_image, payload)
+    ...
+    executor.shutdown()
+    ```
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        max_queue: int = 100,
+        overflow: OverflowPolicy = "drop_oldest",
+        name: str = "OrderedExecutor",
+    ) -> None:
+        if workers < 1:
+            raise ValueError("Executor needs at least 1 worker")
+        if max_queue < 0:
+            raise ValueError("Queue size cannot be negative")
+        if overflow not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+
+        self.max_queue = max_queue
+        """
+        Maximum number of jobs waiting per key. 0 means no limit.
+        """
+        self.overflow: OverflowPolicy = overflow
+        """
+        Overflow policy when a key's queue is full.
+        """
+        self.dropped = 0
+        """
+        Number of jobs dropped because their queue was full.
+        """
+
+        self._lock = threading.Lock()
+        # notified when there are no jobs left
+        self._idle = threading.Condition(self._lock)
+        # jobs waiting per key. A key is present while it has jobs waiting
+        # or running, and is in `_ready` at most once, so its jobs are never
+        # run by two workers at the same time
+        self._pending: Dict[str, Deque[_Job]] = {}
+        self._ready: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+        self._shutdown = False
+
+        self._threads: List[threading.Thread] = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._worker, name=f"{name}_{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key: str, fn: Callable, *args: Any) -> bool:
+        """
+        Queue `fn(*args)` to run after all jobs previously submitted with the
+        same key. Returns `False` if the job was dropped.
+        """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit to an executor after shutdown")
+
+            jobs = self._pending.get(key)
+            schedule = jobs is None
+            if jobs is None:
+                jobs = self._pending[key] = collections.deque()
+
+            if self.max_queue and len(jobs) >= self.max_queue:
+                self.dropped += 1
+                if self.overflow == "drop_newest":
+                    return False
+                jobs.popleft()
+
+            jobs.append((fn, args))
+
+        if schedule:
+            self._ready.put(key)
+
+        return True
+
+    def submit_latest(self, key: str, fn: Callable, *args: Any) -> bool:
+        """
+        Like `submit`, but any jobs for the same key that have not started yet
+        are replaced, so only the newest one runs. Returns `True` if a waiting
+        job was replaced.
+        """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit to an executor after shutdown")
+
+            jobs = self._pending.get(key)
+            schedule = jobs is None
+            if jobs is None:
+                jobs = self._pending[key] = collections.deque()
+
+            replaced = bool(jobs)
+            jobs.clear()
+            jobs.append((fn, args))
+
+        if schedule:
+            self._ready.put(key)
+
+        return replaced
+
+    def _worker(self) -> None:
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+
+            with self._lock:
+                fn, args = self._pending[key].popleft()
+
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception(f"Error running callback for {key}")
+
+            with self._lock:
+                if self._pending[key]:
+                    requeue = True
+                else:
+                    del self._pending[key]
+                    requeue = False
+                    if not self._pending:
+                        self._idle.notify_all()
+
+            # go to the back of the line, so busy keys don't starve others
+            if requeue:
+                self._ready.put(key)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop accepting jobs and stop the worker threads. If `wait` is `True`,
+        block until every queued job has run and the threads have stopped.
+        Otherwise, jobs that have not started yet may be discarded.
+        """
+        # a callback shutting down its own executor can't wait for itself
+        wait = wait and threading.current_thread() not in self._threads
+
+        with self._lock:
+            self._shutdown = True
+            if wait:
+                self._idle.wait_for(lambda: not self._pending)
+
+        for _ in self._threads:
+            self._ready.put(None)
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
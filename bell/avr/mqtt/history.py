@@ -0,0 +1,171 @@
+"""
+Fixed size histories of numeric MQTT topics, stored in NumPy arrays
+so they can be analyzed without looping over payloads in Python.
+"""
+
+import threading
+import time
+from typing import Any, NamedTuple, Optional, Type, Union
+
+import numpy as np
+import pydantic
+
+from bell.avr.mqtt.constants import MQTTPayloadStructLayout, MQTTTopicPayload
+
+
+def payload_dtype(payload: Union[str, Type[pydantic.BaseModel]]) -> np.dtype:
+    """
+    Returns a NumPy structured dtype with a field for each property of a
+    payload class, or the payload class of a topic. This is only possible for
+    payloads made up of numbers and booleans, as listed in
+    `bell.avr.mqtt.constants.MQTTPayloadStructLayout`. Otherwise a
+    `ValueError` is raised.
+
+    ```python
+    payload_dtype("avr/fusion/velocity")
+    # dtype([('Vn', '<f8'), ('Ve', '<f8'), ('Vd', '<f8')])
+    ```
+    """
+    klass = MQTTTopicPayload.get(payload) if isinstance(payload, str) else payload
+
+    layout = MQTTPayloadStructLayout.get(klass)  # type: ignore
+    if layout is None:
+        raise ValueError(f"{payload} does not have a fixed numeric layout")
+
+    return np.dtype(
+        [
+            (name, "<" + format_, (count,)) if count > 1 else (name, "<" + format_)
+            for name, format_, count in layout
+        ]
+    )
+
+
+class HistoryView(NamedTuple):
+    """
+    Part of a `TopicHistory`, oldest first.
+    """
+
+    timestamps: np.ndarray
+    """
+    When each payload was recorded, in seconds from `time.monotonic`.
+    """
+    values: np.ndarray
+    """
+    Structured array of payloads, with the dtype from `payload_dtype`.
+    """
+
+
+class TopicHistory:
+    """
+    Ring buffer of the last `capacity` payloads on a topic. Payloads are
+    usually appended on the network thread while other threads query them,
+    so queries return copies of just the payloads asked for, taken under a
+    lock, which later payloads can't overwrite.
+
+    Instances are callable with a payload, so one can be used directly as a
+    callback in `bell.avr.mqtt.client.MQTTClient.topic_callbacks`.
+
+    Example:
+
+    ```python
+    from bell.avr.mqtt.history import TopicHistory
+
+    class Sandbox(MQTTModule):
+        def __init__(self):
+            super().__init__()
+
+            self.velocity = TopicHistory("avr/fusion/velocity", capacity=500)
+            self.topic_callbacks = {"avr/fusion/velocity": self.velocity}
+
+        def average_north_velocity(self) -> float:
+            return self.velocity.window(2.0).values["Vn"].mean()
+    ```
+    """
+
+    def __init__(
+        self, payload: Union[str, Type[pydantic.BaseModel]], capacity: int
+    ) -> None:
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1")
+
+        self.dtype = payload_dtype(payload)
+        """
+        The structured dtype of the values.
+        """
+        self.capacity = capacity
+        """
+        Maximum number of payloads kept.
+        """
+
+        # every value is written twice, `capacity` apart, so the latest
+        # `capacity` values are always contiguous and can be returned as a view
+        self._values = np.zeros(2 * capacity, dtype=self.dtype)
+        self._timestamps = np.zeros(2 * capacity, dtype=np.float64)
+        self._fields = self.dtype.names
+        # total number of values appended
+        self._count = 0
+        # appends and queries come from different threads
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return min(self._count, self.capacity)
+
+    def __call__(self, payload: Any) -> None:
+        self.append(payload)
+
+    def append(self, payload: Any, timestamp: Optional[float] = None) -> None:
+        """
+        Record a payload, which can be a payload class or a dictionary.
+        If not given, the timestamp is the current `time.monotonic`.
+        Timestamps must not go backwards.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        if isinstance(payload, dict):
+            record = tuple(payload[name] for name in self._fields)  # type: ignore
+        else:
+            record = tuple(getattr(payload, name) for name in self._fields)  # type: ignore
+
+        with self._lock:
+            i = self._count % self.capacity
+            self._values[i] = self._values[i + self.capacity] = record
+            self._timestamps[i] = self._timestamps[i + self.capacity] = timestamp
+
+            self._count += 1
+
+    def _view(self, n: int) -> HistoryView:
+        """
+        Returns the last `n` payloads without copying. Must be called with
+        the lock held.
+        """
+        end = self._count % self.capacity + self.capacity
+        return HistoryView(self._timestamps[end - n : end], self._values[end - n : end])
+
+    def last(self, n: Optional[int] = None) -> HistoryView:
+        """
+        Returns the last `n` payloads, or all of them if `n` is not given.
+        """
+        with self._lock:
+            length = len(self)
+            if n is None or n > length:
+                n = length
+
+            view = self._view(max(n, 0))
+            return HistoryView(view.timestamps.copy(), view.values.copy())
+
+    def window(self, seconds: float, now: Optional[float] = None) -> HistoryView:
+        """
+        Returns the payloads recorded in the last `seconds` seconds before `now`,
+        which defaults to the current `time.monotonic`.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        with self._lock:
+            view = self._view(len(self))
+            start = int(np.searchsorted(view.timestamps, now - seconds, side="left"))
+
+            return HistoryView(
+                view.timestamps[start:].copy(), view.values[start:].copy()
+            )
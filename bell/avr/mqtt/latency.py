@@ -0,0 +1,226 @@
+"""
+Latency histograms for MQTT messages, from when they are published to when
+the subscriber's callbacks finish, split into stages. These are recorded by
+`bell.avr.mqtt.client.MQTTClient` when `latency_tracking` is enabled.
+
+The stages are:
+
+- `network`: from the sender publishing the message to it being received,
+  through the broker and paho. This compares clocks of the sender and
+  receiver, so is only meaningful if they are in sync, such as on the same
+  machine. This and `total` are only recorded for senders with `mqtt_v5`
+  enabled, which carry the send time in a user property.
+- `dispatch`: from the message being received to being processed, which is
+  time spent waiting for a worker if `callback_workers` is set.
+- `decode`: deserializing the payload.
+- `handler`: running the callbacks.
+- `total`: from the sender publishing the message to the callbacks finishing.
+"""
+
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+
+STAGES = ("network", "dispatch", "decode", "handler", "total")
+"""
+The stages latency is recorded for.
+"""
+
+# values below 2 ** _SUB_BUCKET_BITS microseconds get a bucket each, and above
+# that, every power of two is split into 2 ** (_SUB_BUCKET_BITS - 1) buckets
+_SUB_BUCKET_BITS = 7
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_HALF_BUCKET_BITS = _SUB_BUCKET_BITS - 1
+
+
+def _bucket_index(value: int) -> int:
+    if value < _SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - _SUB_BUCKET_BITS
+    return (shift << _HALF_BUCKET_BITS) + (value >> shift)
+
+
+def _bucket_upper_bound(index: int) -> int:
+    if index < _SUB_BUCKETS:
+        return index
+    shift = (index >> _HALF_BUCKET_BITS) - 1
+    top = index - (shift << _HALF_BUCKET_BITS)
+    return ((top + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations in the style of HdrHistogram. Durations are
+    recorded in microseconds, into buckets whose width is at most 1/64 of
+    their value, so percentiles are accurate to within about 1.6% at any
+    scale, with a fixed number of counters.
+
+    Durations longer than `max_value` seconds are counted as `max_value`,
+    and negative durations, possible when clocks are not in sync, as 0.
+    """
+
+    def __init__(self, max_value: float = 60.0) -> None:
+        self.max_value = max_value
+        """
+        Longest duration that can be recorded accurately, in seconds.
+        """
+
+        self._max_micros = int(max_value * 1e6)
+        self._counts: List[int] = [0] * (_bucket_index(self._max_micros) + 1)
+        self._lock = threading.Lock()
+
+        self.count = 0
+        """
+        Number of durations recorded.
+        """
+        self.total = 0.0
+        """
+        Sum of the durations recorded, in seconds.
+        """
+        self.max = 0.0
+        """
+        Longest duration recorded, in seconds.
+        """
+
+    def record(self, seconds: float) -> None:
+        """
+        Record a duration in seconds.
+        """
+        micros = min(max(int(seconds * 1e6), 0), self._max_micros)
+        index = _bucket_index(micros)
+
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    @property
+    def mean(self) -> float:
+        """
+        Average duration recorded, in seconds.
+        """
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Returns the duration in seconds that `percentile` percent of recorded
+        durations are shorter than or equal to, or 0 if nothing was recorded.
+        """
+        if not self.count:
+            return 0.0
+
+        target = max(math.ceil(percentile / 100 * self.count), 1)
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                return min(_bucket_upper_bound(index) / 1e6, self.max)
+
+        return self.max
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        """
+        Add the durations recorded by another histogram with the same
+        `max_value` to this one.
+        """
+        if other.max_value != self.max_value:
+            raise ValueError("Histograms must have the same max_value")
+
+        with self._lock:
+            for index, count in enumerate(other._counts):
+                if count:
+                    self._counts[index] += count
+            self.count += other.count
+            self.total += other.total
+            self.max = max(self.max, other.max)
+
+    def reset(self) -> None:
+        """
+        Forget all recorded durations.
+        """
+        with self._lock:
+            self._counts = [0] * len(self._counts)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Returns the count, mean, 50th, 90th and 99th percentiles, and maximum,
+        with durations in seconds.
+        """
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class LatencyTracker:
+    """
+    A `LatencyHistogram` for every topic and stage. See the module
+    documentation for what each stage covers.
+
+    Example:
+
+    ```python
+    self.latency_tracking = True
+    ...
+    histogram = self.latency.histogram("avr/fusion/position/local", "total")
+    if histogram is not None:
+        print(histogram.percentile(99))
+    ```
+    """
+
+    def __init__(self, max_value: float = 60.0) -> None:
+        self.max_value = max_value
+        """
+        Longest duration the histograms can record accurately, in seconds.
+        """
+        self._histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def record(self, topic: str, stage: str, seconds: float) -> None:
+        """
+        Record how long a stage took for a message on a topic.
+        """
+        histogram = self._histograms.get((topic, stage))
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(
+                    (topic, stage), LatencyHistogram(self.max_value)
+                )
+
+        histogram.record(seconds)
+
+    def histogram(self, topic: str, stage: str) -> Optional[LatencyHistogram]:
+        """
+        Returns the histogram for a topic and stage, or `None` if nothing
+        has been recorded for them.
+        """
+        return self._histograms.get((topic, stage))
+
+    def reset(self) -> None:
+        """
+        Forget all recorded durations.
+        """
+        with self._lock:
+            self._histograms.clear()
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """
+        Returns `LatencyHistogram.summary` for every stage of every topic,
+        as a dictionary of topics to dictionaries of stages.
+        """
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+
+        summary: Dict[str, Dict[str, Dict[str, float]]] = {}
+        for (topic, stage), histogram in histograms:
+            summary.setdefault(topic, {})[stage] = histogram.summary()
+        return summary
@@ -0,0 +1,161 @@
+"""
+Handling of the broker being unreachable: retrying the connection with
+backoff, and holding messages published in the meantime.
+See `bell.avr.mqtt.client.MQTTClient.retry_connect`.
+"""
+
+import collections
+import dataclasses
+import random
+import threading
+from typing import Any, Deque, Dict, List, Literal, Optional, Tuple
+
+OfflinePolicy = Literal["keep_latest", "drop_oldest", "never_drop"]
+"""
+What happens to messages on a topic published while disconnected:
+
+- `keep_latest`: only the latest message is kept, for state and telemetry
+  where older values are useless.
+- `drop_oldest`: every message is kept, but the oldest are dropped to make
+  room once the queue is full.
+- `never_drop`: every message is kept, even past the size of the queue, for
+  commands like `avr/fcm/action/kill`.
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class ReconnectBackoff:
+    """
+    How long to wait between attempts to connect to the broker. paho starts
+    at the initial delay and doubles it with every failed attempt, up to
+    `max_delay`. A random part of the initial delay is taken off for each
+    connection, so modules started together don't retry together.
+    """
+
+    initial_delay: float = 0.1
+    """
+    Seconds to wait after the first failed attempt.
+    """
+    max_delay: float = 30.0
+    """
+    Longest time to wait between attempts, in seconds.
+    """
+    jitter: float = 0.5
+    """
+    Fraction of the initial delay that is random, between 0 and 1.
+    """
+
+    def __post_init__(self) -> None:
+        if self.initial_delay <= 0 or self.max_delay < self.initial_delay:
+            raise ValueError("Delays must be positive, with max_delay the largest")
+        if not 0 <= self.jitter <= 1:
+            raise ValueError("jitter must be between 0 and 1")
+
+    def delays(self) -> Tuple[float, float]:
+        """
+        Returns the initial and maximum delay for a connection, with the
+        random part taken off the initial delay, for paho's
+        `reconnect_delay_set`.
+        """
+        initial_delay = self.initial_delay * (1 - self.jitter * random.random())
+        return initial_delay, self.max_delay
+
+
+class OfflineQueue:
+    """
+    Bounded queue of messages published while disconnected, in order, with
+    an `OfflinePolicy` for each message.
+
+    Once the queue holds `maxsize` messages, the oldest message that isn't
+    `never_drop` is dropped for each new one. `never_drop` messages are kept
+    even if that takes the queue past `maxsize`.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        """
+        Number of messages the queue holds before dropping them.
+        """
+        self.dropped = 0
+        """
+        Total number of messages dropped.
+        """
+
+        # entries are [topic, payload, policy], with the payload set to None
+        # once dropped or replaced, so they are skipped
+        self._entries: Deque[list] = collections.deque()
+        # topic: entry, for keep_latest topics
+        self._latest: Dict[str, list] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def put(self, topic: str, payload: Any, policy: OfflinePolicy) -> None:
+        """
+        Add a message to the end of the queue. The payload can be anything
+        other than `None`.
+        """
+        entry = [topic, payload, policy]
+
+        with self._lock:
+            if policy == "keep_latest":
+                previous = self._latest.get(topic)
+                if previous is not None:
+                    # replaced, rather than dropped
+                    self._remove(previous)
+                    self.dropped -= 1
+                self._latest[topic] = entry
+
+            self._entries.append(entry)
+            self._size += 1
+
+            if self._size > self.maxsize:
+                self._drop_oldest()
+
+            # replaced entries can be anywhere, so clear them out once they
+            # outnumber the messages left
+            if len(self._entries) > 2 * self._size + 16:
+                self._entries = collections.deque(
+                    entry for entry in self._entries if entry[1] is not None
+                )
+
+    def drain(self) -> List[Tuple[str, Any]]:
+        """
+        Remove every message from the queue, and return them as
+        `(topic, payload)` tuples, oldest first.
+        """
+        with self._lock:
+            messages = [
+                (topic, payload)
+                for topic, payload, _ in self._entries
+                if payload is not None
+            ]
+            self._entries.clear()
+            self._latest.clear()
+            self._size = 0
+
+        return messages
+
+    def _remove(self, entry: list) -> None:
+        entry[1] = None
+        self._size -= 1
+        self.dropped += 1
+
+        if self._latest.get(entry[0]) is entry:
+            del self._latest[entry[0]]
+
+    def _drop_oldest(self) -> None:
+        dropped: Optional[list] = None
+        for entry in self._entries:
+            if entry[1] is not None and entry[2] != "never_drop":
+                dropped = entry
+                break
+
+        if dropped is not None:
+            self._remove(dropped)
+
+        # don't let skipped entries pile up at the front
+        while self._entries and self._entries[0][1] is None:
+            self._entries.popleft()
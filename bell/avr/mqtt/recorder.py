@@ -0,0 +1,588 @@
+"""
+Recording of MQTT traffic to disk, and reading it back.
+
+A recording is an append-only file of chunks, each holding many
+`(timestamp, topic id, raw payload)` records, optionally compressed with zlib.
+Next to it, a sidecar index (the same path plus `.idx`) lists the topic ids,
+and for each chunk its offset, time range and topics. This lets
+`RecordingReader` jump straight to the chunks it needs. The index is plain
+JSON lines, and topic names are also stored in the chunks, so a recording can
+still be read if the index is lost.
+
+Example:
+
+```python
+from bell.avr.mqtt.recorder import FlightRecorder, RecordingReader
+
+# record everything on avr/# until stopped
+FlightRecorder("flight.avrrec").run()
+
+# later
+with RecordingReader("flight.avrrec") as reader:
+    for message in reader.messages(topics=["avr/fcm/battery"], start=reader.start_time + 60):
+        print(message.timestamp, message.payload)
+```
+"""
+
+import bisect
+import collections
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import (
+    IO,
+    Any,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import paho.mqtt.client as paho_mqtt
+from loguru import logger
+
+from bell.avr.mqtt.client import MQTTClient
+from bell.avr.mqtt.dispatcher import topic_matches
+
+_FILE_HEADER = b"AVRREC1\n"
+# chunk magic, flags, stored size, uncompressed size
+_CHUNK_HEADER = struct.Struct("<cBII")
+_CHUNK_MAGIC = b"C"
+_CHUNK_COMPRESSED = 0x01
+# timestamp, topic id, payload size
+_RECORD_HEADER = struct.Struct("<dHI")
+# records with this topic id define a topic: uint16 id followed by the name
+_TOPIC_DEFINITION = 0xFFFF
+_TOPIC_ID = struct.Struct("<H")
+
+_INDEX_SUFFIX = ".idx"
+
+
+class RecordedMessage(NamedTuple):
+    """
+    A single message from a recording.
+    """
+
+    timestamp: float
+    """
+    When the message was received, as a UNIX timestamp.
+    """
+    topic: str
+    """
+    The topic of the message.
+    """
+    payload: bytes
+    """
+    The raw payload, which can be deserialized with
+    `bell.avr.mqtt.serializer.deserialize_payload`.
+    """
+
+
+class _Chunk(NamedTuple):
+    offset: int
+    size: int
+    compressed: bool
+    start: float
+    end: float
+    count: int
+    topics: FrozenSet[int]
+
+
+class _SealedChunk(NamedTuple):
+    data: bytes
+    # topics first seen in this chunk, for the index
+    topics: List[Tuple[str, int]]
+    start: float
+    end: float
+    count: int
+    chunk_topics: Set[int]
+
+
+class RecordingWriter:
+    """
+    Writes messages to a new recording. Records are buffered in memory and
+    written as a chunk once `chunk_size` bytes or `chunk_interval` seconds
+    of messages have been collected, or `chunk_interval` seconds after the
+    first buffered message if no more arrive, so at most that much is lost
+    if the process dies.
+
+    Chunks are compressed and written by a background thread, so `write` is
+    cheap enough to call from the MQTT network thread.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, os.PathLike],
+        compress: bool = True,
+        chunk_size: int = 1024 * 1024,
+        chunk_interval: float = 5.0,
+    ) -> None:
+        self.path = os.fspath(path)
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.chunk_interval = chunk_interval
+
+        self._lock = threading.Lock()
+        # wakes the writer thread, and anything waiting for it in `flush`
+        self._changed = threading.Condition(self._lock)
+        self._data: IO[bytes] = open(self.path, "wb")
+        self._index: IO[str] = open(self.path + _INDEX_SUFFIX, "w")
+        self._data.write(_FILE_HEADER)
+
+        self._topic_ids: Dict[str, int] = {}
+        self._new_topics: List[Tuple[str, int]] = []
+
+        self._buffer = bytearray()
+        self._chunk_start = 0.0
+        self._chunk_end = 0.0
+        self._chunk_count = 0
+        self._chunk_topics: Set[int] = set()
+        # when the first buffered record was written, by the monotonic clock
+        self._buffered_at = 0.0
+
+        self._sealed: Deque[_SealedChunk] = collections.deque()
+        self._sealed_count = 0
+        self._written_count = 0
+        self._closing = False
+
+        self._thread = threading.Thread(
+            target=self._run, name="recording_writer", daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self) -> "RecordingWriter":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _topic_id(self, topic: str) -> int:
+        topic_id = self._topic_ids.get(topic)
+        if topic_id is not None:
+            return topic_id
+
+        topic_id = len(self._topic_ids)
+        if topic_id >= _TOPIC_DEFINITION:
+            raise ValueError("Too many topics for one recording")
+
+        self._topic_ids[topic] = topic_id
+        self._new_topics.append((topic, topic_id))
+
+        # inline, so the recording can be read without the index
+        definition = _TOPIC_ID.pack(topic_id) + topic.encode()
+        self._buffer += _RECORD_HEADER.pack(0.0, _TOPIC_DEFINITION, len(definition))
+        self._buffer += definition
+
+        return topic_id
+
+    def write(
+        self,
+        topic: str,
+        payload: Union[bytes, bytearray, memoryview],
+        timestamp: Optional[float] = None,
+    ) -> None:
+        """
+        Record a raw message. The timestamp defaults to now.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._lock:
+            if self._closing:
+                raise ValueError("Recording is closed")
+
+            if not self._buffer:
+                self._buffered_at = time.monotonic()
+                # the writer thread now has a deadline to wait for
+                self._changed.notify_all()
+
+            topic_id = self._topic_id(topic)
+
+            if not self._chunk_count:
+                self._chunk_start = timestamp
+
+            self._buffer += _RECORD_HEADER.pack(timestamp, topic_id, len(payload))
+            self._buffer += payload
+
+            self._chunk_end = timestamp
+            self._chunk_count += 1
+            self._chunk_topics.add(topic_id)
+
+            if (
+                len(self._buffer) >= self.chunk_size
+                or timestamp - self._chunk_start >= self.chunk_interval
+            ):
+                self._seal()
+
+    def _seal(self) -> None:
+        """
+        Hand the buffered records to the writer thread as a chunk.
+        """
+        if not self._buffer:
+            return
+
+        self._sealed.append(
+            _SealedChunk(
+                bytes(self._buffer),
+                self._new_topics,
+                self._chunk_start,
+                self._chunk_end,
+                self._chunk_count,
+                self._chunk_topics,
+            )
+        )
+        self._sealed_count += 1
+        self._changed.notify_all()
+
+        self._buffer = bytearray()
+        self._new_topics = []
+        self._chunk_count = 0
+        self._chunk_topics = set()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while not self._sealed:
+                    if self._closing:
+                        return
+
+                    if self._buffer:
+                        remaining = (
+                            self._buffered_at + self.chunk_interval - time.monotonic()
+                        )
+                        if remaining <= 0:
+                            # nothing new has arrived for a while
+                            self._seal()
+                            continue
+                        self._changed.wait(remaining)
+                    else:
+                        self._changed.wait()
+
+                chunk = self._sealed.popleft()
+
+            try:
+                self._write_chunk(chunk)
+            except Exception:
+                logger.exception(f"Failed to write a chunk to {self.path}")
+
+            with self._lock:
+                self._written_count += 1
+                self._changed.notify_all()
+
+    def _write_chunk(self, chunk: _SealedChunk) -> None:
+        data = chunk.data
+        flags = 0
+        if self.compress:
+            data = zlib.compress(data, 1)
+            flags |= _CHUNK_COMPRESSED
+
+        # the index is written first, so a chunk can't be on disk without its
+        # entry. The reader skips entries for chunks that never made it.
+        offset = self._data.tell()
+        for topic, topic_id in chunk.topics:
+            self._index.write(json.dumps({"topic": topic, "id": topic_id}) + "\n")
+        if chunk.count:
+            self._index.write(
+                json.dumps(
+                    {
+                        "offset": offset,
+                        "size": len(data),
+                        "compressed": self.compress,
+                        "start": chunk.start,
+                        "end": chunk.end,
+                        "count": chunk.count,
+                        "topics": sorted(chunk.chunk_topics),
+                    }
+                )
+                + "\n"
+            )
+        self._index.flush()
+
+        self._data.write(
+            _CHUNK_HEADER.pack(_CHUNK_MAGIC, flags, len(data), len(chunk.data))
+        )
+        self._data.write(data)
+        self._data.flush()
+
+    def flush(self) -> None:
+        """
+        Write any buffered messages to disk as a chunk, and wait until they
+        have been written.
+        """
+        with self._lock:
+            self._seal()
+            target = self._sealed_count
+            while self._written_count < target and self._thread.is_alive():
+                self._changed.wait()
+
+    def close(self) -> None:
+        """
+        Write any buffered messages and close the recording.
+        """
+        with self._lock:
+            if self._closing:
+                return
+
+            self._seal()
+            self._closing = True
+            self._changed.notify_all()
+
+        # the thread writes every sealed chunk before finishing
+        self._thread.join()
+        self._data.close()
+        self._index.close()
+
+
+class RecordingReader:
+    """
+    Reads a recording made by `RecordingWriter`. The recording is memory
+    mapped, and only the chunks overlapping the requested time range and
+    topics are read.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]) -> None:
+        self.path = os.fspath(path)
+
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[: len(_FILE_HEADER)] != _FILE_HEADER:
+            self.close()
+            raise ValueError(f"{self.path} is not a recording")
+
+        self._topics: Dict[int, str] = {}
+        self._chunks: List[_Chunk] = []
+
+        if os.path.exists(self.path + _INDEX_SUFFIX):
+            self._load_index()
+            self._chunks = [chunk for chunk in self._chunks if self._is_written(chunk)]
+        else:
+            self._scan()
+
+        # for finding the first chunk that could contain a time
+        self._chunk_ends = [chunk.end for chunk in self._chunks]
+
+    def __enter__(self) -> "RecordingReader":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Close the recording.
+        """
+        self._mmap.close()
+        self._file.close()
+
+    def _load_index(self) -> None:
+        with open(self.path + _INDEX_SUFFIX) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written last line
+                    break
+
+                if "topic" in entry:
+                    self._topics[entry["id"]] = entry["topic"]
+                else:
+                    self._chunks.append(
+                        _Chunk(
+                            entry["offset"],
+                            entry["size"],
+                            entry["compressed"],
+                            entry["start"],
+                            entry["end"],
+                            entry["count"],
+                            frozenset(entry["topics"]),
+                        )
+                    )
+
+    def _is_written(self, chunk: _Chunk) -> bool:
+        """
+        Whether an indexed chunk is completely in the recording. Index entries
+        are written before their chunks, so the last may not be after a crash.
+        """
+        if chunk.offset + _CHUNK_HEADER.size + chunk.size > len(self._mmap):
+            return False
+
+        magic, _, size, _ = _CHUNK_HEADER.unpack_from(self._mmap, chunk.offset)
+        return magic == _CHUNK_MAGIC and size == chunk.size
+
+    def _scan(self) -> None:
+        """
+        Rebuild the index by reading every chunk.
+        """
+        offset = len(_FILE_HEADER)
+
+        while offset + _CHUNK_HEADER.size <= len(self._mmap):
+            magic, flags, size, _ = _CHUNK_HEADER.unpack_from(self._mmap, offset)
+            if magic != _CHUNK_MAGIC or offset + _CHUNK_HEADER.size + size > len(
+                self._mmap
+            ):
+                # truncated by a crash
+                break
+
+            chunk = _Chunk(
+                offset, size, bool(flags & _CHUNK_COMPRESSED), 0, 0, 0, frozenset()
+            )
+
+            timestamps = []
+            topics = set()
+            for timestamp, topic_id, payload in self._records(chunk):
+                if topic_id == _TOPIC_DEFINITION:
+                    (defined_id,) = _TOPIC_ID.unpack_from(payload)
+                    self._topics[defined_id] = bytes(payload[_TOPIC_ID.size :]).decode()
+                else:
+                    timestamps.append(timestamp)
+                    topics.add(topic_id)
+
+            if timestamps:
+                self._chunks.append(
+                    chunk._replace(
+                        start=timestamps[0],
+                        end=timestamps[-1],
+                        count=len(timestamps),
+                        topics=frozenset(topics),
+                    )
+                )
+
+            offset += _CHUNK_HEADER.size + size
+
+    def _records(self, chunk: _Chunk) -> Iterator[tuple]:
+        start = chunk.offset + _CHUNK_HEADER.size
+        data: Union[bytes, memoryview]
+        if chunk.compressed:
+            data = zlib.decompress(self._mmap[start : start + chunk.size])
+        else:
+            data = memoryview(self._mmap)[start : start + chunk.size]
+
+        position = 0
+        while position < len(data):
+            timestamp, topic_id, size = _RECORD_HEADER.unpack_from(data, position)
+            position += _RECORD_HEADER.size
+            yield timestamp, topic_id, data[position : position + size]
+            position += size
+
+    @property
+    def topics(self) -> List[str]:
+        """
+        Every topic in the recording.
+        """
+        return list(self._topics.values())
+
+    @property
+    def start_time(self) -> Optional[float]:
+        """
+        Timestamp of the first message, or `None` if the recording is empty.
+        """
+        return self._chunks[0].start if self._chunks else None
+
+    @property
+    def end_time(self) -> Optional[float]:
+        """
+        Timestamp of the last message, or `None` if the recording is empty.
+        """
+        return self._chunks[-1].end if self._chunks else None
+
+    def __len__(self) -> int:
+        return sum(chunk.count for chunk in self._chunks)
+
+    def messages(
+        self,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        topics: Optional[Iterable[str]] = None,
+    ) -> Iterator[RecordedMessage]:
+        """
+        Iterate over the recorded messages in order, optionally only those
+        between the `start` and `end` timestamps (inclusive), and on the given
+        topics or topic filters.
+        """
+        topic_ids: Optional[Set[int]] = None
+        if topics is not None:
+            topic_filters = list(topics)
+            topic_ids = {
+                topic_id
+                for topic_id, topic in self._topics.items()
+                if any(topic_matches(f, topic) for f in topic_filters)
+            }
+
+        first = 0
+        if start is not None:
+            first = bisect.bisect_left(self._chunk_ends, start)
+
+        for chunk in self._chunks[first:]:
+            if end is not None and chunk.start > end:
+                break
+
+            if topic_ids is not None and not chunk.topics & topic_ids:
+                continue
+
+            for timestamp, topic_id, payload in self._records(chunk):
+                if (
+                    topic_id == _TOPIC_DEFINITION
+                    or (topic_ids is not None and topic_id not in topic_ids)
+                    or (start is not None and timestamp < start)
+                    or (end is not None and timestamp > end)
+                ):
+                    continue
+
+                yield RecordedMessage(timestamp, self._topics[topic_id], bytes(payload))
+
+
+class FlightRecorder(MQTTClient):
+    """
+    MQTT client that records every message on `avr/#` to a recording.
+    Payloads are written exactly as received, without being deserialized.
+
+    ```python
+    from bell.avr.mqtt.recorder import FlightRecorder
+
+    recorder = FlightRecorder("flight.avrrec")
+    recorder.run()
+    ```
+    """
+
+    def __init__(
+        self,
+        path: Union[str, os.PathLike],
+        compress: bool = True,
+        chunk_size: int = 1024 * 1024,
+        chunk_interval: float = 5.0,
+    ) -> None:
+        super().__init__()
+
+        self.subscribe_to_all_avr_topics = True
+
+        self.writer = RecordingWriter(path, compress, chunk_size, chunk_interval)
+        """
+        The `RecordingWriter` messages are written to.
+        """
+
+    def on_message(
+        self, client: paho_mqtt.Client, userdata: Any, msg: paho_mqtt.MQTTMessage
+    ) -> None:
+        """
+        Record an incoming message. This is called automatically.
+        """
+        self.writer.write(msg.topic, msg.payload)
+
+    def stop(self) -> None:
+        """
+        Stop recording, and close the recording.
+        """
+        super().stop()
+        self.writer.close()
@@ -0,0 +1,191 @@
+"""
+Replay of recorded MQTT traffic into a module, without a broker. Messages are
+given to the module's `on_message` as paho messages, so they go through the
+same logging, deserialization and dispatch as live ones, which makes this
+useful for regression tests, and for measuring how many messages per second
+a module can keep up with.
+
+Example:
+
+```python
+from bell.avr.mqtt.replay import replay
+
+module = Sandbox()
+stats = replay(module, "flight.avrrec", speed=None)
+
+print(f"{stats.throughput:.0f} messages per second")
+for topic, latency in stats.topics.items():
+    print(topic, latency.mean, latency.max)
+```
+"""
+
+import dataclasses
+import json
+import os
+import time
+from typing import Dict, Iterable, Iterator, Optional, Union
+
+import paho.mqtt.client as paho_mqtt
+
+from bell.avr.mqtt.client import MQTTClient
+from bell.avr.mqtt.recorder import RecordedMessage, RecordingReader
+
+
+@dataclasses.dataclass
+class TopicLatency:
+    """
+    How long a module took to handle the messages on a topic.
+    """
+
+    count: int = 0
+    """
+    Number of messages handled.
+    """
+    total: float = 0.0
+    """
+    Total time spent handling messages, in seconds.
+    """
+    max: float = 0.0
+    """
+    Longest time spent handling a single message, in seconds.
+    """
+
+    @property
+    def mean(self) -> float:
+        """
+        Average time spent handling a message, in seconds.
+        """
+        return self.total / self.count if self.count else 0.0
+
+
+@dataclasses.dataclass
+class ReplayStats:
+    """
+    Results of `replay`.
+    """
+
+    messages: int = 0
+    """
+    Number of messages replayed.
+    """
+    elapsed: float = 0.0
+    """
+    How long the replay took, in seconds.
+    """
+    max_lag: float = 0.0
+    """
+    How far behind the recording's timing the replay fell at worst, in seconds.
+    If this keeps growing, the module can't keep up at this speed.
+    """
+    topics: Dict[str, TopicLatency] = dataclasses.field(default_factory=dict)
+    """
+    Handling time per topic. This covers deserialization and callbacks,
+    or only queueing the message if callbacks run in worker threads.
+    """
+
+    @property
+    def throughput(self) -> float:
+        """
+        Messages replayed per second.
+        """
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+
+def read_json_lines(path: Union[str, os.PathLike]) -> Iterator[RecordedMessage]:
+    """
+    Read messages from a JSON lines file, with one object per line like
+    `{"timestamp": 1700000000.0, "topic": "avr/fcm/battery", "payload": {...}}`.
+    The payload may be a JSON value or a string of JSON.
+    """
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+
+            entry = json.loads(line)
+            payload = entry["payload"]
+            if not isinstance(payload, str):
+                payload = json.dumps(payload)
+
+            yield RecordedMessage(
+                float(entry["timestamp"]), entry["topic"], payload.encode()
+            )
+
+
+def load_messages(path: Union[str, os.PathLike]) -> Iterator[RecordedMessage]:
+    """
+    Read messages from a recording made by `bell.avr.mqtt.recorder`, or from a
+    JSON lines file if the path ends in `.jsonl` or `.json`.
+    """
+    if os.fspath(path).endswith((".jsonl", ".json")):
+        yield from read_json_lines(path)
+        return
+
+    with RecordingReader(path) as reader:
+        yield from reader.messages()
+
+
+def replay(
+    module: MQTTClient,
+    messages: Union[str, os.PathLike, Iterable[RecordedMessage]],
+    speed: Optional[float] = 1.0,
+) -> ReplayStats:
+    """
+    Feed messages into a module as if they had come from the broker.
+    `messages` can be a path for `load_messages`, or any iterable of
+    `bell.avr.mqtt.recorder.RecordedMessage`.
+
+    With a `speed` of 1, messages are replayed with their original timing.
+    Other values replay that many times faster, and `None` replays them as
+    fast as possible.
+
+    The module must have an `on_message` method, like
+    `bell.avr.mqtt.module.MQTTModule`. It is called with no client or userdata.
+    """
+    on_message = getattr(module, "on_message", None)
+    if on_message is None:
+        raise ValueError(f"{module.__class__.__name__} has no on_message method")
+
+    if isinstance(messages, (str, os.PathLike)):
+        messages = load_messages(messages)
+
+    if speed is not None and speed <= 0:
+        raise ValueError("Speed must be greater than 0")
+
+    stats = ReplayStats()
+    topics = stats.topics
+
+    start = time.perf_counter()
+    first_timestamp: Optional[float] = None
+
+    for message in messages:
+        if speed is not None:
+            if first_timestamp is None:
+                first_timestamp = message.timestamp
+
+            due = start + (message.timestamp - first_timestamp) / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            elif -wait > stats.max_lag:
+                stats.max_lag = -wait
+
+        msg = paho_mqtt.MQTTMessage(topic=message.topic.encode())
+        msg.payload = message.payload
+
+        handle_start = time.perf_counter()
+        on_message(None, None, msg)
+        handle_time = time.perf_counter() - handle_start
+
+        latency = topics.get(message.topic)
+        if latency is None:
+            latency = topics[message.topic] = TopicLatency()
+        latency.count += 1
+        latency.total += handle_time
+        if handle_time > latency.max:
+            latency.max = handle_time
+
+        stats.messages += 1
+
+    stats.elapsed = time.perf_counter() - start
+    return stats
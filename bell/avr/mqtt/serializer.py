@@ -1,83 +1,286 @@
 """
 Using these functions ensure consistent serialization and deserialization of
 MQTT payloads.
+
+Payloads are JSON by default. Messages made up only of numbers and booleans
+(see `bell.avr.mqtt.constants.MQTTPayloadStructLayout`) can also be sent in a
+compact fixed-layout binary format. Binary payloads start with a byte that can
+never start JSON text, so `deserialize_payload` accepts either format.
+
+Other binary payloads, such as raw images from
+`bell.avr.utils.images.serialize_image_raw`, start with another byte from the
+same range. These are passed through untouched in both directions.
 """
 
 import json
-from typing import Any
+import struct
+import zlib
+from typing import Any, Dict, Optional, Tuple, Type, Union
 
 import pydantic
 
-from bell.avr.mqtt.constants import MQTTTopicPayload
+from bell.avr.mqtt.constants import MQTTPayloadStructLayout, MQTTTopicPayload
 from bell.avr.mqtt.payloads import AVREmptyMessage
 
+# UTF-8 continuation bytes are never the first byte of JSON text,
+# so this range is reserved for binary payloads
+_BINARY_FRAME_FIRST_BYTES = range(0x80, 0xC0)
+# binary payloads packed with a topic's struct layout
+_BINARY_MAGIC = b"\xa5"
+# fields added to payloads since the first release, left out while they hold
+# their default so receivers on older versions, which reject unknown fields,
+# still accept the payload
+_ADDED_FIELDS = {"dtype"}
 
-def deserialize_payload(topic: str, payload: bytes) -> Any:
+
+def _is_raw_binary(payload: Any) -> bool:
     """
-    Deserializes an MQTT payload bytes into a pydantic model. If the topic is
-    not known, deserialized JSON will be returned.
+    Whether a payload is a binary payload that should be passed through as is.
+    """
+    return (
+        isinstance(payload, (bytes, bytearray))
+        and len(payload) > 0
+        and payload[0] in _BINARY_FRAME_FIRST_BYTES
+        and payload[:1] != _BINARY_MAGIC
+    )
 
-    A `ValueError` will be raised if the payload is not valid JSON.
 
-    Additionally, a `ValueError` will be raised if the given topic is known
-    and the payload does not match the required schema.
+class PayloadCodec:
     """
+    Encoder and decoder for the payloads of a single topic. The payload class
+    is resolved once when the codec is created, so encoding and decoding
+    do not need to look anything up per message.
 
-    # so json.loads doesn't choke on an empty string
-    if payload in {None, "", b""}:
-        payload = b"{}"
+    Use `get_codec` to get the codec for a topic rather than creating these
+    directly.
+    """
 
-    # we talk JSON, no exceptions
-    payload = json.loads(payload)
+    __slots__ = ("topic", "klass", "_struct", "_fields", "_header", "_added")
 
-    # load the json into a pydantic model
-    if topic in MQTTTopicPayload:
-        return MQTTTopicPayload[topic](**payload)
+    def __init__(
+        self,
+        topic: Optional[str] = None,
+        klass: Optional[Type[pydantic.BaseModel]] = None,
+    ) -> None:
+        self.topic = topic
+        """
+        The topic this codec is for, or `None` for unknown topics.
+        """
 
-    # if we have an empty dict, manually convert it
-    elif payload == {}:
-        return AVREmptyMessage()
+        self.klass = klass
+        """
+        The payload class for the topic, or `None` if the topic is not known.
+        """
 
-    # whatever the user gave us
-    return payload
+        self._struct: Optional[struct.Struct] = None
+        self._fields: Tuple[Tuple[str, int], ...] = ()
+        self._header = b""
+        # added field name: default
+        self._added: Dict[str, Any] = {}
+        if klass is not None:
+            self._added = {
+                name: field.default
+                for name, field in klass.model_fields.items()
+                if name in _ADDED_FIELDS
+            }
 
+        layout = MQTTPayloadStructLayout.get(klass) if klass is not None else None
+        if layout is not None:
+            self._struct = struct.Struct(
+                "<" + "".join(f"{count}{format_}" for _, format_, count in layout)
+            )
+            self._fields = tuple((name, count) for name, _, count in layout)
+            # second byte identifies the layout, so mismatched versions
+            # of the library fail loudly rather than decoding garbage
+            self._header = _BINARY_MAGIC + bytes(
+                (zlib.crc32(repr(layout).encode()) & 0xFF,)
+            )
 
-def serialize_payload(topic: str, payload: Any) -> str:
-    """
-    Serializes a payload into a string we can send over MQTT. If the topic is
-    not known, serialized JSON will be returned.
+    @property
+    def supports_binary(self) -> bool:
+        """
+        Whether payloads for this topic can be encoded in the binary format.
+        """
+        return self._struct is not None
 
-    A `ValueError` will be raised if the payload is a string or bytes
-    and is not valid JSON.
+    def decode(self, payload: bytes) -> Any:
+        """
+        Decodes MQTT payload bytes. See `deserialize_payload`.
+        """
+        # so json doesn't choke on an empty string
+        if payload in {None, "", b""}:
+            payload = b"{}"
 
-    Additionally, a `ValueError` will be raised if the given topic is known
-    and the payload does not match the required schema.
-    """
+        if payload[:1] == _BINARY_MAGIC:
+            return self._decode_binary(payload)
+
+        if _is_raw_binary(payload):
+            return payload
 
-    # if no payload given, use empty message
-    if payload in [None, "", b"", {}]:
-        payload = AVREmptyMessage()
+        # known topics are validated straight from the JSON in a single pass
+        if self.klass is not None:
+            return self.klass.model_validate_json(payload)
 
-    # first, convert to a dict if appropriate
-    if isinstance(payload, (str, bytes)):
+        # we talk JSON, no exceptions
         payload = json.loads(payload)
 
-    # if this is a known topic
-    if topic in MQTTTopicPayload:
-        klass = MQTTTopicPayload[topic]
+        # if we have an empty dict, manually convert it
+        if payload == {}:
+            return AVREmptyMessage()
+
+        # whatever the user gave us
+        return payload
+
+    def _decode_binary(self, payload: bytes) -> pydantic.BaseModel:
+        if self._struct is None or self.klass is None:
+            raise ValueError(f"{self.topic} does not support binary payloads")
+
+        if (
+            payload[: len(self._header)] != self._header
+            or len(payload) != len(self._header) + self._struct.size
+        ):
+            raise ValueError(f"{self.topic} binary payload does not match layout")
+
+        values = self._struct.unpack_from(payload, len(self._header))
+
+        data = {}
+        i = 0
+        for name, count in self._fields:
+            data[name] = values[i] if count == 1 else values[i : i + count]
+            i += count
+
+        return self.klass.model_validate(data)
+
+    def _encode_binary(self, model: pydantic.BaseModel) -> bytes:
+        if self._struct is None:
+            raise ValueError(f"{self.topic} does not support binary payloads")
+
+        values = []
+        for name, count in self._fields:
+            if count == 1:
+                values.append(getattr(model, name))
+            else:
+                values.extend(getattr(model, name))
+
+        try:
+            return self._header + self._struct.pack(*values)
+        except struct.error as e:
+            raise ValueError(f"{self.topic} payload cannot be packed: {e}") from e
+
+    def encode(self, payload: Any, binary: bool = False) -> Union[str, bytes]:
+        """
+        Encodes a payload into a JSON string, or bytes if `binary` is `True`.
+        See `serialize_payload`.
+        """
+        if _is_raw_binary(payload):
+            return payload
+
+        # if no payload given, use empty message
+        if payload in [None, "", b"", {}]:
+            payload = AVREmptyMessage()
+
+        klass = self.klass
+
+        # unknown topic, anything JSON serializable goes
+        if klass is None:
+            if binary:
+                raise ValueError(f"{self.topic} does not support binary payloads")
+
+            if isinstance(payload, pydantic.BaseModel):
+                return payload.model_dump_json()
+
+            if isinstance(payload, (str, bytes)):
+                payload = json.loads(payload)
+
+            return json.dumps(payload)
 
         # if payload is already a pydantic model, check to make sure it's the right
         # one
-        if isinstance(payload, pydantic.BaseModel) and not isinstance(payload, klass):
-            raise ValueError(f"{topic} payload must be of type {klass}")
+        if isinstance(payload, pydantic.BaseModel):
+            if not isinstance(payload, klass):
+                raise ValueError(f"{self.topic} payload must be of type {klass}")
+
+            model = payload
+
+        # validate JSON text directly, without parsing it into a dict first
+        elif isinstance(payload, (str, bytes)):
+            model = klass.model_validate_json(payload)
 
-        # if not, convert to a pydantic model
-        if not isinstance(payload, pydantic.BaseModel):
-            payload = MQTTTopicPayload[topic](**payload)
+        else:
+            model = klass.model_validate(payload)
 
-    # convert pydantic models to json
-    if isinstance(payload, pydantic.BaseModel):
-        return payload.model_dump_json()
+        if binary:
+            return self._encode_binary(model)
 
-    # convert any other data type to json
-    return json.dumps(payload)
+        if self._added:
+            return model.model_dump_json(
+                exclude={
+                    name
+                    for name, default in self._added.items()
+                    if getattr(model, name) == default
+                }
+            )
+
+        return model.model_dump_json()
+
+
+_UNKNOWN_TOPIC_CODEC = PayloadCodec()
+
+_TOPIC_CODECS: Dict[str, PayloadCodec] = {
+    topic: PayloadCodec(topic, klass) for topic, klass in MQTTTopicPayload.items()
+}
+
+
+def get_codec(topic: str) -> PayloadCodec:
+    """
+    Returns the `PayloadCodec` for a topic. Codecs for every topic in
+    `bell.avr.mqtt.constants.MQTTTopicPayload` are built once on import. Unknown
+    topics share a single codec which works with plain JSON.
+
+    Example:
+
+    ```python
+    from bell.avr.mqtt.serializer import get_codec
+
+    codec = get_codec("avr/fusion/position/local")
+
+    position = codec.decode(b'{"n": 1.0, "e": 2.0, "d": 3.0}')
+    raw = codec.encode(position)
+    ```
+    """
+    return _TOPIC_CODECS.get(topic, _UNKNOWN_TOPIC_CODEC)
+
+
+def deserialize_payload(topic: str, payload: bytes) -> Any:
+    """
+    Deserializes an MQTT payload bytes into a pydantic model. If the topic is
+    not known, deserialized JSON will be returned. Both JSON and binary
+    payloads are accepted. Raw binary payloads, such as images, are returned
+    as is.
+
+    A `ValueError` will be raised if the payload is not valid JSON.
+
+    Additionally, a `ValueError` will be raised if the given topic is known
+    and the payload does not match the required schema.
+    """
+    return get_codec(topic).decode(payload)
+
+
+def serialize_payload(
+    topic: str, payload: Any, binary: bool = False
+) -> Union[str, bytes]:
+    """
+    Serializes a payload into a string we can send over MQTT. If the topic is
+    not known, serialized JSON will be returned.
+
+    If `binary` is `True`, the payload is packed into the compact binary format
+    instead, and bytes are returned. A `ValueError` will be raised if the topic
+    does not have a binary layout.
+
+    A `ValueError` will be raised if the payload is a string or bytes
+    and is not valid JSON.
+
+    Additionally, a `ValueError` will be raised if the given topic is known
+    and the payload does not match the required schema.
+    """
+    return get_codec(topic).encode(payload, binary)
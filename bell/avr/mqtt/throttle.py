@@ -0,0 +1,171 @@
+"""
+Rate limiting of outgoing MQTT messages.
+See `bell.avr.mqtt.client.MQTTClient.publish_policies`.
+"""
+
+import dataclasses
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from bell.avr.mqtt.dispatcher import topic_matches
+
+
+@dataclasses.dataclass(frozen=True)
+class PublishPolicy:
+    """
+    How often messages may be published on a topic.
+    """
+
+    max_rate: float
+    """
+    Maximum number of messages per second.
+    """
+    coalesce: bool = False
+    """
+    If `False`, messages sent too soon after the previous one are dropped.
+    If `True`, the last of them is held back and sent as soon as the rate
+    allows, so the final value is never lost.
+    """
+
+    def __post_init__(self) -> None:
+        if self.max_rate <= 0:
+            raise ValueError("max_rate must be greater than 0")
+
+
+@dataclasses.dataclass
+class PublishStats:
+    """
+    Counters of outgoing messages, see `bell.avr.mqtt.client.MQTTClient.publish_stats`.
+    """
+
+    published: int = 0
+    """
+    Number of messages handed to the MQTT client.
+    """
+    suppressed: Dict[str, int] = dataclasses.field(default_factory=dict)
+    """
+    Number of messages per topic that were not published because of
+    a `PublishPolicy`.
+    """
+
+
+def _call_later(delay: float, fn: Callable[[], Any]) -> None:
+    timer = threading.Timer(delay, fn)
+    timer.daemon = True
+    timer.start()
+
+
+class _TopicState:
+    __slots__ = ("last_sent", "pending", "scheduled")
+
+    def __init__(self) -> None:
+        self.last_sent = float("-inf")
+        self.pending: Optional[Tuple[Union[str, bytes], Any]] = None
+        self.scheduled = False
+
+
+class PublishThrottle:
+    """
+    Applies `PublishPolicy`s to messages before handing them to `publish`.
+    """
+
+    def __init__(
+        self,
+        publish: Callable[[str, Union[str, bytes], bool, Any], Any],
+        stats: PublishStats,
+    ) -> None:
+        self.policies: Dict[str, PublishPolicy] = {}
+        """
+        Policies by topic or topic filter.
+        """
+
+        self.call_later: Callable[[float, Callable[[], Any]], Any] = _call_later
+        """
+        Function used to publish held back messages later. Defaults to a timer
+        thread, and can be replaced to run on an event loop instead.
+        """
+
+        self._publish = publish
+        self._stats = stats
+        self._lock = threading.Lock()
+        self._states: Dict[str, _TopicState] = {}
+
+    def policy_for(self, topic: str) -> Optional[PublishPolicy]:
+        """
+        Returns the policy for a topic. An exact topic takes precedence over
+        topic filters.
+        """
+        policy = self.policies.get(topic)
+        if policy is not None:
+            return policy
+
+        for topic_filter, policy in self.policies.items():
+            if ("+" in topic_filter or "#" in topic_filter) and topic_matches(
+                topic_filter, topic
+            ):
+                return policy
+
+        return None
+
+    def _suppress(self, topic: str) -> None:
+        suppressed = self._stats.suppressed
+        suppressed[topic] = suppressed.get(topic, 0) + 1
+
+    def publish(
+        self,
+        topic: str,
+        payload: Union[str, bytes],
+        force_write: bool = False,
+        context: Any = None,
+    ) -> Any:
+        """
+        Publish a message now if its topic's policy allows it. Returns what
+        `publish` returned, or `None` if the message was dropped or held back.
+        `context` is passed on to `publish` with the message.
+
+        Held back messages are published later from another thread, so they
+        are never published with `force_write`.
+        """
+        policy = self.policy_for(topic) if self.policies else None
+        if policy is None:
+            return self._publish(topic, payload, force_write, context)
+
+        now = time.monotonic()
+        interval = 1 / policy.max_rate
+
+        with self._lock:
+            state = self._states.get(topic)
+            if state is None:
+                state = self._states[topic] = _TopicState()
+
+            wait = state.last_sent + interval - now
+            if wait <= 0 and not state.scheduled:
+                state.last_sent = now
+            else:
+                if policy.coalesce:
+                    if state.pending is not None:
+                        self._suppress(topic)
+                    state.pending = (payload, context)
+
+                    if not state.scheduled:
+                        state.scheduled = True
+                        self.call_later(max(wait, 0), lambda: self._flush(topic))
+                else:
+                    self._suppress(topic)
+
+                return None
+
+        return self._publish(topic, payload, force_write, context)
+
+    def _flush(self, topic: str) -> None:
+        with self._lock:
+            state = self._states[topic]
+            pending = state.pending
+            state.pending = None
+            state.scheduled = False
+            state.last_sent = time.monotonic()
+
+        if pending is not None:
+            payload, context = pending
+            self._publish(topic, payload, False, context)
@@ -1,11 +1,166 @@
+"""
+Helpers for sending images over MQTT.
+
+Images can be sent in two ways. `serialize_image` produces an `ImageData`
+dictionary that goes inside a JSON payload such as
+`bell.avr.mqtt.payloads.AVRVIOImageCapture`. `serialize_image_raw` instead
+produces bytes that are sent as the entire MQTT payload, with the shape, data
+type and compression in a small fixed header followed by the pixel buffer.
+This avoids base64 and JSON entirely. `deserialize_image` accepts either.
+
+Both can be compressed with any of the registered `ImageCodec`s, optionally
+after a row-delta filter. The choice is recorded in the compressed data, so
+`deserialize_image` does not need to be told what was used.
+
+For continuous streams where consecutive frames are similar, such as thermal
+readings, `ImageStreamEncoder` and `ImageStreamDecoder` only send the
+difference from the previous frame, with periodic full keyframes.
+"""
+
 import base64
+import binascii
+import concurrent.futures
+import os
+import struct
 import zlib
-from typing import List, Protocol, TypedDict, Union
+from typing import Callable, Dict, List, Optional, Protocol, TypedDict, Union
 
 import numpy as np
 
+# first byte of raw image payloads. The MQTT serializer passes payloads starting
+# with a byte between 0x80 and 0xBF through untouched, as JSON never does.
+_RAW_IMAGE_MAGIC = b"\xa6"
+_RAW_IMAGE_VERSION = 1
+
+# magic, version, numpy dtype string, compression, number of dimensions
+_RAW_IMAGE_HEADER = struct.Struct("<cB3sBB")
+
+_COMPRESSION_NONE = 0
+# plain zlib, or a codec frame
+_COMPRESSION_ZLIB = 1
+
+# first byte of image stream payloads
+_STREAM_MAGIC = b"\xa8"
+_STREAM_VERSION = 1
+# magic, version, flags, sequence number
+_STREAM_HEADER = struct.Struct("<cBBI")
+_STREAM_FLAG_KEYFRAME = 0x01
+
+# first byte of compressed data that isn't plain zlib (which starts with 0x78)
+_CODEC_FRAME_MAGIC = b"\xa7"
+# magic, codec id, filter id, number of chunks
+_CODEC_FRAME_HEADER = struct.Struct("<cBBI")
+
+_FILTER_NONE = 0
+_FILTER_ROW_DELTA = 1
+
+# images larger than this are compressed in pieces on a thread pool.
+# zlib releases the GIL, so the pieces are compressed in parallel.
+_CHUNK_SIZE = 256 * 1024
+
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+class ImageCodec:
+    """
+    A compression method for image data. The built-in codecs are:
+
+    - `zlib`: [zlib](https://docs.python.org/3/library/zlib.html) at the given
+      level, from 1 (fastest) to 9 (smallest), defaulting to 6.
+    - `fast`: zlib with run-length encoding only. Much faster than `zlib`, and
+      works best together with the row-delta filter.
+
+    Additional codecs can be added with `register_image_codec`. The receiver
+    must have registered the same codec.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        codec_id: int,
+        compress: Callable[[memoryview, Optional[int]], bytes],
+        decompress: Callable[[memoryview], bytes],
+    ) -> None:
+        self.name = name
+        """
+        Name used to select this codec, such as `zlib`.
+        """
+        self.codec_id = codec_id
+        """
+        Number between 1 and 255 recorded in the data to identify this codec.
+        """
+        self.compress = compress
+        """
+        Function that compresses bytes, at a codec specific level or `None`
+        for the default.
+        """
+        self.decompress = decompress
+        """
+        Function that reverses `compress`.
+        """
+
+
+_CODECS_BY_NAME: Dict[str, ImageCodec] = {}
+_CODECS_BY_ID: Dict[int, ImageCodec] = {}
+
+
+def register_image_codec(codec: ImageCodec) -> None:
+    """
+    Registers a compression codec so it can be used with `serialize_image`
+    and `serialize_image_raw` by name, and recognized by `deserialize_image`.
+
+    Example:
+
+    ```python
+    import lzma
+
+    from bell.avr.utils.images import ImageCodec, register_image_codec
+
+    register_image_codec(
+        ImageCodec("lzma", 100, lambda data, level: lzma.compress(data), lzma.decompress)
+    )
+    ```
+    """
+    if not 0 < codec.codec_id < 256:
+        raise ValueError("Codec id must be between 1 and 255")
+
+    existing = _CODECS_BY_ID.get(codec.codec_id)
+    if existing is not None and existing.name != codec.name:
+        raise ValueError(f"Codec id {codec.codec_id} is used by {existing.name}")
+
+    _CODECS_BY_NAME[codec.name] = codec
+    _CODECS_BY_ID[codec.codec_id] = codec
+
+
+def _zlib_compress(data: memoryview, level: Optional[int]) -> bytes:
+    return zlib.compress(data, -1 if level is None else level)
+
+
+def _fast_compress(data: memoryview, level: Optional[int]) -> bytes:
+    compressor = zlib.compressobj(
+        1 if level is None else level, zlib.DEFLATED, zlib.MAX_WBITS, 8, zlib.Z_RLE
+    )
+    return compressor.compress(data) + compressor.flush()
+
+
+register_image_codec(ImageCodec("zlib", 1, _zlib_compress, zlib.decompress))
+register_image_codec(ImageCodec("fast", 2, _fast_compress, zlib.decompress))
+
+
+# what arrays made from Python ints hold, which were always sent as uint8
+_DEFAULT_INT = np.dtype(int).newbyteorder("<")
+
+
+class _ImageDataOptional(TypedDict, total=False):
+    dtype: str
+    """
+    The numpy data type of the image data, such as `uint16` or `float32`.
+    This is left out for `uint8`, which data without it is treated as, so
+    older receivers still accept those images.
+    """
+
 
-class ImageData(TypedDict):
+class ImageData(_ImageDataOptional):
     """
     Data structure to hold image data and metadata.
     This is a TypedDict so it can easily be used with other classes with parameter
@@ -48,62 +203,504 @@ class _ImageDataProtocol(Protocol):
     compressed: bool
 
 
-def serialize_image(image: np.ndarray, compress: bool = False) -> ImageData:
+def _image_buffer(image: np.ndarray) -> np.ndarray:
+    """
+    Returns the image as a contiguous little-endian array, which is
+    what goes over the wire. This does not copy if the image already is one.
+    """
+    image = np.asarray(image)
+
+    if image.dtype.kind not in "biuf":
+        raise ValueError(f"Unsupported image data type: {image.dtype}")
+
+    return np.ascontiguousarray(image, dtype=image.dtype.newbyteorder("<"))
+
+
+def _map(function: Callable, items: List) -> List:
+    """
+    Run a function over items, on a shared thread pool if there are several.
+    """
+    global _executor
+
+    if len(items) <= 1 or (os.cpu_count() or 1) == 1:
+        return [function(item) for item in items]
+
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            thread_name_prefix="image_codec"
+        )
+
+    return list(_executor.map(function, items))
+
+
+def _unsigned_view(image: np.ndarray) -> np.ndarray:
+    """
+    View any image as unsigned integers of the same size, so that differences
+    wrap around and can be undone exactly.
+    """
+    return image.view(f"<u{image.dtype.itemsize}")
+
+
+def _row_delta(image: np.ndarray) -> np.ndarray:
+    """
+    Replace each row with its difference from the previous row. Neighbouring
+    rows of an image are similar, so this leaves mostly small values that
+    compress much better.
+    """
+    unsigned = _unsigned_view(image)
+    delta = np.empty_like(unsigned)
+    delta[:1] = unsigned[:1]
+    np.subtract(unsigned[1:], unsigned[:-1], out=delta[1:])
+    return delta
+
+
+def _undo_row_delta(delta: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    unsigned = _unsigned_view(delta)
+    return np.cumsum(unsigned, axis=0, dtype=unsigned.dtype).view(dtype)
+
+
+def _compress(
+    image: np.ndarray, compress: Union[bool, str], level: Optional[int], row_delta: bool
+) -> bytes:
+    # plain zlib in a single stream can be read by anything, including older
+    # versions of this library
+    if compress is True and not row_delta:
+        return _zlib_compress(memoryview(image.reshape(-1).view(np.uint8)), level)
+
+    codec = _CODECS_BY_NAME.get("zlib" if compress is True else str(compress))
+    if codec is None:
+        raise ValueError(f"Unknown image codec: {compress}")
+
+    if row_delta and image.ndim > 0:
+        image = _row_delta(image)
+        filter_id = _FILTER_ROW_DELTA
+    else:
+        filter_id = _FILTER_NONE
+
+    data = memoryview(image.reshape(-1).view(np.uint8))
+    chunks = [data[i : i + _CHUNK_SIZE] for i in range(0, len(data), _CHUNK_SIZE)]
+    compressed = _map(lambda chunk: codec.compress(chunk, level), chunks)
+
+    header = _CODEC_FRAME_HEADER.pack(
+        _CODEC_FRAME_MAGIC, codec.codec_id, filter_id, len(compressed)
+    ) + struct.pack(f"<{len(compressed)}I", *(len(c) for c in compressed))
+
+    return b"".join([header, *compressed])
+
+
+def _decompress(
+    data: Union[bytes, memoryview], dtype: np.dtype, shape: List[int]
+) -> np.ndarray:
+    """
+    Decompress image data from `_compress` into a (read-only) array.
+    """
+    if data[:1] != _CODEC_FRAME_MAGIC:
+        image_bytes = zlib.decompress(data)
+        return np.frombuffer(image_bytes, dtype=dtype).reshape(shape)
+
+    try:
+        _, codec_id, filter_id, count = _CODEC_FRAME_HEADER.unpack_from(data)
+        lengths = struct.unpack_from(f"<{count}I", data, _CODEC_FRAME_HEADER.size)
+    except struct.error as e:
+        raise ValueError("Compressed image data is truncated") from e
+
+    codec = _CODECS_BY_ID.get(codec_id)
+    if codec is None:
+        raise ValueError(f"Unknown image codec: {codec_id}")
+
+    view = memoryview(data)
+    offset = _CODEC_FRAME_HEADER.size + 4 * count
+    chunks = []
+    for length in lengths:
+        chunks.append(view[offset : offset + length])
+        offset += length
+
+    decompressed = _map(codec.decompress, chunks)
+    image_bytes = decompressed[0] if len(decompressed) == 1 else b"".join(decompressed)
+    image = np.frombuffer(image_bytes, dtype=dtype).reshape(shape)
+
+    if filter_id == _FILTER_ROW_DELTA:
+        image = _undo_row_delta(image, dtype)
+        image.flags.writeable = False
+    elif filter_id != _FILTER_NONE:
+        raise ValueError(f"Unknown image filter: {filter_id}")
+
+    return image
+
+
+def serialize_image(
+    image: np.ndarray,
+    compress: Union[bool, str] = False,
+    level: Optional[int] = None,
+    row_delta: bool = False,
+) -> ImageData:
     """
     Takes a numpy array of image data, and transforms it into format that can
-    be sent over JSON. Expects a 2D or 3D numpy array. If the array does
-    not contain integers, all of the values will be rounded to the nearest
-    integer. Setting `compress` to `True` enables
-    [zlib](https://docs.python.org/3/library/zlib.html) compression.
-    """
-    # record the shape before we start making changes
-    shape = list(np.shape(image))
-
-    # round all of the items to integers
-    image_rounded = np.rint(image).astype(int)
-    # flatten the array
-    image_integer_list: List[int] = image_rounded.flatten().tolist()
-    # convert the flat integer list into a bytearray
-    image_byte_array = bytearray(image_integer_list)
-
-    # compress with zlib if desired
+    be sent over JSON. Expects a 2D or 3D numpy array. The data type of the
+    array is kept, so `uint16` or `float32` thermal data is sent
+    without any loss. Arrays of the default integer type, like those made
+    from Python ints, are sent as `uint8` if their values fit.
+
+    Setting `compress` to `True` enables
+    [zlib](https://docs.python.org/3/library/zlib.html) compression, as a
+    single plain zlib stream that anything can decompress. It can
+    also be the name of an `ImageCodec`, such as `"fast"`, and `level` sets the
+    codec's speed/size trade-off. Setting `row_delta` to `True` stores the
+    difference between rows before compressing, which usually compresses
+    camera images much better. It needs `compress` to be set, otherwise a
+    `ValueError` is raised.
+
+    With a named codec or `row_delta`, the data is framed so
+    `deserialize_image` knows how to undo it, and large images are
+    compressed in pieces in parallel.
+
+    Example:
+
+    ```python
+    serialize_image(frame, compress="fast", row_delta=True)
+    ```
+    """
+    if row_delta and not compress:
+        raise ValueError("row_delta needs compress to be set")
+
+    buffer = _image_buffer(image)
+    if (
+        buffer.dtype == _DEFAULT_INT
+        and buffer.size
+        and buffer.min() >= 0
+        and buffer.max() <= 255
+    ):
+        buffer = buffer.astype(np.uint8)
+
+    # work directly on the array memory, rather than converting each value
     if compress:
-        image_byte_array = zlib.compress(image_byte_array)
+        image_bytes = _compress(buffer, compress, level, row_delta)
+    else:
+        image_bytes = buffer.data
 
     # convert to base64 and convert to a string
-    base64_image_data = base64.b64encode(image_byte_array).decode("utf-8")
+    base64_image_data = base64.b64encode(image_bytes).decode("ascii")
 
     # build class
-    image_data = ImageData(data=base64_image_data, shape=shape, compressed=compress)
+    image_data = ImageData(
+        data=base64_image_data,
+        shape=list(buffer.shape),
+        compressed=bool(compress),
+    )
+    if buffer.dtype != np.uint8:
+        image_data["dtype"] = buffer.dtype.name
 
     return image_data
 
 
-def deserialize_image(image_data: Union[ImageData, _ImageDataProtocol]) -> np.ndarray:
+def serialize_image_raw(
+    image: np.ndarray,
+    compress: Union[bool, str] = False,
+    level: Optional[int] = None,
+    row_delta: bool = False,
+) -> bytes:
+    """
+    Takes a numpy array of image data, and packs it into bytes that can be sent
+    directly as an MQTT payload, without any JSON. The data type of the array
+    is kept. The compression options are the same as `serialize_image`.
+
+    Callbacks for the topic receive the raw bytes, which can be turned back
+    into an array with `deserialize_image`.
+
+    Example:
+
+    ```python
+    from bell.avr.utils.images import serialize_image_raw
+
+    self.send_message("avr/thermal/reading", serialize_image_raw(frame))
+    ```
+    """
+    if row_delta and not compress:
+        raise ValueError("row_delta needs compress to be set")
+
+    image = _image_buffer(image)
+
+    dtype = image.dtype.str.encode()
+    if len(dtype) != 3:
+        raise ValueError(f"Unsupported image data type: {image.dtype}")
+
+    header = _RAW_IMAGE_HEADER.pack(
+        _RAW_IMAGE_MAGIC,
+        _RAW_IMAGE_VERSION,
+        dtype,
+        _COMPRESSION_ZLIB if compress else _COMPRESSION_NONE,
+        image.ndim,
+    ) + struct.pack(f"<{image.ndim}I", *image.shape)
+
+    # avoid an intermediate copy of the pixel buffer
+    body = _compress(image, compress, level, row_delta) if compress else image.data
+
+    return b"".join((header, body))
+
+
+def _deserialize_image_raw(buffer: Union[bytes, bytearray, memoryview]) -> np.ndarray:
+    try:
+        magic, version, dtype, compression, ndim = _RAW_IMAGE_HEADER.unpack_from(buffer)
+        shape = struct.unpack_from(f"<{ndim}I", buffer, _RAW_IMAGE_HEADER.size)
+    except struct.error as e:
+        raise ValueError("Raw image payload is truncated") from e
+
+    if magic != _RAW_IMAGE_MAGIC or version != _RAW_IMAGE_VERSION:
+        raise ValueError("Not a raw image payload")
+
+    offset = _RAW_IMAGE_HEADER.size + 4 * ndim
+    dtype = np.dtype(dtype.decode())
+
+    if compression == _COMPRESSION_ZLIB:
+        return _decompress(memoryview(buffer)[offset:], dtype, list(shape))
+    elif compression != _COMPRESSION_NONE:
+        raise ValueError(f"Unknown image compression: {compression}")
+
+    # a view over the buffer, not a copy
+    image = np.frombuffer(buffer, dtype=dtype, offset=offset)
+    return image.reshape(shape)
+
+
+def _copy_to_output(image: np.ndarray, out: Optional[np.ndarray]) -> np.ndarray:
+    if out is None:
+        return image
+
+    if out.shape != image.shape or out.dtype.name != image.dtype.name:
+        raise ValueError(
+            f"Output array must have shape {image.shape} and type {image.dtype.name},"
+            f" not {out.shape} and {out.dtype.name}"
+        )
+
+    np.copyto(out, image, casting="equiv")
+    return out
+
+
+def deserialize_image(
+    image_data: Union[ImageData, _ImageDataProtocol, bytes, bytearray, memoryview],
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
     """
     Given an `ImageData` object, will reconstruct the original numpy array.
     Additionally, an object that has `.data`, `.compressed` and `.shape`
-    attributes is allowed.
+    attributes is allowed, as are raw payloads from `serialize_image_raw`.
+
+    The returned array is a read-only view of the decoded data, so no extra
+    copies are made. Use `.copy()` if you need to modify it.
+
+    Alternatively, pass a preallocated array with the same shape and data
+    type as `out`, and the image will be written into it and `out` returned.
+    This lets a receiver reuse one buffer for a whole stream of images.
+
+    Example:
+
+    ```python
+    from bell.avr.utils.images import deserialize_image
+
+    self.frame = np.empty((800, 848), dtype=np.uint8)
+
+    def on_image(self, payload: AVRVIOImageCapture) -> None:
+        deserialize_image(payload, out=self.frame)
+    ```
     """
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return _copy_to_output(_deserialize_image_raw(image_data), out)
+
     if isinstance(image_data, dict):
         data = image_data["data"]
         compressed = image_data["compressed"]
         shape = image_data["shape"]
+        dtype = image_data.get("dtype", "uint8")
     else:
         data = image_data.data
         compressed = image_data.compressed
         shape = image_data.shape
+        dtype = getattr(image_data, "dtype", "uint8")
+
+    # undo the base64. This reads an ASCII string in place, without
+    # first encoding it to bytes
+    image_bytes = binascii.a2b_base64(data)
 
-    # convert the string to bytes, and then undo the base64
-    image_bytes = base64.b64decode(data.encode("utf-8"))
+    image_dtype = np.dtype(dtype).newbyteorder("<")
 
-    # decompress with zlib
     if compressed:
-        image_bytes = zlib.decompress(image_bytes)
+        image_array = _decompress(image_bytes, image_dtype, shape)
+    else:
+        # view the bytes as a numpy array of the original type, without copying
+        image_array = np.frombuffer(image_bytes, dtype=image_dtype).reshape(shape)
+
+    return _copy_to_output(image_array, out)
+
+
+class ImageStreamEncoder:
+    """
+    Encodes a continuous stream of images into raw MQTT payloads. Every
+    `keyframe_interval` frames a full image is sent. In between, only the
+    XOR of each frame with the previous one is sent, which is mostly zeros and
+    compresses very well when frames change little.
+
+    Every payload has a sequence number, so an `ImageStreamDecoder` can tell
+    when one was lost and wait for the next keyframe rather than showing a
+    corrupted image.
+
+    The compression options are the same as `serialize_image`.
+
+    Example:
+
+    ```python
+    from bell.avr.utils.images import ImageStreamEncoder
+
+    self.thermal_encoder = ImageStreamEncoder(keyframe_interval=20)
+
+    def publish_reading(self, reading: np.ndarray) -> None:
+        self.send_message("avr/thermal/reading", self.thermal_encoder.encode(reading))
+    ```
+    """
+
+    def __init__(
+        self,
+        keyframe_interval: int = 30,
+        compress: Union[bool, str] = "fast",
+        level: Optional[int] = None,
+        row_delta: bool = False,
+    ) -> None:
+        if keyframe_interval < 1:
+            raise ValueError("Keyframe interval must be at least 1")
+        if row_delta and not compress:
+            raise ValueError("row_delta needs compress to be set")
+
+        self.keyframe_interval = keyframe_interval
+        self.compress = compress
+        self.level = level
+        self.row_delta = row_delta
+
+        self._previous: Optional[np.ndarray] = None
+        self._sequence = 0
+        self._since_keyframe = 0
+        self._force_keyframe = False
+
+    def request_keyframe(self) -> None:
+        """
+        Make the next frame a keyframe, for example when a new receiver joins.
+        """
+        self._force_keyframe = True
+
+    def encode(self, image: np.ndarray) -> bytes:
+        """
+        Encode the next image of the stream into a raw MQTT payload.
+        """
+        buffer = _image_buffer(image)
+        previous = self._previous
+
+        keyframe = (
+            previous is None
+            or self._force_keyframe
+            or self._since_keyframe >= self.keyframe_interval - 1
+            or previous.shape != buffer.shape
+            or previous.dtype != buffer.dtype
+        )
+
+        if keyframe:
+            body = buffer
+            self._since_keyframe = 0
+            self._force_keyframe = False
+        else:
+            body = np.bitwise_xor(_unsigned_view(buffer), _unsigned_view(previous))
+            body = body.view(buffer.dtype)
+            self._since_keyframe += 1
+
+        header = _STREAM_HEADER.pack(
+            _STREAM_MAGIC,
+            _STREAM_VERSION,
+            _STREAM_FLAG_KEYFRAME if keyframe else 0,
+            self._sequence,
+        )
+        payload = header + serialize_image_raw(
+            body, self.compress, self.level, self.row_delta
+        )
+
+        # keep our own copy, the caller may reuse their array
+        self._previous = buffer.copy()
+        self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+
+        return payload
+
+
+class ImageStreamDecoder:
+    """
+    Decodes payloads from an `ImageStreamEncoder` back into images.
+
+    Example:
+
+    ```python
+    from bell.avr.utils.images import ImageStreamDecoder
+
+    self.thermal_decoder = ImageStreamDecoder()
+
+    def handle_thermal(self, payload: bytes) -> None:
+        reading = self.thermal_decoder.decode(payload)
+        if reading is None:
+            # waiting for a keyframe
+            return
+        ...
+    ```
+    """
+
+    def __init__(self) -> None:
+        self._frame: Optional[np.ndarray] = None
+        self._sequence: Optional[int] = None
+
+        self.frames_decoded = 0
+        """
+        Number of frames successfully decoded.
+        """
+        self.frames_dropped = 0
+        """
+        Number of frames that could not be decoded because an earlier frame
+        was missing. Decoding resumes at the next keyframe.
+        """
+
+    def decode(
+        self, payload: Union[bytes, bytearray, memoryview]
+    ) -> Optional[np.ndarray]:
+        """
+        Decode the next payload of the stream. Returns the current image as a
+        read-only array, or `None` if the stream is waiting for a keyframe.
+        The returned array is updated in place by later calls, so copy it
+        if it needs to be kept.
+        """
+        try:
+            magic, version, flags, sequence = _STREAM_HEADER.unpack_from(payload)
+        except struct.error as e:
+            raise ValueError("Image stream payload is truncated") from e
+
+        if magic != _STREAM_MAGIC or version != _STREAM_VERSION:
+            raise ValueError("Not an image stream payload")
+
+        body = deserialize_image(memoryview(payload)[_STREAM_HEADER.size :])
+
+        if flags & _STREAM_FLAG_KEYFRAME:
+            self._frame = np.array(body)
+
+        elif (
+            self._frame is None
+            or self._sequence is None
+            or (sequence - self._sequence) & 0xFFFFFFFF != 1
+            or self._frame.shape != body.shape
+            or self._frame.dtype != body.dtype
+        ):
+            # a frame was lost, the next keyframe will resync us.
+            # forget the old sequence so we don't pick up again mid-stream
+            self.frames_dropped += 1
+            self._sequence = None
+            return None
+
+        else:
+            frame = _unsigned_view(self._frame)
+            np.bitwise_xor(frame, _unsigned_view(body), out=frame)
 
-    # convert bytes to a byte array
-    image_byte_array = bytearray(image_bytes)
-    # convert the byte array back into a numpy array
-    image_array = np.array(image_byte_array)
+        self._sequence = sequence
+        self.frames_decoded += 1
 
-    return np.reshape(image_array, shape)
+        view = self._frame.view()
+        view.flags.writeable = False
+        return view
@@ -25,6 +25,9 @@ def rate_limit(
     within a file, so multiple calls to `rate_limit` say within a loop
     with the same callable and period will be treated separately. This allows
     for dynamic frequency manipulation.
+
+    To limit how often MQTT messages are sent, use
+    `bell.avr.mqtt.client.MQTTClient.publish_policies` instead.
     """
     if frequency is not None:
         period = 1 / frequency
@@ -0,0 +1,766 @@
+"""
+A small MQTT broker that runs in a background thread, for testing and
+benchmarking modules end to end on one machine without Mosquitto.
+
+It supports MQTT 3.1.1 and 5, QoS 0 and 1, the `+` and `#` wildcards, and
+retained messages. With MQTT 5, clients can publish with topic aliases, and
+message expiry applies to retained messages. QoS 2 messages are accepted,
+but delivered at QoS 1. Sessions are not persisted, messages are not
+retried, and wills, authentication and other MQTT 5 properties are ignored,
+so this is not a replacement for the broker on the drone. It lives with
+the benchmarks rather than in `bell.avr.mqtt`, so it isn't published.
+
+Example:
+
+```python
+from benchmarks.broker import LoopbackBroker
+
+with LoopbackBroker() as broker:
+    sandbox = Sandbox()
+    sandbox.run_non_blocking(broker.host, broker.port)
+    broker.wait_for_subscribers("avr/fcm/battery")
+    ...
+```
+
+It can also be run on its own for modules in other processes:
+
+```bash
+python -m benchmarks.broker --port 18830
+```
+"""
+
+import argparse
+import dataclasses
+import math
+import selectors
+import socket
+import struct
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from bell.avr.mqtt.dispatcher import topic_matches
+from bell.avr.utils.env import get_env_int
+
+_CONNECT = 1
+_PUBLISH = 3
+_PUBACK = 4
+_PUBREC = 5
+_PUBREL = 6
+_PUBCOMP = 7
+_SUBSCRIBE = 8
+_UNSUBSCRIBE = 10
+_PINGREQ = 12
+_DISCONNECT = 14
+
+_UINT16 = struct.Struct("!H")
+_UINT32 = struct.Struct("!I")
+
+# MQTT 3.1, 3.1.1 and 5
+_PROTOCOL_LEVELS = {3, 4, 5}
+_MQTT_V5 = 5
+
+# MQTT 5 properties this broker uses
+_MESSAGE_EXPIRY_INTERVAL = 0x02
+_TOPIC_ALIAS_MAXIMUM = 0x22
+_TOPIC_ALIAS = 0x23
+
+# sizes of the other MQTT 5 properties, so they can be skipped.
+# 0 is a variable byte integer, and -1 is a length prefixed string or binary
+_PROPERTY_SIZES = {
+    **dict.fromkeys((0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A), 1),
+    **dict.fromkeys((0x13, 0x21, 0x22, 0x23), 2),
+    **dict.fromkeys((0x02, 0x11, 0x18, 0x27), 4),
+    0x0B: 0,
+    **dict.fromkeys((0x03, 0x08, 0x09, 0x12, 0x15, 0x16, 0x1A, 0x1C, 0x1F), -1),
+}
+# user properties are a pair of strings
+_USER_PROPERTY = 0x26
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(header: int, body: bytes) -> bytes:
+    return bytes((header,)) + _encode_length(len(body)) + body
+
+
+def _read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value = 0
+    multiplier = 1
+    while True:
+        byte = data[offset]
+        offset += 1
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, offset
+        multiplier *= 128
+        if multiplier > 128**3:
+            raise ValueError("Malformed variable byte integer")
+
+
+def _read_properties(
+    data: bytes, offset: int, user_properties: Optional[bytearray] = None
+) -> Tuple[Dict[int, int], int]:
+    """
+    Read MQTT 5 properties, returning the numeric ones and where they end.
+    User properties are added to `user_properties` as they were encoded.
+    """
+    length, offset = _read_varint(data, offset)
+    end = offset + length
+    properties = {}
+
+    while offset < end:
+        identifier = data[offset]
+        offset += 1
+
+        if identifier == _USER_PROPERTY:
+            start = offset - 1
+            _, offset = _read_string(data, offset)
+            _, offset = _read_string(data, offset)
+            if user_properties is not None:
+                user_properties += data[start:offset]
+            continue
+
+        size = _PROPERTY_SIZES.get(identifier)
+        if size is None:
+            raise ValueError(f"Unknown property {identifier:#x}")
+        elif size == 0:
+            properties[identifier], offset = _read_varint(data, offset)
+        elif size == -1:
+            (length,) = _UINT16.unpack_from(data, offset)
+            offset += 2 + length
+        else:
+            properties[identifier] = int.from_bytes(data[offset : offset + size], "big")
+            offset += size
+
+    if offset != end:
+        raise ValueError("Malformed properties")
+
+    return properties, end
+
+
+def _read_string(data: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = _UINT16.unpack_from(data, offset)
+    start = offset + 2
+    return data[start : start + length].decode(), start + length
+
+
+def _split_packet(data: bytearray, offset: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns where the body of the packet at `offset` starts and ends,
+    or `None` if the packet has not been fully received yet.
+    """
+    length = 0
+    multiplier = 1
+    position = offset + 1
+
+    while True:
+        if position >= len(data):
+            return None
+        byte = data[position]
+        position += 1
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+        if multiplier > 128**3:
+            raise ValueError("Malformed remaining length")
+
+    if position + length > len(data):
+        return None
+
+    return position, position + length
+
+
+@dataclasses.dataclass
+class BrokerStats:
+    """
+    Counters of messages through a `LoopbackBroker`.
+    """
+
+    received: int = 0
+    """
+    Number of messages published to the broker.
+    """
+    delivered: int = 0
+    """
+    Number of messages sent to subscribers, including retained messages.
+    """
+
+
+class _Session:
+    __slots__ = (
+        "sock",
+        "inbuf",
+        "outbuf",
+        "events",
+        "client_id",
+        "level",
+        "aliases",
+        "connected",
+        "closed",
+        "subscriptions",
+        "matches",
+        "last_packet_id",
+    )
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.events = selectors.EVENT_READ
+        self.client_id = ""
+        # MQTT protocol level, 5 for MQTT 5
+        self.level = 0
+        # topic alias: topic, for messages from the client
+        self.aliases: Dict[int, str] = {}
+        self.connected = False
+        self.closed = False
+        # topic filter: granted QoS
+        self.subscriptions: Dict[str, int] = {}
+        # topic: highest QoS of the matching subscriptions, or -1 for none
+        self.matches: Dict[str, int] = {}
+        self.last_packet_id = 0
+
+    def match(self, topic: str) -> int:
+        qos = self.matches.get(topic)
+        if qos is None:
+            qos = max(
+                (
+                    granted
+                    for topic_filter, granted in self.subscriptions.items()
+                    if topic_matches(topic_filter, topic)
+                ),
+                default=-1,
+            )
+            self.matches[topic] = qos
+        return qos
+
+    def next_packet_id(self) -> int:
+        self.last_packet_id = self.last_packet_id % 0xFFFF + 1
+        return self.last_packet_id
+
+
+class LoopbackBroker:
+    """
+    MQTT broker listening on `host` and `port`. A `port` of 0 picks a free
+    port, which is available from `port` once started. All connections are
+    handled by a single thread.
+
+    Use as a context manager, or call `start` and `stop`.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host = host
+        """
+        Address the broker listens on.
+        """
+        self.port = port
+        """
+        Port the broker listens on.
+        """
+        self.stats = BrokerStats()
+        """
+        Counts of messages received and delivered.
+        """
+        self.topic_alias_maximum = 16
+        """
+        How many topic aliases each MQTT 5 client may use.
+        """
+
+        self._selector = selectors.DefaultSelector()
+        self._server: Optional[socket.socket] = None
+        self._wakeup: Optional[Tuple[socket.socket, socket.socket]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+        self._sessions: Dict[socket.socket, _Session] = {}
+        # topic: (payload, QoS, when it expires by `time.monotonic` or None)
+        self._retained: Dict[str, Tuple[bytes, int, Optional[float], bytes]] = {}
+        # sessions with data waiting to be written
+        self._pending: Set[_Session] = set()
+        # held while sessions or subscriptions change, so other threads can
+        # wait for subscribers
+        self._changed = threading.Condition()
+
+    def __enter__(self) -> "LoopbackBroker":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def _bind(self) -> None:
+        if self._server is not None:
+            return
+
+        server = socket.create_server((self.host, self.port))
+        server.setblocking(False)
+        self.port = server.getsockname()[1]
+        self._server = server
+        self._selector.register(server, selectors.EVENT_READ)
+
+        self._wakeup = socket.socketpair()
+        self._wakeup[0].setblocking(False)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+
+    def start(self) -> "LoopbackBroker":
+        """
+        Start listening, and handle connections in a background thread.
+        """
+        self._bind()
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._serve, name=self.__class__.__name__, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        """
+        Start listening if not already, and handle connections on the current
+        thread until `stop` is called.
+        """
+        self._bind()
+        self._running = True
+        self._serve()
+
+    def _serve(self) -> None:
+        while self._running:
+            for key, events in self._selector.select():
+                if key.fileobj is self._server:
+                    self._accept()
+                elif self._wakeup is not None and key.fileobj is self._wakeup[0]:
+                    self._wakeup[0].recv(4096)
+                else:
+                    session: _Session = key.data
+                    if events & selectors.EVENT_READ:
+                        self._read(session)
+                    if events & selectors.EVENT_WRITE and not session.closed:
+                        self._pending.add(session)
+
+            # write everything queued while handling this batch of events
+            for session in list(self._pending):
+                self._flush(session)
+
+        self._close_all()
+
+    def stop(self) -> None:
+        """
+        Disconnect all clients and stop listening.
+        """
+        if self._thread is None:
+            return
+
+        self._running = False
+        if self._wakeup is not None:
+            self._wakeup[1].send(b"\x00")
+        self._thread.join()
+        self._thread = None
+
+    def wait_for_subscribers(
+        self, topic: str, count: int = 1, timeout: float = 5.0
+    ) -> bool:
+        """
+        Wait until at least `count` clients are subscribed to a topic, and
+        return whether they are. Useful in tests to avoid publishing before
+        a module has finished subscribing.
+        """
+
+        def subscribed() -> bool:
+            return (
+                sum(
+                    any(topic_matches(f, topic) for f in session.subscriptions)
+                    for session in self._sessions.values()
+                )
+                >= count
+            )
+
+        with self._changed:
+            return self._changed.wait_for(subscribed, timeout)
+
+    def _close_all(self) -> None:
+        for session in list(self._sessions.values()):
+            self._close(session)
+
+        if self._server is not None:
+            self._selector.unregister(self._server)
+            self._server.close()
+
+        if self._wakeup is not None:
+            self._selector.unregister(self._wakeup[0])
+            self._wakeup[0].close()
+            self._wakeup[1].close()
+
+        self._server = None
+        self._wakeup = None
+
+    def _accept(self) -> None:
+        assert self._server is not None
+        try:
+            sock, _ = self._server.accept()
+        except BlockingIOError:
+            return
+
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        session = _Session(sock)
+        with self._changed:
+            self._sessions[sock] = session
+        self._selector.register(sock, selectors.EVENT_READ, session)
+
+    def _close(self, session: _Session) -> None:
+        if session.closed:
+            return
+
+        session.closed = True
+        self._pending.discard(session)
+        self._selector.unregister(session.sock)
+        session.sock.close()
+
+        with self._changed:
+            del self._sessions[session.sock]
+            self._changed.notify_all()
+
+    def _read(self, session: _Session) -> None:
+        try:
+            data = session.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self._close(session)
+            return
+
+        buffer = session.inbuf
+        buffer += data
+        offset = 0
+
+        try:
+            while len(buffer) - offset >= 2:
+                span = _split_packet(buffer, offset)
+                if span is None:
+                    break
+
+                header = buffer[offset]
+                body = bytes(buffer[span[0] : span[1]])
+                offset = span[1]
+
+                self._handle(session, header, body)
+                if session.closed:
+                    return
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError) as e:
+            logger.warning(f"Closing {session.client_id or 'client'}: {e}")
+            self._close(session)
+            return
+
+        del buffer[:offset]
+
+    def _send(self, session: _Session, data: bytes) -> None:
+        session.outbuf += data
+        self._pending.add(session)
+
+    def _flush(self, session: _Session) -> None:
+        self._pending.discard(session)
+        if session.closed:
+            return
+
+        if session.outbuf:
+            try:
+                sent = session.sock.send(session.outbuf)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self._close(session)
+                return
+            del session.outbuf[:sent]
+
+        # wait for the socket to be writable again if it couldn't take it all
+        events = selectors.EVENT_READ
+        if session.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events != session.events:
+            self._selector.modify(session.sock, events, session)
+            session.events = events
+
+    def _handle(self, session: _Session, header: int, body: bytes) -> None:
+        packet_type = header >> 4
+
+        if not session.connected:
+            if packet_type != _CONNECT:
+                raise ValueError("Expected CONNECT")
+            self._on_connect(session, body)
+
+        elif packet_type == _PUBLISH:
+            self._on_publish(session, header, body)
+
+        elif packet_type == _PUBREL:
+            self._send(session, _packet(_PUBCOMP << 4, body[:2]))
+
+        elif packet_type == _SUBSCRIBE:
+            self._on_subscribe(session, body)
+
+        elif packet_type == _UNSUBSCRIBE:
+            self._on_unsubscribe(session, body)
+
+        elif packet_type == _PINGREQ:
+            self._send(session, b"\xd0\x00")
+
+        elif packet_type == _DISCONNECT:
+            self._close(session)
+
+        elif packet_type in (_PUBACK, _PUBREC, _PUBCOMP):
+            # messages are delivered at most at QoS 1, and never retried
+            pass
+
+        else:
+            raise ValueError(f"Unexpected packet type {packet_type}")
+
+    def _on_connect(self, session: _Session, body: bytes) -> None:
+        _, offset = _read_string(body, 0)
+        level = body[offset]
+        if level not in _PROTOCOL_LEVELS:
+            # unacceptable protocol version
+            self._send(session, b"\x20\x02\x00\x01")
+            self._flush(session)
+            self._close(session)
+            return
+
+        # skip the flags and keepalive
+        offset += 4
+        if level == _MQTT_V5:
+            _, offset = _read_properties(body, offset)
+
+        client_id, _ = _read_string(body, offset)
+        if not client_id:
+            client_id = f"loopback_{uuid.uuid4()}"
+
+        # a new connection with the same client ID replaces the old one
+        for other in list(self._sessions.values()):
+            if other.client_id == client_id:
+                self._close(other)
+
+        session.client_id = client_id
+        session.level = level
+        session.connected = True
+
+        if level == _MQTT_V5:
+            properties = bytes((_TOPIC_ALIAS_MAXIMUM,)) + _UINT16.pack(
+                self.topic_alias_maximum
+            )
+            self._send(
+                session,
+                _packet(
+                    0x20, b"\x00\x00" + _encode_length(len(properties)) + properties
+                ),
+            )
+        else:
+            self._send(session, b"\x20\x02\x00\x00")
+
+    def _on_publish(self, session: _Session, header: int, body: bytes) -> None:
+        qos = (header >> 1) & 0x03
+        retain = header & 0x01
+
+        topic, offset = _read_string(body, 0)
+        if qos:
+            packet_id = body[offset : offset + 2]
+            offset += 2
+            self._send(
+                session, _packet((_PUBACK if qos == 1 else _PUBREC) << 4, packet_id)
+            )
+
+        expires_at = None
+        # passed on to subscribers untouched
+        user_properties = bytearray()
+        if session.level == _MQTT_V5:
+            properties, offset = _read_properties(body, offset, user_properties)
+            topic = self._resolve_alias(session, topic, properties.get(_TOPIC_ALIAS))
+
+            expiry = properties.get(_MESSAGE_EXPIRY_INTERVAL)
+            if expiry is not None:
+                expires_at = time.monotonic() + expiry
+
+        if not topic:
+            raise ValueError("Empty topic")
+
+        payload = body[offset:]
+        qos = min(qos, 1)
+        self.stats.received += 1
+
+        if retain:
+            if payload:
+                self._retained[topic] = (
+                    payload,
+                    qos,
+                    expires_at,
+                    bytes(user_properties),
+                )
+            else:
+                self._retained.pop(topic, None)
+
+        for other in self._sessions.values():
+            if not other.connected:
+                continue
+
+            granted = other.match(topic)
+            if granted >= 0:
+                self._deliver(
+                    other,
+                    topic,
+                    payload,
+                    min(qos, granted),
+                    False,
+                    expires_at,
+                    user_properties,
+                )
+
+    def _resolve_alias(
+        self, session: _Session, topic: str, alias: Optional[int]
+    ) -> str:
+        if alias is None:
+            return topic
+
+        if not 0 < alias <= self.topic_alias_maximum:
+            raise ValueError(f"Topic alias {alias} out of range")
+
+        if topic:
+            session.aliases[alias] = topic
+            return topic
+
+        if alias not in session.aliases:
+            raise ValueError(f"Unknown topic alias {alias}")
+        return session.aliases[alias]
+
+    def _deliver(
+        self,
+        session: _Session,
+        topic: str,
+        payload: bytes,
+        qos: int,
+        retain: bool,
+        expires_at: Optional[float] = None,
+        user_properties: bytes = b"",
+    ) -> None:
+        topic_bytes = topic.encode()
+        body = _UINT16.pack(len(topic_bytes)) + topic_bytes
+        if qos:
+            body += _UINT16.pack(session.next_packet_id())
+
+        if session.level == _MQTT_V5:
+            properties = bytes(user_properties)
+            if expires_at is not None:
+                # the time left
+                expiry = max(math.ceil(expires_at - time.monotonic()), 1)
+                properties += bytes((_MESSAGE_EXPIRY_INTERVAL,)) + _UINT32.pack(expiry)
+            body += _encode_length(len(properties)) + properties
+
+        header = _PUBLISH << 4 | qos << 1 | retain
+        self._send(session, _packet(header, body + payload))
+        self.stats.delivered += 1
+
+    def _on_subscribe(self, session: _Session, body: bytes) -> None:
+        packet_id = body[:2]
+        offset = 2
+        if session.level == _MQTT_V5:
+            _, offset = _read_properties(body, offset)
+
+        topic_filters: List[Tuple[str, int]] = []
+        while offset < len(body):
+            topic_filter, offset = _read_string(body, offset)
+            topic_filters.append((topic_filter, min(body[offset] & 0x03, 1)))
+            offset += 1
+
+        with self._changed:
+            session.subscriptions.update(topic_filters)
+            session.matches.clear()
+            self._changed.notify_all()
+
+        properties = b"\x00" if session.level == _MQTT_V5 else b""
+        self._send(
+            session,
+            _packet(
+                0x90, packet_id + properties + bytes(qos for _, qos in topic_filters)
+            ),
+        )
+
+        now = time.monotonic()
+        for topic, (_, _, expires_at, _) in list(self._retained.items()):
+            if expires_at is not None and expires_at <= now:
+                del self._retained[topic]
+
+        for topic_filter, granted in topic_filters:
+            for topic, retained in self._retained.items():
+                payload, qos, expires_at, user_properties = retained
+                if topic_matches(topic_filter, topic):
+                    self._deliver(
+                        session,
+                        topic,
+                        payload,
+                        min(qos, granted),
+                        True,
+                        expires_at,
+                        user_properties,
+                    )
+
+    def _on_unsubscribe(self, session: _Session, body: bytes) -> None:
+        packet_id = body[:2]
+        offset = 2
+        if session.level == _MQTT_V5:
+            _, offset = _read_properties(body, offset)
+
+        count = 0
+        with self._changed:
+            while offset < len(body):
+                topic_filter, offset = _read_string(body, offset)
+                session.subscriptions.pop(topic_filter, None)
+                count += 1
+            session.matches.clear()
+            self._changed.notify_all()
+
+        if session.level == _MQTT_V5:
+            # no properties, and a success reason code for each topic filter
+            self._send(session, _packet(0xB0, packet_id + bytes(count + 1)))
+        else:
+            self._send(session, _packet(0xB0, packet_id))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a loopback MQTT broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=get_env_int("MQTT_PORT", 18830))
+    args = parser.parse_args()
+
+    broker = LoopbackBroker(args.host, args.port)
+    broker._bind()
+    logger.success(f"Listening on {broker.host}:{broker.port}")
+
+    start = time.perf_counter()
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Received {broker.stats.received} and delivered {broker.stats.delivered}"
+        f" messages in {elapsed:.1f} seconds"
+    )
+
+
+if __name__ == "__main__":
+    main()
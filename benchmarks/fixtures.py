@@ -0,0 +1,139 @@
+"""
+Representative payloads for every topic in
+`bell.avr.mqtt.constants.MQTTTopicPayload`.
+
+Most payloads are generated from the JSON schema of the payload class.
+Topics whose size in practice depends on their content, such as images and
+missions, are filled in by hand with realistic sizes.
+"""
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pydantic
+
+from bell.avr.mqtt.constants import MQTTTopicPayload
+from bell.avr.utils.images import serialize_image
+
+# array length used when the schema doesn't fix one
+_ARRAY_LENGTH = 4
+# topics with longer arrays in practice
+_ARRAY_LENGTHS = {
+    "avr/fcm/action/mission/upload": 20,
+    "avr/apriltags/raw": 3,
+    "avr/apriltags/visible": 3,
+}
+
+
+def _resolve(schema: dict, definitions: dict) -> dict:
+    while "$ref" in schema:
+        schema = definitions[schema["$ref"].split("/")[-1]]
+    return schema
+
+
+def example_value(
+    schema: dict, definitions: dict, array_length: int = _ARRAY_LENGTH
+) -> Any:
+    """
+    Build a value that is valid for a JSON schema, preferring defaults and
+    values in the middle of any allowed range.
+    """
+    schema = _resolve(schema, definitions)
+
+    if "default" in schema:
+        return schema["default"]
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return schema["enum"][0]
+
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            options = [
+                option
+                for option in schema[key]
+                if _resolve(option, definitions).get("type") != "null"
+            ]
+            return example_value(options[0], definitions, array_length)
+
+    type_ = schema.get("type")
+
+    if type_ == "object":
+        return {
+            name: example_value(property_, definitions, array_length)
+            for name, property_ in schema.get("properties", {}).items()
+        }
+
+    if type_ == "array":
+        if "prefixItems" in schema:
+            return [
+                example_value(item, definitions, array_length)
+                for item in schema["prefixItems"]
+            ]
+
+        length = max(schema.get("minItems", array_length), 1)
+        length = min(length, schema.get("maxItems", length))
+        return [
+            example_value(schema["items"], definitions, array_length)
+            for _ in range(length)
+        ]
+
+    if type_ in ("integer", "number"):
+        minimum: Optional[float] = schema.get("minimum", schema.get("exclusiveMinimum"))
+        maximum: Optional[float] = schema.get("maximum", schema.get("exclusiveMaximum"))
+
+        if minimum is not None and maximum is not None:
+            value = (minimum + maximum) / 2
+        elif minimum is not None:
+            value = minimum + 1
+        elif maximum is not None:
+            value = maximum - 1
+        else:
+            # enough digits to be representative of real sensor data
+            value = 12.345678901234
+
+        return int(value) if type_ == "integer" else float(value)
+
+    if type_ == "boolean":
+        return True
+
+    if type_ == "string":
+        return "example"
+
+    return None
+
+
+def _image(shape: tuple, dtype: str) -> dict:
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, shape).astype(dtype)
+    return dict(serialize_image(image, compress=True))
+
+
+def _overrides() -> Dict[str, dict]:
+    return {
+        # AMG8833 thermal camera
+        "avr/thermal/reading": _image((8, 8), "float32"),
+        # Intel RealSense T265 fisheye, per side
+        "avr/vio/image/capture": {"side": "left", **_image((800, 848), "uint8")},
+    }
+
+
+def payload_fixtures() -> Dict[str, pydantic.BaseModel]:
+    """
+    Returns a representative payload for every topic.
+    """
+    overrides = _overrides()
+    fixtures = {}
+
+    for topic, klass in MQTTTopicPayload.items():
+        schema = klass.model_json_schema()
+        data = overrides.get(topic)
+        if data is None:
+            data = example_value(
+                schema,
+                schema.get("$defs", {}),
+                _ARRAY_LENGTHS.get(topic, _ARRAY_LENGTH),
+            )
+
+        fixtures[topic] = klass.model_validate(data)
+
+    return fixtures
@@ -0,0 +1,74 @@
+"""
+Per-frame timing of `bell.avr.utils.images` at the resolutions AVR uses.
+
+Run with `python -m benchmarks.images`.
+"""
+import argparse
+import timeit
+from typing import Dict, Tuple
+
+import numpy as np
+
+from bell.avr.utils.images import deserialize_image, serialize_image
+
+# name: serialize_image keyword arguments
+COMPRESSION = {
+    "none": {"compress": False},
+    "zlib": {"compress": True},
+    "zlib-1": {"compress": True, "level": 1},
+    "fast+delta": {"compress": "fast", "row_delta": True},
+}
+
+# name: (shape, dtype)
+FRAMES: Dict[str, Tuple[Tuple[int, ...], str]] = {
+    # Intel RealSense T265 fisheye, per side
+    "tracking_camera": ((800, 848), "uint8"),
+    "color_720p": ((720, 1280, 3), "uint8"),
+    # AMG8833 thermal camera
+    "thermal": ((8, 8), "float32"),
+}
+
+
+def make_frame(shape: Tuple[int, ...], dtype: str) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    if np.dtype(dtype).kind == "f":
+        return rng.uniform(15, 40, shape).astype(dtype)
+    # smooth gradient with a little noise, closer to a real image than noise
+    gradient = np.indices(shape).sum(axis=0) % 256
+    return (gradient + rng.integers(0, 8, shape)).astype(dtype)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20, help="Frames per timing")
+    args = parser.parse_args()
+
+    print(
+        f"{'frame':<18}{'compression':<13}{'serialize ms':>14}"
+        f"{'deserialize ms':>16}{'ratio':>8}"
+    )
+    for name, (shape, dtype) in FRAMES.items():
+        frame = make_frame(shape, dtype)
+
+        for compression, kwargs in COMPRESSION.items():
+            image_data = serialize_image(frame, **kwargs)
+
+            serialize_time = timeit.timeit(
+                lambda: serialize_image(frame, **kwargs), number=args.number
+            )
+            deserialize_time = timeit.timeit(
+                lambda: deserialize_image(image_data), number=args.number
+            )
+            # base64 adds a third, so compare against the raw size
+            ratio = len(image_data["data"]) * 3 / 4 / frame.nbytes
+
+            print(
+                f"{name:<18}{compression:<13}"
+                f"{serialize_time / args.number * 1000:>14.3f}"
+                f"{deserialize_time / args.number * 1000:>16.3f}"
+                f"{ratio:>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+End to end publish to callback latency and throughput between `MQTTModule`s,
+through a real broker connection.
+
+Run with `python -m benchmarks.loopback`. By default this starts a
+`benchmarks.broker.LoopbackBroker` in the same process. Pass `--port` to
+use another broker instead, such as one started in another process with
+`python -m benchmarks.broker`.
+"""
+import argparse
+import contextlib
+import json
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from benchmarks.suite import metadata
+from benchmarks.broker import LoopbackBroker
+from bell.avr.mqtt.module import MQTTModule
+from bell.avr.mqtt.payloads import AVRFusionHeading
+
+TOPIC = "avr/fusion/heading"
+
+
+class _Receiver(MQTTModule):
+    def __init__(self) -> None:
+        super().__init__()
+
+        # message number: when it was received
+        self.times: Dict[int, float] = {}
+        self.expected = 0
+        self.done = threading.Event()
+
+        self.topic_callbacks = {TOPIC: self.handle_heading}
+
+    def expect(self, count: int) -> None:
+        self.expected = count
+        self.done.clear()
+        if len(self.times) >= count:
+            self.done.set()
+
+    def handle_heading(self, payload: AVRFusionHeading) -> None:
+        self.times[int(payload.hdg)] = time.perf_counter()
+        if len(self.times) >= self.expected:
+            self.done.set()
+
+
+@contextlib.contextmanager
+def _broker(host: str, port: Optional[int]) -> Iterator[Tuple[str, int]]:
+    if port is not None:
+        yield host, port
+        return
+
+    with LoopbackBroker(host) as broker:
+        yield broker.host, broker.port
+
+
+def wait_for_subscribers(sender: MQTTModule, receivers: List[_Receiver]) -> None:
+    """
+    Send messages until every receiver gets one, since receivers may still be
+    subscribing when they start.
+    """
+    for receiver in receivers:
+        receiver.times.clear()
+        receiver.expect(1)
+
+    for _ in range(50):
+        sender.send_message(TOPIC, AVRFusionHeading(hdg=0))
+        if all(receiver.done.wait(0.1) for receiver in receivers):
+            return
+
+    raise TimeoutError("Receivers did not subscribe")
+
+
+def latency(sender: MQTTModule, receivers: List[_Receiver], count: int) -> List[float]:
+    """
+    Send messages one at a time, waiting for every receiver to get each one,
+    and return the time each receiver took to get each message.
+    """
+    for receiver in receivers:
+        receiver.times.clear()
+
+    latencies = []
+    for i in range(count):
+        for receiver in receivers:
+            receiver.expect(i + 1)
+
+        sent = time.perf_counter()
+        sender.send_message(TOPIC, AVRFusionHeading(hdg=i))
+
+        for receiver in receivers:
+            if not receiver.done.wait(5):
+                raise TimeoutError(f"Message {i} was not received")
+            latencies.append(receiver.times[i] - sent)
+
+    return latencies
+
+
+def throughput(sender: MQTTModule, receivers: List[_Receiver], count: int) -> float:
+    """
+    Send messages as fast as possible, and return the seconds until every
+    receiver got all of them.
+    """
+    for receiver in receivers:
+        receiver.times.clear()
+        receiver.expect(count)
+
+    start = time.perf_counter()
+    for i in range(count):
+        sender.send_message(TOPIC, AVRFusionHeading(hdg=i))
+
+    for receiver in receivers:
+        if not receiver.done.wait(60):
+            raise TimeoutError(
+                f"Only {len(receiver.times)} of {count} messages were received"
+            )
+
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, help="Use a running broker rather than starting one"
+    )
+    parser.add_argument("--receivers", type=int, default=2)
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument(
+        "--stages",
+        action="store_true",
+        help="Also break latency down into stages with latency_tracking",
+    )
+    parser.add_argument("--output", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    with _broker(args.host, args.port) as (host, port):
+        sender = MQTTModule()
+        receivers = [_Receiver() for _ in range(args.receivers)]
+
+        for module in (sender, *receivers):
+            # the send time is carried in an MQTT v5 user property
+            module.mqtt_v5 = args.stages
+            module.latency_tracking = args.stages
+            module.run_non_blocking(host, port)
+
+        try:
+            wait_for_subscribers(sender, receivers)
+            for receiver in receivers:
+                receiver.latency.reset()
+            latencies = np.array(latency(sender, receivers, args.count // 10))
+            stages = receivers[0].latency.summary().get(TOPIC, {})
+            elapsed = throughput(sender, receivers, args.count)
+        finally:
+            for module in (sender, *receivers):
+                module.stop()
+
+    results = {
+        "loopback/latency/p50": float(np.percentile(latencies, 50)),
+        "loopback/latency/p99": float(np.percentile(latencies, 99)),
+        "loopback/latency/max": float(latencies.max()),
+        "loopback/throughput/per_message": elapsed / args.count,
+    }
+
+    if args.stages:
+        for stage, summary in stages.items():
+            results[f"loopback/stage/{stage}/p50"] = summary["p50"]
+            results[f"loopback/stage/{stage}/p99"] = summary["p99"]
+
+    for name, result in results.items():
+        print(f"{name:<40}{result * 1e6:>12.1f} us")
+    print(
+        f"{args.count / elapsed:.0f} messages per second published,"
+        f" {args.count * args.receivers / elapsed:.0f} delivered"
+    )
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"meta": metadata(), "results": results}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
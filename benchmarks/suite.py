@@ -0,0 +1,268 @@
+"""
+Benchmarks of the hot paths of the library: serializing and deserializing the
+payload of every topic, dispatching messages to callbacks, images, and the
+PCC serial protocol.
+
+Run with `python -m benchmarks.suite`. Results can be written as JSON with
+`--output`, and compared against an earlier run with `--baseline`. The
+comparison fails if any benchmark is slower than the baseline by more than
+`--threshold`. Baselines are only comparable on the same machine, so save one
+with `--output` before making changes.
+"""
+import argparse
+import json
+import platform
+import re
+import sys
+import time
+import timeit
+import warnings
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pydantic
+
+from benchmarks.fixtures import payload_fixtures
+from benchmarks.images import COMPRESSION, FRAMES, make_frame
+from bell.avr.mqtt.client import MQTTClient
+from bell.avr.mqtt.dispatcher import TopicCallbacks, dispatch_message
+from bell.avr.mqtt.serializer import deserialize_payload, get_codec, serialize_payload
+from bell.avr.utils.images import deserialize_image, serialize_image
+
+Benchmark = Tuple[str, Callable[[], object]]
+
+
+def _noop(payload: object = None) -> None:
+    pass
+
+
+def serializer_benchmarks() -> List[Benchmark]:
+    benchmarks: List[Benchmark] = []
+
+    for topic, payload in payload_fixtures().items():
+        raw = serialize_payload(topic, payload).encode()
+        benchmarks.append(
+            (f"serialize/{topic}", lambda t=topic, p=payload: serialize_payload(t, p))
+        )
+        benchmarks.append(
+            (f"deserialize/{topic}", lambda t=topic, r=raw: deserialize_payload(t, r))
+        )
+
+        if get_codec(topic).supports_binary:
+            binary = serialize_payload(topic, payload, binary=True)
+            benchmarks.append(
+                (
+                    f"serialize-binary/{topic}",
+                    lambda t=topic, p=payload: serialize_payload(t, p, binary=True),
+                )
+            )
+            benchmarks.append(
+                (
+                    f"deserialize-binary/{topic}",
+                    lambda t=topic, b=binary: deserialize_payload(t, b),
+                )
+            )
+
+    return benchmarks
+
+
+def dispatch_benchmarks() -> List[Benchmark]:
+    fixtures = payload_fixtures()
+
+    # a module listening to everything, plus a couple of wildcards
+    topic_callbacks = TopicCallbacks({topic: _noop for topic in fixtures})
+    topic_callbacks["avr/fusion/#"] = _noop
+    topic_callbacks["avr/+/battery"] = _noop
+
+    client = MQTTClient()
+    client.topic_callbacks = {"avr/fcm/battery": _noop}
+    battery = fixtures["avr/fcm/battery"]
+    raw_battery = serialize_payload("avr/fcm/battery", battery).encode()
+
+    return [
+        (
+            "dispatch/exact",
+            lambda: dispatch_message(topic_callbacks, "avr/pcm/servo/open", None),
+        ),
+        (
+            "dispatch/wildcard",
+            lambda: dispatch_message(
+                topic_callbacks, "avr/fusion/position/local", None
+            ),
+        ),
+        (
+            "dispatch/unmatched",
+            lambda: dispatch_message(topic_callbacks, "avr/not/a/topic", None),
+        ),
+        (
+            "client/process_message",
+            lambda: client._process_message("avr/fcm/battery", raw_battery),
+        ),
+        (
+            "client/process_message_skipped",
+            lambda: client._process_message("avr/fusion/heading", raw_battery),
+        ),
+    ]
+
+
+def image_benchmarks() -> List[Benchmark]:
+    benchmarks: List[Benchmark] = []
+
+    for name, (shape, dtype) in FRAMES.items():
+        frame = make_frame(shape, dtype)
+
+        for compression, kwargs in COMPRESSION.items():
+            image_data = serialize_image(frame, **kwargs)
+            benchmarks.append(
+                (
+                    f"image/serialize/{name}/{compression}",
+                    lambda f=frame, k=kwargs: serialize_image(f, **k),
+                )
+            )
+            benchmarks.append(
+                (
+                    f"image/deserialize/{name}/{compression}",
+                    lambda d=image_data: deserialize_image(d),
+                )
+            )
+
+    return benchmarks
+
+
+def pcc_benchmarks() -> List[Benchmark]:
+    try:
+        from bell.avr.serial.pcc import PeripheralControlComputer
+    except ImportError:
+        # pyserial is an optional dependency
+        return []
+
+    pcc = PeripheralControlComputer(None)  # type: ignore
+    packet = pcc._construct_payload(0, 5, [255, 0, 255, 0, 0])
+
+    return [
+        (
+            "pcc/construct_payload",
+            lambda: pcc._construct_payload(0, 5, [255, 0, 255, 0, 0]),
+        ),
+        ("pcc/calc_crc", lambda: pcc._calc_crc(packet, len(packet))),
+    ]
+
+
+def all_benchmarks() -> List[Benchmark]:
+    return (
+        serializer_benchmarks()
+        + dispatch_benchmarks()
+        + image_benchmarks()
+        + pcc_benchmarks()
+    )
+
+
+def measure(function: Callable[[], object], repeat: int, min_time: float) -> float:
+    """
+    Returns the fastest time per call in seconds, out of `repeat` runs of at
+    least `min_time` seconds each.
+    """
+    timer = timeit.Timer(function)
+
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        best = min(best, timer.timeit(number))
+
+    return best / number
+
+
+def run(
+    pattern: Optional[str] = None, repeat: int = 5, min_time: float = 0.02
+) -> Dict[str, float]:
+    """
+    Run the benchmarks with names matching a regular expression, and return
+    the seconds per call for each.
+    """
+    results = {}
+    for name, function in all_benchmarks():
+        if pattern is None or re.search(pattern, name):
+            results[name] = measure(function, repeat, min_time)
+    return results
+
+
+def compare(
+    results: Dict[str, float], baseline: Dict[str, float], threshold: float
+) -> List[Tuple[str, float, float]]:
+    """
+    Returns the benchmarks that are slower than the baseline by more than
+    `threshold`, as (name, baseline, result) tuples.
+    """
+    return [
+        (name, baseline[name], result)
+        for name, result in results.items()
+        if name in baseline and result > baseline[name] * (1 + threshold)
+    ]
+
+
+def metadata() -> dict:
+    return {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "numpy": np.__version__,
+        "pydantic": pydantic.VERSION,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter", help="Only run benchmarks matching this regex")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against this JSON file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown against the baseline, as a fraction",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.02)
+    args = parser.parse_args()
+
+    # tuple fields serialize fine, but pydantic warns about them
+    warnings.filterwarnings("ignore", category=UserWarning, module="pydantic")
+
+    results = run(args.filter, args.repeat, args.min_time)
+
+    baseline: Dict[str, float] = {}
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)["results"]
+
+    print(f"{'benchmark':<60}{'us':>12}{'baseline us':>14}{'change':>9}")
+    for name, result in results.items():
+        line = f"{name:<60}{result * 1e6:>12.3f}"
+        if name in baseline:
+            change = result / baseline[name] - 1
+            line += f"{baseline[name] * 1e6:>14.3f}{change:>+9.1%}"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"meta": metadata(), "results": results}, fp, indent=2)
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(
+            f"\n{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}:"
+        )
+        for name, before, after in regressions:
+            print(f"  {name}: {before * 1e6:.3f} us -> {after * 1e6:.3f} us")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
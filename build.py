@@ -8,7 +8,7 @@ import shutil
 import subprocess
 import sys
 import urllib.request
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import jinja2
 import jsonref
@@ -239,7 +239,9 @@ def type_hint_for_property(
             property_type_hint.type_hint = "str"
 
         if "default" in property_:
-            property_type_hint.type_hint += f" = Field(default={property_['default']})"
+            property_type_hint.type_hint += (
+                f" = Field(default={json.dumps(property_['default'])})"
+            )
 
     elif property_["type"] in ["number", "integer"]:
         subclass_name = create_name(parent_name, name)
@@ -343,6 +345,80 @@ def build_class_code(class_name: str, class_data: dict) -> List[str]:
     return output_lines
 
 
+# struct format characters for integers, smallest first
+STRUCT_INTEGER_FORMATS = [
+    ("B", 0, 2**8 - 1),
+    ("b", -(2**7), 2**7 - 1),
+    ("H", 0, 2**16 - 1),
+    ("h", -(2**15), 2**15 - 1),
+    ("I", 0, 2**32 - 1),
+    ("i", -(2**31), 2**31 - 1),
+]
+
+
+def struct_format_for_scalar(property_: Dict) -> Optional[str]:
+    """
+    Take JSON schema data for a scalar property and return the struct format
+    character that can hold every valid value, or `None` if the property
+    cannot be packed into a fixed size.
+    """
+    if property_["type"] == "number":
+        return "d"
+
+    if property_["type"] == "boolean":
+        return "?"
+
+    if property_["type"] != "integer":
+        return None
+
+    minimum = property_.get("minimum", property_.get("exclusiveMinimum"))
+    maximum = property_.get("maximum", property_.get("exclusiveMaximum"))
+
+    # pick the smallest integer type that fits the bounds
+    if minimum is not None and maximum is not None:
+        for format_, low, high in STRUCT_INTEGER_FORMATS:
+            if low <= minimum and maximum <= high:
+                return format_
+
+    return "q"
+
+
+def struct_layout_for_class(class_data: dict) -> Optional[List[Tuple[str, str, int]]]:
+    """
+    Take JSON schema data for a message and return a fixed binary layout
+    as a list of (property name, struct format character, count).
+    Returns `None` if the message has anything besides required numbers,
+    booleans, or fixed length arrays of those.
+    """
+    properties = class_data.get("properties")
+    if not properties:
+        return None
+
+    layout = []
+    for property_name, property_ in properties.items():
+        if property_name not in class_data.get("required", []):
+            return None
+
+        count = 1
+        if property_["type"] == "array":
+            if (
+                "minItems" not in property_
+                or property_.get("maxItems") != property_["minItems"]
+            ):
+                return None
+
+            count = property_["minItems"]
+            property_ = property_["items"]
+
+        format_ = struct_format_for_scalar(property_)
+        if format_ is None:
+            return None
+
+        layout.append((property_name, format_, count))
+
+    return layout
+
+
 def python_code() -> None:
     output_file = MQTT_DIR.joinpath("payloads.py")
 
@@ -355,6 +431,8 @@ def python_code() -> None:
 
     # first, build a dict of topics to class names
     topic_class: Dict[str, str] = {}
+    # and of topics to (QoS, retain) from MQTT bindings, if they have any
+    topic_delivery: Dict[str, Tuple[int, bool]] = {}
 
     channels = raw_asyncapi_data["channels"]
     for topic in channels:
@@ -372,11 +450,22 @@ def python_code() -> None:
         # parse out the class name
         topic_class[topic] = topic_message["message"]["$ref"].split("/")[-1]
 
+        # https://github.com/asyncapi/bindings/tree/master/mqtt#operation-binding-object
+        mqtt_binding = topic_message.get("bindings", {}).get("mqtt")
+        if mqtt_binding is not None:
+            topic_delivery[topic] = (
+                mqtt_binding.get("qos", 0),
+                mqtt_binding.get("retain", False),
+            )
+
     # now, build the class for each topic
     final_output_lines = (
         MQTT_DIR.joinpath("_payloads_header.j2").read_text().splitlines()
     )
 
+    # fixed binary layouts for messages that support them
+    class_struct_layout: Dict[str, List[Tuple[str, str, int]]] = {}
+
     messages = asyncapi_data["components"]["messages"]
     for message in messages:
         print(f"Building code for {message}")
@@ -384,6 +473,10 @@ def python_code() -> None:
             build_class_code(message, messages[message]["payload"])
         )
 
+        layout = struct_layout_for_class(messages[message]["payload"])
+        if layout is not None:
+            class_struct_layout[message] = layout
+
     # generate callables
     for klass in set(topic_class.values()):
         args = f", payload: {klass}"
@@ -424,6 +517,8 @@ def python_code() -> None:
             fp.write(
                 template_env.get_template(template.name).render(
                     topic_class=topic_class,
+                    class_struct_layout=class_struct_layout,
+                    topic_delivery=topic_delivery,
                 )
             )
 
@@ -7,12 +7,10 @@ from bell.avr.serial.pcc import PeripheralControlComputer
 from tests.models import MQTTModuleTest
 
 
-@pytest.fixture()
-def mqtt_module(mocker: MockerFixture) -> MQTTModuleTest:
-    """
-    Create an MQTTModule with a test handler function.
-    """
+def _mqtt_module(mocker: MockerFixture, mqtt_v5: bool) -> MQTTModuleTest:
     module = MQTTModuleTest()
+    # creates the client again, so must come before it is mocked
+    module.mqtt_v5 = mqtt_v5
     mocker.patch.object(module, "test_handler")
     mocker.patch.object(module, "test_handler_empty")
     mocker.patch.object(module, "_mqtt_client")
@@ -20,6 +18,22 @@ def mqtt_module(mocker: MockerFixture) -> MQTTModuleTest:
     return module
 
 
+@pytest.fixture()
+def mqtt_module(mocker: MockerFixture) -> MQTTModuleTest:
+    """
+    Create an MQTTModule with a test handler function.
+    """
+    return _mqtt_module(mocker, False)
+
+
+@pytest.fixture()
+def mqtt_v5_module(mocker: MockerFixture) -> MQTTModuleTest:
+    """
+    Create an MQTTModule using MQTT v5, with a test handler function.
+    """
+    return _mqtt_module(mocker, True)
+
+
 @pytest.fixture()
 def pcc(mocker: MockerFixture) -> PeripheralControlComputer:
     """
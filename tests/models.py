@@ -1,4 +1,7 @@
-from typing import Any
+from typing import Any, Optional
+
+from paho.mqtt.properties import Properties
+
 from bell.avr.mqtt.module import MQTTModule, paho_mqtt
 
 
@@ -9,7 +12,11 @@ class MQTTModuleTest(MQTTModule):
     def test_handler_empty(self) -> Any:
         pass
 
-    def recieve_message(self, topic: str, payload: str) -> None:
+    def recieve_message(
+        self, topic: str, payload: str, properties: Optional[Properties] = None
+    ) -> None:
         msg = paho_mqtt.MQTTMessage(topic=topic.encode())
         msg.payload = payload.encode()
+        if properties is not None:
+            msg.properties = properties
         self.on_message(None, None, msg)  # type: ignore
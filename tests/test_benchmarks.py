@@ -0,0 +1,32 @@
+import pytest
+
+from benchmarks.fixtures import payload_fixtures
+from benchmarks.suite import compare, measure
+from bell.avr.mqtt.constants import MQTTTopicPayload
+from bell.avr.mqtt.serializer import deserialize_payload, serialize_payload
+
+
+# tuple fields serialize fine, but pydantic warns about them
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_payload_fixtures() -> None:
+    fixtures = payload_fixtures()
+    assert fixtures.keys() == MQTTTopicPayload.keys()
+
+    for topic, payload in fixtures.items():
+        assert isinstance(payload, MQTTTopicPayload[topic])
+        assert deserialize_payload(topic, serialize_payload(topic, payload)) == payload
+
+
+def test_measure() -> None:
+    assert measure(lambda: None, repeat=2, min_time=0.001) > 0
+
+
+def test_compare() -> None:
+    baseline = {"a": 1.0, "b": 1.0, "c": 1.0}
+    results = {"a": 1.1, "b": 1.5, "d": 10.0}
+
+    assert compare(results, baseline, threshold=0.2) == [("b", 1.0, 1.5)]
+    assert compare(results, baseline, threshold=0.05) == [
+        ("a", 1.0, 1.1),
+        ("b", 1.0, 1.5),
+    ]
@@ -1,6 +1,11 @@
+from typing import List
+
 import numpy as np
+import pydantic
 import pytest
 
+from bell.avr.mqtt.payloads import AVRThermalReading
+from bell.avr.mqtt.serializer import serialize_payload
 from bell.avr.utils import images
 
 
@@ -22,3 +27,291 @@ def test_serialization(in_image: np.ndarray, compress: bool) -> None:
     print(in_image)
     print(out_image)
     np.testing.assert_array_equal(in_image, out_image)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize(
+    "in_image",
+    [
+        np.arange(12, dtype=np.uint8).reshape(3, 4),
+        np.arange(24, dtype=np.uint16).reshape(2, 3, 4) * 1000,
+        np.linspace(20.5, 35.25, 64, dtype=np.float32).reshape(8, 8),
+        np.arange(6, dtype=">i2").reshape(2, 3) - 3,  # big-endian input
+    ],
+)
+def test_serialization_dtype(in_image: np.ndarray, compress: bool) -> None:
+    image_data = images.serialize_image(in_image, compress)
+
+    # make sure the payload classes accept the data
+    payload = AVRThermalReading(**image_data)
+    out_image = images.deserialize_image(payload)
+
+    assert out_image.dtype.name == in_image.dtype.name
+    np.testing.assert_array_equal(in_image, out_image)
+
+
+class BaselineThermalReading(pydantic.BaseModel):
+    # the payload class before the data type was recorded
+    model_config = pydantic.ConfigDict(extra="forbid")
+
+    data: str
+    shape: List[int]
+    compressed: bool
+
+
+@pytest.mark.parametrize(
+    "in_image",
+    [np.arange(12, dtype=np.uint8).reshape(3, 4), np.array([[1, 2], [3, 4]])],
+)
+def test_serialization_baseline_schema(in_image: np.ndarray) -> None:
+    image_data = images.serialize_image(in_image)
+    assert "dtype" not in image_data
+
+    raw = serialize_payload("avr/thermal/reading", AVRThermalReading(**image_data))
+    payload = BaselineThermalReading.model_validate_json(raw)
+    out_image = images.deserialize_image(payload)
+
+    assert out_image.dtype == np.uint8
+    np.testing.assert_array_equal(in_image, out_image)
+
+
+def test_deserialization_without_dtype() -> None:
+    # data from before the data type was recorded
+    image_data = {"data": "AQIDBA==", "shape": [2, 2], "compressed": False}
+    out_image = images.deserialize_image(image_data)  # type: ignore
+
+    assert out_image.dtype == np.uint8
+    np.testing.assert_array_equal(out_image, [[1, 2], [3, 4]])
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize(
+    "in_image",
+    [
+        np.arange(12, dtype=np.uint8).reshape(3, 4),
+        np.arange(24, dtype=np.uint16).reshape(2, 3, 4) * 1000,
+        np.linspace(20.5, 35.25, 64, dtype=np.float32).reshape(8, 8),
+    ],
+)
+def test_raw_serialization(in_image: np.ndarray, compress: bool) -> None:
+    raw = images.serialize_image_raw(in_image, compress)
+    out_image = images.deserialize_image(raw)
+
+    assert out_image.dtype == in_image.dtype
+    np.testing.assert_array_equal(in_image, out_image)
+
+
+def test_raw_deserialization_is_a_view() -> None:
+    raw = images.serialize_image_raw(np.zeros((4, 4, 3), dtype=np.uint8))
+    out_image = images.deserialize_image(raw)
+
+    assert np.shares_memory(out_image, np.frombuffer(raw, dtype=np.uint8))
+    assert not out_image.flags.writeable
+
+
+def test_raw_mqtt_payload() -> None:
+    from bell.avr.mqtt.serializer import deserialize_payload, serialize_payload
+
+    raw = images.serialize_image_raw(np.ones((2, 2), dtype=np.uint8))
+
+    # raw images are passed through the serializer untouched
+    assert serialize_payload("avr/thermal/reading", raw) is raw
+    assert deserialize_payload("avr/thermal/reading", raw) is raw
+
+
+@pytest.mark.parametrize("raw", [b"\xa6\x01", b"\xa6\x09|u1\x00\x01\x02\x00\x00\x00"])
+def test_raw_deserialization_invalid(raw: bytes) -> None:
+    with pytest.raises(ValueError):
+        images.deserialize_image(raw)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_deserialization_is_read_only(compress: bool) -> None:
+    image_data = images.serialize_image(np.ones((4, 4), dtype=np.uint8), compress)
+    out_image = images.deserialize_image(image_data)
+
+    assert not out_image.flags.writeable
+
+
+@pytest.mark.parametrize("raw", [False, True])
+def test_deserialization_out(raw: bool) -> None:
+    serialize = images.serialize_image_raw if raw else images.serialize_image
+    out = np.zeros((8, 8), dtype=np.float32)
+
+    for value in (1.5, 2.5):
+        in_image = np.full((8, 8), value, dtype=np.float32)
+        result = images.deserialize_image(serialize(in_image), out=out)  # type: ignore
+
+        # the same buffer is reused every time
+        assert result is out
+        np.testing.assert_array_equal(out, in_image)
+
+
+@pytest.mark.parametrize(
+    "out", [np.zeros((8, 8), dtype=np.uint8), np.zeros((4, 4), dtype=np.float32)]
+)
+def test_deserialization_out_mismatch(out: np.ndarray) -> None:
+    image_data = images.serialize_image(np.zeros((8, 8), dtype=np.float32))
+
+    with pytest.raises(ValueError):
+        images.deserialize_image(image_data, out=out)
+
+
+@pytest.mark.parametrize("raw", [False, True])
+@pytest.mark.parametrize("row_delta", [False, True])
+@pytest.mark.parametrize("compress, level", [(True, 1), (True, 9), ("fast", None)])
+@pytest.mark.parametrize(
+    "in_image",
+    [
+        np.arange(48, dtype=np.uint8).reshape(4, 4, 3) * 5,
+        np.arange(64, dtype=np.int16).reshape(8, 8) - 32,
+        np.linspace(-5, 40, 64, dtype=np.float32).reshape(8, 8),
+    ],
+)
+def test_codecs(
+    in_image: np.ndarray, compress: bool, level: int, row_delta: bool, raw: bool
+) -> None:
+    serialize = images.serialize_image_raw if raw else images.serialize_image
+    out_image = images.deserialize_image(
+        serialize(in_image, compress, level=level, row_delta=row_delta)  # type: ignore
+    )
+
+    assert out_image.dtype == in_image.dtype
+    np.testing.assert_array_equal(in_image, out_image)
+
+
+def test_codec_chunks() -> None:
+    # large enough to be compressed in several pieces
+    in_image = np.arange(1024 * 1024, dtype=np.uint32).reshape(1024, 1024)
+
+    image_data = images.serialize_image(in_image, "fast", row_delta=True)
+    out_image = images.deserialize_image(image_data)
+
+    np.testing.assert_array_equal(in_image, out_image)
+
+
+def test_codec_plain_zlib() -> None:
+    # default compression stays readable without this library
+    import base64
+    import zlib
+
+    in_image = np.arange(16, dtype=np.uint8).reshape(4, 4)
+    image_data = images.serialize_image(in_image, compress=True)
+
+    assert zlib.decompress(base64.b64decode(image_data["data"])) == in_image.tobytes()
+
+
+def test_codec_plain_zlib_large() -> None:
+    # even when large enough to be compressed in pieces with a named codec
+    import base64
+    import zlib
+
+    in_image = np.arange(1024 * 1024, dtype=np.uint32).reshape(1024, 1024)
+    image_data = images.serialize_image(in_image, compress=True)
+
+    assert zlib.decompress(base64.b64decode(image_data["data"])) == in_image.tobytes()
+
+
+@pytest.mark.parametrize("raw", [False, True])
+def test_row_delta_without_compress(raw: bool) -> None:
+    serialize = images.serialize_image_raw if raw else images.serialize_image
+
+    with pytest.raises(ValueError):
+        serialize(np.zeros((2, 2), dtype=np.uint8), row_delta=True)
+
+
+def test_codec_unknown() -> None:
+    with pytest.raises(ValueError):
+        images.serialize_image(np.zeros((2, 2), dtype=np.uint8), compress="notreal")
+
+
+def test_register_codec() -> None:
+    import lzma
+
+    images.register_image_codec(
+        images.ImageCodec(
+            "lzma", 200, lambda data, level: lzma.compress(data), lzma.decompress
+        )
+    )
+
+    in_image = np.arange(16, dtype=np.uint8).reshape(4, 4)
+    out_image = images.deserialize_image(images.serialize_image(in_image, "lzma"))
+    np.testing.assert_array_equal(in_image, out_image)
+
+    # ids can't be reused by a different codec
+    with pytest.raises(ValueError):
+        images.register_image_codec(
+            images.ImageCodec("other", 200, lambda data, level: b"", bytes)
+        )
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.float32])
+def test_stream_roundtrip(dtype: type) -> None:
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 100, (24, 32)).astype(dtype)
+
+    encoder = images.ImageStreamEncoder(keyframe_interval=4)
+    decoder = images.ImageStreamDecoder()
+
+    sizes = []
+    for i in range(8):
+        frame[i, i] += 1
+        payload = encoder.encode(frame)
+        sizes.append(len(payload))
+
+        out_image = decoder.decode(payload)
+        assert out_image is not None
+        assert out_image.dtype == frame.dtype
+        np.testing.assert_array_equal(frame, out_image)
+
+    # frames 0 and 4 are keyframes, the rest are small deltas
+    assert sizes[1] < sizes[0]
+    assert sizes[5] < sizes[4]
+    assert decoder.frames_decoded == 8
+
+
+def test_stream_resync_after_drop() -> None:
+    encoder = images.ImageStreamEncoder(keyframe_interval=3)
+    decoder = images.ImageStreamDecoder()
+
+    frames = [np.full((4, 4), i, dtype=np.uint16) for i in range(6)]
+    payloads = [encoder.encode(frame) for frame in frames]
+
+    assert decoder.decode(payloads[0]) is not None
+    # payloads[1] is lost, so the delta in payloads[2] can't be applied
+    assert decoder.decode(payloads[2]) is None
+    assert decoder.frames_dropped == 1
+
+    # payloads[3] is a keyframe
+    for frame, payload in zip(frames[3:], payloads[3:]):
+        out_image = decoder.decode(payload)
+        assert out_image is not None
+        np.testing.assert_array_equal(frame, out_image)
+
+
+def test_stream_keyframe_on_request_and_shape_change() -> None:
+    encoder = images.ImageStreamEncoder(keyframe_interval=100)
+    decoder = images.ImageStreamDecoder()
+
+    decoder.decode(encoder.encode(np.zeros((4, 4), dtype=np.uint8)))
+
+    # a new receiver joining mid-stream can only start at a keyframe
+    late_decoder = images.ImageStreamDecoder()
+    assert late_decoder.decode(encoder.encode(np.ones((4, 4), dtype=np.uint8))) is None
+
+    encoder.request_keyframe()
+    out_image = late_decoder.decode(encoder.encode(np.ones((4, 4), dtype=np.uint8)))
+    assert out_image is not None
+
+    # a different shape always starts a new keyframe
+    in_image = np.ones((2, 8), dtype=np.uint8)
+    out_image = late_decoder.decode(encoder.encode(in_image))
+    assert out_image is not None
+    np.testing.assert_array_equal(in_image, out_image)
+
+
+def test_stream_not_stream_payload() -> None:
+    decoder = images.ImageStreamDecoder()
+
+    with pytest.raises(ValueError):
+        decoder.decode(images.serialize_image_raw(np.zeros((2, 2), dtype=np.uint8)))
@@ -0,0 +1,150 @@
+import asyncio
+import struct
+import time
+from typing import Any, List, Tuple
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from bell.avr.mqtt.async_module import AsyncMQTTModule
+from bell.avr.mqtt.payloads import AVRFusionHeading, AVRPCMServo
+
+
+async def read_packet(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    """
+    Read a single MQTT packet, returning the packet type and the body.
+    """
+    header = (await reader.readexactly(1))[0]
+
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+
+    return header >> 4, await reader.readexactly(length)
+
+
+def publish_packet(topic: str, payload: bytes) -> bytes:
+    body = struct.pack("!H", len(topic)) + topic.encode() + payload
+    assert len(body) < 128
+    return bytes((0x30, len(body))) + body
+
+
+def test_async_module_end_to_end() -> None:
+    async def main() -> None:
+        received: List[Any] = []
+        published: List[Tuple[str, bytes]] = []
+        subscribed = asyncio.Event()
+        disconnected = asyncio.Event()
+
+        async def broker(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            packet_type, _ = await read_packet(reader)
+            assert packet_type == 1  # CONNECT
+            writer.write(b"\x20\x02\x00\x00")  # CONNACK
+
+            while True:
+                packet_type, body = await read_packet(reader)
+                if packet_type == 3:  # PUBLISH
+                    (topic_length,) = struct.unpack_from("!H", body)
+                    published.append(
+                        (
+                            body[2 : 2 + topic_length].decode(),
+                            body[2 + topic_length :],
+                        )
+                    )
+                elif packet_type == 8 and not subscribed.is_set():  # SUBSCRIBE
+                    subscribed.set()
+                    writer.write(publish_packet("avr/pcm/servo/open", b'{"servo": 2}'))
+                elif packet_type == 14:  # DISCONNECT
+                    disconnected.set()
+                    writer.close()
+                    return
+
+        server = await asyncio.start_server(broker, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        class Module(AsyncMQTTModule):
+            def __init__(self) -> None:
+                super().__init__()
+
+                self.topic_callbacks = {"avr/pcm/servo/open": self.handle_servo}
+
+            async def handle_servo(self, payload: AVRPCMServo) -> None:
+                await asyncio.sleep(0)
+                received.append(payload)
+
+        module = Module()
+        await module.connect_async("127.0.0.1", port)
+        await subscribed.wait()
+
+        # the iterator sees the same messages as the callbacks
+        async for topic, payload in module.messages("avr/pcm/servo/open"):
+            assert topic == "avr/pcm/servo/open"
+            assert payload == AVRPCMServo(servo=2)
+            break
+
+        await module.send_message("avr/pcm/servo/close", AVRPCMServo(servo=3))
+        assert module.message_cache["avr/pcm/servo/close"] == AVRPCMServo(servo=3)
+
+        await module.stop_async()
+        await disconnected.wait()
+        server.close()
+        await server.wait_closed()
+
+        assert received == [AVRPCMServo(servo=2)]
+        assert published == [("avr/pcm/servo/close", b'{"servo":3}')]
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def test_async_messages_unsubscribe(mocker: MockerFixture) -> None:
+    module = AsyncMQTTModule()
+    mocker.patch.object(module, "_mqtt_client")
+
+    async def main() -> None:
+        iterator = module.messages("avr/fusion/#")
+        next_message = asyncio.ensure_future(iterator.__anext__())
+        await asyncio.sleep(0)
+        module._mqtt_client.subscribe.assert_called_once_with("avr/fusion/#", qos=0)
+
+        module._process_message("avr/fusion/heading", b'{"hdg": 1}')
+        assert await next_message == ("avr/fusion/heading", AVRFusionHeading(hdg=1))
+
+        await iterator.aclose()
+
+    asyncio.run(main())
+
+    module._mqtt_client.unsubscribe.assert_called_once_with("avr/fusion/#")
+    assert module._message_queues == []
+
+
+def test_async_latency_tracking(mocker: MockerFixture) -> None:
+    module = AsyncMQTTModule()
+    mocker.patch.object(module, "_mqtt_client")
+    handler = mocker.Mock()
+    module.topic_callbacks = {"avr/fusion/heading": handler}
+    module.latency_tracking = True
+
+    module._process_message("avr/fusion/heading", b'{"hdg": 1}', time.time())
+
+    handler.assert_called_once_with(AVRFusionHeading(hdg=1))
+    summary = module.latency.summary()["avr/fusion/heading"]
+    assert set(summary) == {"network", "dispatch", "decode", "handler", "total"}
+
+
+@pytest.mark.parametrize(
+    "option, value",
+    [("callback_workers", 2), ("conflate_topics", {"avr/fusion/#"})],
+)
+def test_async_unsupported_options(option: str, value: Any) -> None:
+    module = AsyncMQTTModule()
+    setattr(module, option, value)
+
+    with pytest.raises(ValueError):
+        asyncio.run(module.connect_async("127.0.0.1", 1))
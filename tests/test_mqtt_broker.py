@@ -0,0 +1,407 @@
+import socket
+import threading
+from typing import List, Set
+
+import numpy as np
+import paho.mqtt.client as paho_mqtt
+import pytest
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from benchmarks.broker import LoopbackBroker
+from bell.avr.mqtt.delivery import DeliveryPolicy
+from bell.avr.mqtt.module import MQTTModule
+from bell.avr.mqtt.offline import ReconnectBackoff
+from bell.avr.mqtt.payloads import AVRPCMServo, AVRThermalReading
+from bell.avr.utils.images import serialize_image
+
+
+@pytest.fixture
+def broker():
+    with LoopbackBroker() as broker:
+        yield broker
+
+
+def make_client(broker: LoopbackBroker) -> paho_mqtt.Client:
+    client = paho_mqtt.Client(protocol=paho_mqtt.MQTTv311)
+    client.connect(broker.host, broker.port)
+    client.loop_start()
+    return client
+
+
+def test_modules_end_to_end(broker: LoopbackBroker) -> None:
+    received: List[AVRPCMServo] = []
+    done = threading.Event()
+
+    class Receiver(MQTTModule):
+        def __init__(self) -> None:
+            super().__init__()
+
+            self.topic_callbacks = {"avr/pcm/servo/+": self.handle_servo}
+
+        def handle_servo(self, payload: AVRPCMServo) -> None:
+            received.append(payload)
+            if len(received) == 2:
+                done.set()
+
+    receiver = Receiver()
+    sender = MQTTModule()
+    receiver.run_non_blocking(broker.host, broker.port)
+    sender.run_non_blocking(broker.host, broker.port)
+
+    try:
+        assert broker.wait_for_subscribers("avr/pcm/servo/open")
+
+        sender.send_message("avr/pcm/servo/open", AVRPCMServo(servo=1))
+        sender.send_message("avr/fusion/heading", {"hdg": 90.0})
+        sender.send_message("avr/pcm/servo/close", AVRPCMServo(servo=2))
+
+        assert done.wait(5)
+        assert received == [AVRPCMServo(servo=1), AVRPCMServo(servo=2)]
+    finally:
+        sender.stop()
+        receiver.stop()
+
+    assert broker.stats.received == 3
+    assert broker.stats.delivered == 2
+
+
+def test_qos_1(broker: LoopbackBroker) -> None:
+    messages: List[paho_mqtt.MQTTMessage] = []
+    done = threading.Event()
+
+    def on_message(client, userdata, msg: paho_mqtt.MQTTMessage) -> None:
+        messages.append(msg)
+        done.set()
+
+    subscriber = make_client(broker)
+    subscriber.on_message = on_message
+    subscriber.subscribe("avr/#", qos=1)
+    publisher = make_client(broker)
+
+    try:
+        assert broker.wait_for_subscribers("avr/fcm/action/kill")
+
+        info = publisher.publish("avr/fcm/action/kill", b"{}", qos=1)
+        info.wait_for_publish(5)
+        assert info.is_published()
+
+        assert done.wait(5)
+        assert messages[0].topic == "avr/fcm/action/kill"
+        assert messages[0].qos == 1
+    finally:
+        publisher.disconnect()
+        subscriber.disconnect()
+        publisher.loop_stop()
+        subscriber.loop_stop()
+
+
+def test_retained(broker: LoopbackBroker) -> None:
+    messages: List[paho_mqtt.MQTTMessage] = []
+    done = threading.Event()
+
+    def on_message(client, userdata, msg: paho_mqtt.MQTTMessage) -> None:
+        messages.append(msg)
+        done.set()
+
+    publisher = make_client(broker)
+    publisher.publish("avr/fcm/status", b"armed", qos=1, retain=True).wait_for_publish(
+        5
+    )
+
+    subscriber = make_client(broker)
+    subscriber.on_message = on_message
+    subscriber.subscribe("avr/+/status")
+
+    try:
+        assert done.wait(5)
+        assert messages[0].payload == b"armed"
+        assert messages[0].retain
+    finally:
+        publisher.disconnect()
+        subscriber.disconnect()
+        publisher.loop_stop()
+        subscriber.loop_stop()
+
+
+def test_unsubscribe(broker: LoopbackBroker) -> None:
+    unsubscribed = threading.Event()
+
+    subscriber = make_client(broker)
+    subscriber.on_unsubscribe = lambda *args: unsubscribed.set()
+    subscriber.subscribe("avr/fusion/#")
+
+    try:
+        assert broker.wait_for_subscribers("avr/fusion/heading")
+        subscriber.unsubscribe("avr/fusion/#")
+        assert unsubscribed.wait(5)
+        assert not broker.wait_for_subscribers("avr/fusion/heading", timeout=0)
+    finally:
+        subscriber.disconnect()
+        subscriber.loop_stop()
+
+
+def test_mqtt_v5_end_to_end(broker: LoopbackBroker) -> None:
+    messages: List[paho_mqtt.MQTTMessage] = []
+    done = threading.Event()
+
+    def on_message(client, userdata, msg: paho_mqtt.MQTTMessage) -> None:
+        messages.append(msg)
+        if len(messages) == 5:
+            done.set()
+
+    # MQTT v3.1.1 subscriber
+    subscriber = make_client(broker)
+    subscriber.on_message = on_message
+    subscriber.subscribe("avr/#")
+
+    connected = threading.Event()
+
+    class Sender(MQTTModule):
+        def __init__(self) -> None:
+            super().__init__()
+
+            self.mqtt_v5 = True
+            self.message_expiry = {"avr/fusion/heading": 5}
+
+        def on_connect(self, *args) -> None:
+            super().on_connect(*args)
+            connected.set()
+
+    sender = Sender()
+    sender.run_non_blocking(broker.host, broker.port)
+
+    try:
+        assert connected.wait(5)
+        assert broker.wait_for_subscribers("avr/fusion/heading")
+
+        for hdg in range(5):
+            sender.send_message("avr/fusion/heading", {"hdg": hdg})
+
+        assert done.wait(5)
+        # later messages were sent with a topic alias
+        assert sender._topic_aliases[sender._mqtt_client].aliases == {
+            "avr/fusion/heading": 1
+        }
+        assert [msg.topic for msg in messages] == ["avr/fusion/heading"] * 5
+        assert [msg.payload for msg in messages][-1] == b'{"hdg":4.0}'
+    finally:
+        sender.stop()
+        subscriber.disconnect()
+        subscriber.loop_stop()
+
+
+def test_mqtt_v5_retained_expiry(broker: LoopbackBroker) -> None:
+    messages: List[paho_mqtt.MQTTMessage] = []
+    done = threading.Event()
+
+    def on_message(client, userdata, msg: paho_mqtt.MQTTMessage) -> None:
+        messages.append(msg)
+        done.set()
+
+    publisher = paho_mqtt.Client(protocol=paho_mqtt.MQTTv5)
+    publisher.connect(broker.host, broker.port)
+    publisher.loop_start()
+
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.MessageExpiryInterval = 30
+    properties.UserProperty = ("avr-sent", "1.5")
+    publisher.publish(
+        "avr/fcm/status", b"armed", qos=1, retain=True, properties=properties
+    ).wait_for_publish(5)
+
+    subscriber = paho_mqtt.Client(protocol=paho_mqtt.MQTTv5)
+    subscriber.on_message = on_message
+    subscriber.connect(broker.host, broker.port)
+    subscriber.loop_start()
+    subscriber.subscribe("avr/fcm/status")
+
+    try:
+        assert done.wait(5)
+        assert messages[0].retain
+        assert 0 < messages[0].properties.MessageExpiryInterval <= 30
+        # user properties are passed on untouched
+        assert messages[0].properties.UserProperty == [("avr-sent", "1.5")]
+    finally:
+        for client in (publisher, subscriber):
+            client.disconnect()
+            client.loop_stop()
+
+
+def test_delivery_policies_end_to_end(broker: LoopbackBroker) -> None:
+    sender = MQTTModule()
+    sender.delivery_policies = {"avr/fcm/armed": DeliveryPolicy(retain=True)}
+    sender.run_non_blocking(broker.host, broker.port)
+
+    try:
+        # actions are acknowledged, and retained state is kept for later
+        # subscribers
+        info = sender._publish("avr/fcm/action/kill", "{}")
+        sender.send_message("avr/fcm/armed", {"armed": True})
+        assert info is not None
+        info.wait_for_publish(5)
+        assert info.is_published()
+        assert sender.delivery_stats.in_flight == 0
+
+        messages: List[paho_mqtt.MQTTMessage] = []
+        done = threading.Event()
+
+        def on_message(client, userdata, msg: paho_mqtt.MQTTMessage) -> None:
+            messages.append(msg)
+            done.set()
+
+        subscriber = make_client(broker)
+        subscriber.on_message = on_message
+        subscriber.subscribe("avr/fcm/#")
+        try:
+            assert done.wait(5)
+        finally:
+            subscriber.loop_stop()
+            subscriber.disconnect()
+    finally:
+        sender.stop()
+
+    assert [msg.topic for msg in messages] == ["avr/fcm/armed"]
+    assert messages[0].retain
+
+
+# image shapes are tuples, which serialize fine, but pydantic warns about them
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_connection_shards_end_to_end(broker: LoopbackBroker) -> None:
+    received: List[str] = []
+    threads: Set[str] = set()
+    done = threading.Event()
+
+    class Receiver(MQTTModule):
+        def __init__(self) -> None:
+            super().__init__()
+
+            self.connection_shards = {"images": {"avr/thermal/#"}}
+            self.topic_callbacks = {
+                "avr/thermal/reading": self.handle_message,
+                "avr/pcm/servo/open": self.handle_message,
+            }
+
+        def handle_message(self, payload: object) -> None:
+            received.append(type(payload).__name__)
+            threads.add(threading.current_thread().name)
+            if len(received) == 2:
+                done.set()
+
+    receiver = Receiver()
+    sender = MQTTModule()
+    sender.connection_shards = {"images": {"avr/thermal/#"}}
+    receiver.run_non_blocking(broker.host, broker.port)
+    sender.run_non_blocking(broker.host, broker.port)
+
+    try:
+        assert broker.wait_for_subscribers("avr/thermal/reading")
+        assert broker.wait_for_subscribers("avr/pcm/servo/open")
+
+        images = sender._shard_clients["images"]
+        image = serialize_image(np.zeros((8, 8), dtype=np.uint8))
+        sender.send_message("avr/thermal/reading", AVRThermalReading(**image))
+        sender.send_message("avr/pcm/servo/open", AVRPCMServo(servo=1))
+        assert sender._client_for_topic("avr/thermal/reading") is images
+
+        assert done.wait(5)
+        assert sorted(received) == ["AVRPCMServo", "AVRThermalReading"]
+        # callbacks from both connections run on the same thread
+        assert threads == {"Receiver_callbacks_0"}
+    finally:
+        sender.stop()
+        receiver.stop()
+
+
+def test_connection_shards_wildcard(broker: LoopbackBroker) -> None:
+    """
+    Ensure messages that arrive on a shard and through a wildcard on the
+    main connection are only handled once.
+    """
+    received: List[str] = []
+    thermal = threading.Event()
+    done = threading.Event()
+
+    class Receiver(MQTTModule):
+        def __init__(self) -> None:
+            super().__init__()
+
+            self.connection_shards = {"images": {"avr/thermal/#"}}
+            self.subscribe_to_all_avr_topics = True
+            self.topic_callbacks = {
+                "avr/thermal/reading": self.handle_thermal,
+                "avr/pcm/servo/open": lambda _: done.set(),
+            }
+
+        def handle_thermal(self, payload: AVRThermalReading) -> None:
+            received.append("thermal")
+            thermal.set()
+
+    receiver = Receiver()
+    sender = MQTTModule()
+    receiver.run_non_blocking(broker.host, broker.port)
+    sender.run_non_blocking(broker.host, broker.port)
+
+    try:
+        assert broker.wait_for_subscribers("avr/thermal/reading", count=2)
+
+        image = serialize_image(np.zeros((8, 8), dtype=np.uint8))
+        sender.send_message("avr/thermal/reading", AVRThermalReading(**image))
+        # sent after, on the same connection, and only received on the main one
+        sender.send_message("avr/pcm/servo/open", AVRPCMServo(servo=1))
+
+        # a copy through the main connection would have been handled first
+        assert done.wait(5)
+        assert thermal.wait(5)
+        assert received == ["thermal"]
+    finally:
+        sender.stop()
+        receiver.stop()
+
+
+def test_retry_connect() -> None:
+    # find a port with nothing listening on it yet
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    received: List[AVRPCMServo] = []
+    done = threading.Event()
+
+    class Receiver(MQTTModule):
+        def __init__(self) -> None:
+            super().__init__()
+
+            self.retry_connect = True
+            self.reconnect_backoff = ReconnectBackoff(initial_delay=0.01, max_delay=0.1)
+            self.topic_callbacks = {"avr/pcm/servo/open": self.handle_servo}
+
+        def handle_servo(self, payload: AVRPCMServo) -> None:
+            received.append(payload)
+            if payload.servo == 2:
+                done.set()
+
+    sender = MQTTModule()
+    sender.retry_connect = True
+    sender.reconnect_backoff = ReconnectBackoff(initial_delay=0.01, max_delay=0.1)
+    receiver = Receiver()
+
+    # neither raises, even though the broker isn't running yet
+    sender.run_non_blocking("127.0.0.1", port)
+    receiver.run_non_blocking("127.0.0.1", port)
+
+    try:
+        sender.send_message("avr/pcm/servo/open", AVRPCMServo(servo=1))
+        assert sender.delivery_stats.offline == 1
+
+        with LoopbackBroker(port=port) as late_broker:
+            assert late_broker.wait_for_subscribers("avr/pcm/servo/open")
+
+            # the held message may have been sent before the receiver subscribed
+            sender.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+            assert done.wait(5)
+            assert received[-1] == AVRPCMServo(servo=2)
+            assert sender.delivery_stats.offline == 0
+    finally:
+        sender.stop()
+        receiver.stop()
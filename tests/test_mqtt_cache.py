@@ -0,0 +1,60 @@
+from pytest_mock.plugin import MockerFixture
+
+from bell.avr.mqtt.cache import ReceiveCache, SentCache
+from bell.avr.mqtt.payloads import AVRPCMServo
+
+
+def test_sent_cache_lazy() -> None:
+    cache = SentCache()
+    assert cache.get("avr/pcm/servo/open") is None
+    cache.put("avr/pcm/servo/open", '{"servo":2}')
+
+    assert "avr/pcm/servo/open" in cache
+
+    # every read gets its own copy
+    payload = cache.get("avr/pcm/servo/open")
+    assert payload == AVRPCMServo(servo=2)
+    payload.servo = 4
+    assert cache.get("avr/pcm/servo/open") == AVRPCMServo(servo=2)
+
+    cache.put("avr/pcm/servo/open", '{"servo":3}')
+    assert cache.get("avr/pcm/servo/open") == AVRPCMServo(servo=3)
+
+
+def test_receive_cache(mocker: MockerFixture) -> None:
+    now = [10.0]
+    mocker.patch("bell.avr.mqtt.cache.time.monotonic", side_effect=lambda: now[0])
+
+    cache = ReceiveCache()
+    assert cache.get_message("avr/pcm/servo/open") is None
+    assert cache.get_fresh("avr/pcm/servo/open", 1) is None
+
+    cache.put("avr/pcm/servo/open", b'{"servo": 1}')
+    now[0] += 0.5
+    cache.put("avr/pcm/servo/open", b'{"servo": 2}')
+
+    assert cache.get_message("avr/pcm/servo/open") == (AVRPCMServo(servo=2), 10.5, 2)
+    assert cache["avr/pcm/servo/open"] is cache["avr/pcm/servo/open"]
+
+    now[0] += 1
+    assert cache.age("avr/pcm/servo/open") == 1
+    assert cache.get_fresh("avr/pcm/servo/open", 2) == AVRPCMServo(servo=2)
+    assert cache.get_fresh("avr/pcm/servo/open", 0.5, "stale") == "stale"
+
+
+def test_receive_cache_put_decoded() -> None:
+    cache = ReceiveCache()
+    raw = b'{"servo": 1}'
+    payload = AVRPCMServo(servo=1)
+
+    cache.put("avr/pcm/servo/open", raw)
+    cache.put_decoded("avr/pcm/servo/open", raw, payload)
+    assert cache["avr/pcm/servo/open"] is payload
+
+    # a newer message isn't replaced by an older decoded one
+    cache.put("avr/pcm/servo/open", b'{"servo": 2}')
+    cache.put_decoded("avr/pcm/servo/open", raw, payload)
+    assert cache["avr/pcm/servo/open"] == AVRPCMServo(servo=2)
+
+    cache.put_decoded("avr/pcm/servo/close", raw, payload)
+    assert "avr/pcm/servo/close" not in cache
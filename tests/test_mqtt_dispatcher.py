@@ -0,0 +1,128 @@
+from typing import Any, List
+
+import pytest
+
+from bell.avr.mqtt.dispatcher import TopicCallbacks, dispatch_message, topic_matches
+from bell.avr.mqtt.payloads import AVREmptyMessage, AVRPCMServo
+
+
+@pytest.mark.parametrize(
+    "topic_filter, topic, expected",
+    [
+        ("avr/fcm/battery", "avr/fcm/battery", True),
+        ("avr/fcm/battery", "avr/fcm/armed", False),
+        ("avr/+/battery", "avr/fcm/battery", True),
+        ("avr/+", "avr/fcm/battery", False),
+        ("avr/#", "avr/fcm/battery", True),
+        ("avr/#", "avr", True),  # "#" includes the parent level
+        ("avr/fcm/#", "avr/fusion/heading", False),
+        ("#", "$SYS/broker", False),  # wildcards don't match $ topics
+        ("$SYS/#", "$SYS/broker", True),
+    ],
+)
+def test_topic_matches(topic_filter: str, topic: str, expected: bool) -> None:
+    assert topic_matches(topic_filter, topic) is expected
+
+    # the compiled trie must agree with the reference matcher
+    topic_callbacks = TopicCallbacks({topic_filter: lambda: None})
+    assert bool(topic_callbacks.match(topic)) is expected
+
+
+def test_dispatch_wildcards_and_lists() -> None:
+    calls: List[Any] = []
+
+    topic_callbacks = TopicCallbacks(
+        {
+            "avr/pcm/servo/open": [
+                lambda payload: calls.append(("exact", payload)),
+                lambda payload=None: calls.append(("exact_optional", payload)),
+            ],
+            "avr/pcm/#": lambda payload: calls.append(("wildcard", payload)),
+        }
+    )
+
+    payload = AVRPCMServo(servo=2)
+    dispatch_message(topic_callbacks, "avr/pcm/servo/open", payload)  # type: ignore
+
+    # callbacks run in the order they were registered
+    assert calls == [
+        ("exact", payload),
+        ("exact_optional", payload),
+        ("wildcard", payload),
+    ]
+
+
+def test_dispatch_calling_convention() -> None:
+    """
+    Callbacks that require an argument always get the payload, and callbacks
+    without parameters never do.
+    """
+    calls: List[Any] = []
+    topic_callbacks = TopicCallbacks(
+        {
+            "avr/pcm/laser/fire": lambda payload: calls.append(payload),
+            "avr/pcm/servo/open": lambda: calls.append("no payload"),
+        }
+    )
+
+    empty = AVREmptyMessage()
+    dispatch_message(topic_callbacks, "avr/pcm/laser/fire", empty)  # type: ignore
+    dispatch_message(topic_callbacks, "avr/pcm/servo/open", AVRPCMServo(servo=1))  # type: ignore
+
+    assert calls == [empty, "no payload"]
+
+
+def test_dispatch_empty_message_optional_argument() -> None:
+    calls: List[Any] = []
+
+    def handler(payload: Any = None) -> None:
+        calls.append(payload)
+
+    topic_callbacks = TopicCallbacks({"avr/pcm/laser/fire": handler})
+    dispatch_message(topic_callbacks, "avr/pcm/laser/fire", AVREmptyMessage())  # type: ignore
+
+    assert calls == [None]
+
+
+def test_dispatch_recompiles_after_change() -> None:
+    calls: List[str] = []
+
+    topic_callbacks = TopicCallbacks({"a/b": lambda: calls.append("first")})
+    dispatch_message(topic_callbacks, "a/b", AVREmptyMessage())  # type: ignore
+
+    topic_callbacks["a/+"] = lambda: calls.append("second")
+    dispatch_message(topic_callbacks, "a/b", AVREmptyMessage())  # type: ignore
+
+    del topic_callbacks["a/b"]
+    dispatch_message(topic_callbacks, "a/b", AVREmptyMessage())  # type: ignore
+
+    assert calls == ["first", "first", "second", "second"]
+
+
+def test_dispatch_list_changed_in_place() -> None:
+    calls: List[str] = []
+    callbacks = [lambda: calls.append("first")]
+
+    topic_callbacks = TopicCallbacks({"a/b": callbacks})
+    dispatch_message(topic_callbacks, "a/b", AVREmptyMessage())  # type: ignore
+
+    # not seen until the list is assigned again
+    callbacks.append(lambda: calls.append("second"))
+    dispatch_message(topic_callbacks, "a/b", AVREmptyMessage())  # type: ignore
+
+    topic_callbacks["a/b"] = callbacks
+    dispatch_message(topic_callbacks, "a/b", AVREmptyMessage())  # type: ignore
+
+    assert calls == ["first", "first", "first", "second"]
+
+
+def test_dispatch_plain_dict() -> None:
+    calls: List[Any] = []
+
+    dispatch_message(
+        {"avr/pcm/servo/open": calls.append},  # type: ignore
+        "avr/pcm/servo/open",
+        AVRPCMServo(servo=1),
+    )
+
+    assert calls == [AVRPCMServo(servo=1)]
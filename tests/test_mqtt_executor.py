@@ -0,0 +1,109 @@
+import threading
+from typing import List, Tuple
+
+import pytest
+
+from bell.avr.mqtt.executor import OrderedExecutor
+
+
+def test_executor_order_per_key() -> None:
+    calls: List[Tuple[str, int]] = []
+    lock = threading.Lock()
+
+    def job(key: str, i: int) -> None:
+        with lock:
+            calls.append((key, i))
+
+    executor = OrderedExecutor(workers=4, max_queue=0)
+    for i in range(200):
+        for key in ("a", "b", "c"):
+            executor.submit(key, job, key, i)
+    executor.shutdown()
+
+    for key in ("a", "b", "c"):
+        assert [i for k, i in calls if k == key] == list(range(200))
+
+
+def test_executor_keys_run_in_parallel() -> None:
+    release = threading.Event()
+    other_ran = threading.Event()
+
+    executor = OrderedExecutor(workers=2)
+    # one key being stuck doesn't hold up the others
+    executor.submit("slow", release.wait)
+    executor.submit("fast", other_ran.set)
+
+    assert other_ran.wait(5)
+    release.set()
+    executor.shutdown()
+
+
+@pytest.mark.parametrize(
+    "overflow, expected", [("drop_oldest", [0, 3, 4]), ("drop_newest", [0, 1, 2])]
+)
+def test_executor_overflow(overflow: str, expected: List[int]) -> None:
+    calls: List[int] = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def first() -> None:
+        started.set()
+        release.wait()
+        calls.append(0)
+
+    executor = OrderedExecutor(workers=1, max_queue=2, overflow=overflow)  # type: ignore
+    executor.submit("a", first)
+    started.wait()
+
+    results = [executor.submit("a", calls.append, i) for i in range(1, 5)]
+
+    release.set()
+    executor.shutdown()
+
+    assert calls == expected
+    assert executor.dropped == 2
+    assert results == (
+        [True] * 4 if overflow == "drop_oldest" else [True] * 2 + [False] * 2
+    )
+
+
+def test_executor_errors_logged() -> None:
+    calls: List[int] = []
+
+    def broken() -> None:
+        raise RuntimeError("oops")
+
+    executor = OrderedExecutor(workers=1)
+    executor.submit("a", broken)
+    executor.submit("a", calls.append, 1)
+    executor.shutdown()
+
+    # the worker keeps going
+    assert calls == [1]
+
+    with pytest.raises(RuntimeError):
+        executor.submit("a", calls.append, 2)
+
+
+def test_executor_submit_latest() -> None:
+    calls: List[int] = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def first() -> None:
+        started.set()
+        release.wait()
+        calls.append(0)
+
+    executor = OrderedExecutor(workers=1)
+    executor.submit("a", first)
+    started.wait()
+
+    # only the newest waiting job is kept
+    replaced = [executor.submit_latest("a", calls.append, i) for i in range(1, 5)]
+
+    release.set()
+    executor.shutdown()
+
+    assert calls == [0, 4]
+    assert replaced == [False, True, True, True]
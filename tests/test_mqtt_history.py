@@ -0,0 +1,68 @@
+import threading
+
+import numpy as np
+import pytest
+
+from bell.avr.mqtt.history import TopicHistory, payload_dtype
+from bell.avr.mqtt.payloads import AVRFusionVelocity, AVRPCMColorSet
+
+
+def test_payload_dtype() -> None:
+    assert payload_dtype("avr/fusion/velocity") == np.dtype(
+        [("Vn", "<f8"), ("Ve", "<f8"), ("Vd", "<f8")]
+    )
+    assert payload_dtype(AVRPCMColorSet) == np.dtype([("wrgb", "<u1", (4,))])
+
+    with pytest.raises(ValueError):
+        payload_dtype("avr/fcm/status")
+
+
+@pytest.mark.parametrize("count", [0, 3, 5, 7, 12])
+def test_history_last(count: int) -> None:
+    history = TopicHistory("avr/fusion/velocity", capacity=5)
+
+    for i in range(count):
+        history(AVRFusionVelocity(Vn=i, Ve=-i, Vd=0))
+
+    expected = np.arange(max(count - 5, 0), count, dtype=np.float64)
+
+    view = history.last()
+    np.testing.assert_array_equal(view.values["Vn"], expected)
+    np.testing.assert_array_equal(view.values["Ve"], -expected)
+    assert len(history) == len(expected)
+
+    np.testing.assert_array_equal(history.last(2).values["Vn"], expected[-2:])
+
+    # copies, which later payloads don't overwrite
+    history(AVRFusionVelocity(Vn=-1, Ve=1, Vd=0))
+    np.testing.assert_array_equal(view.values["Vn"], expected)
+
+
+def test_history_window() -> None:
+    history = TopicHistory(AVRPCMColorSet, capacity=10)
+
+    for i in range(15):
+        history.append({"wrgb": (i, i, i, i)}, timestamp=float(i))
+
+    view = history.window(2.5, now=14.0)
+    np.testing.assert_array_equal(view.timestamps, [12.0, 13.0, 14.0])
+    np.testing.assert_array_equal(view.values["wrgb"][:, 0], [12, 13, 14])
+
+    # only what is still in the history
+    assert len(history.window(100, now=14.0).values) == 10
+
+
+def test_history_threads() -> None:
+    history = TopicHistory("avr/fusion/velocity", capacity=50)
+
+    def writer() -> None:
+        for i in range(20000):
+            history.append(AVRFusionVelocity(Vn=i, Ve=0, Vd=0), timestamp=float(i))
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    while thread.is_alive():
+        # every query sees whole payloads, matching their timestamps
+        view = history.last()
+        np.testing.assert_array_equal(view.values["Vn"], view.timestamps)
+    thread.join()
@@ -0,0 +1,78 @@
+import pytest
+
+from bell.avr.mqtt.latency import (
+    LatencyHistogram,
+    LatencyTracker,
+    _bucket_index,
+    _bucket_upper_bound,
+)
+
+
+def test_bucket_bounds() -> None:
+    previous = -1
+    for value in [*range(0, 1000), 123_456, 9_999_999, 60_000_000]:
+        index = _bucket_index(value)
+        assert index >= previous
+        previous = index
+
+        upper = _bucket_upper_bound(index)
+        assert value <= upper
+        # within 1/64 of the value
+        assert upper - value <= value / 64
+
+
+def test_histogram_percentiles() -> None:
+    histogram = LatencyHistogram()
+    for micros in range(1, 10001):
+        histogram.record(micros / 1e6)
+
+    assert histogram.count == 10000
+    assert histogram.mean == pytest.approx(0.0050005)
+    assert histogram.max == pytest.approx(0.01)
+    assert histogram.percentile(50) == pytest.approx(0.005, rel=0.02)
+    assert histogram.percentile(99) == pytest.approx(0.0099, rel=0.02)
+    assert histogram.percentile(100) == pytest.approx(0.01)
+
+
+def test_histogram_clamps() -> None:
+    histogram = LatencyHistogram(max_value=1)
+    histogram.record(-0.5)
+    histogram.record(5)
+
+    assert histogram.percentile(50) == 0
+    assert histogram.percentile(100) == pytest.approx(1, rel=0.02)
+    assert histogram.max == 5
+
+
+def test_histogram_merge_and_reset() -> None:
+    first = LatencyHistogram()
+    second = LatencyHistogram()
+    first.record(0.001)
+    second.record(0.003)
+
+    first.merge(second)
+    assert first.count == 2
+    assert first.percentile(100) == pytest.approx(0.003, rel=0.02)
+
+    with pytest.raises(ValueError):
+        first.merge(LatencyHistogram(max_value=1))
+
+    first.reset()
+    assert first.count == 0
+    assert first.percentile(50) == 0
+
+
+def test_tracker_summary() -> None:
+    tracker = LatencyTracker()
+    tracker.record("avr/fcm/battery", "decode", 0.001)
+    tracker.record("avr/fcm/battery", "handler", 0.002)
+
+    histogram = tracker.histogram("avr/fcm/battery", "decode")
+    assert histogram is not None
+    assert histogram.count == 1
+    assert tracker.histogram("avr/fcm/battery", "network") is None
+
+    summary = tracker.summary()
+    assert list(summary) == ["avr/fcm/battery"]
+    assert list(summary["avr/fcm/battery"]) == ["decode", "handler"]
+    assert summary["avr/fcm/battery"]["handler"]["count"] == 1
@@ -1,3 +1,16 @@
+import json
+import threading
+from typing import List
+
+import pytest
+from paho.mqtt.client import MQTT_ERR_QUEUE_SIZE, MQTTMessageInfo, MQTTv5
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from pytest_mock.plugin import MockerFixture
+
+from bell.avr.mqtt.delivery import DeliveryPolicy
+from bell.avr.mqtt.payloads import AVRPCMServo
+from bell.avr.mqtt.throttle import PublishPolicy
 from tests.models import MQTTModuleTest
 
 
@@ -10,7 +23,9 @@ def test_subscriptions_topic_callbacks(mqtt_module: MQTTModuleTest) -> None:
     }
     mqtt_module.on_connect(mqtt_module._mqtt_client, None, None, None)  # type: ignore
 
-    mqtt_module._mqtt_client.subscribe.assert_called_once_with("avr/pcm/servo/open")
+    mqtt_module._mqtt_client.subscribe.assert_called_once_with(
+        "avr/pcm/servo/open", qos=0
+    )
 
 
 def test_subscriptions_all_avr(mqtt_module: MQTTModuleTest) -> None:
@@ -20,7 +35,7 @@ def test_subscriptions_all_avr(mqtt_module: MQTTModuleTest) -> None:
     mqtt_module.subscribe_to_all_avr_topics = True
     mqtt_module.on_connect(mqtt_module._mqtt_client, None, None, None)  # type: ignore
 
-    mqtt_module._mqtt_client.subscribe.assert_called_once_with("avr/#")
+    mqtt_module._mqtt_client.subscribe.assert_called_once_with("avr/#", qos=1)
 
 
 def test_subscriptions_all(mqtt_module: MQTTModuleTest) -> None:
@@ -30,4 +45,486 @@ def test_subscriptions_all(mqtt_module: MQTTModuleTest) -> None:
     mqtt_module.subscribe_to_all_topics = True
     mqtt_module.on_connect(mqtt_module._mqtt_client, None, None, None)  # type: ignore
 
-    mqtt_module._mqtt_client.subscribe.assert_called_once_with("#")
+    mqtt_module._mqtt_client.subscribe.assert_called_once_with("#", qos=1)
+
+
+def test_on_message_wildcard_callback(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure topic_callbacks keys can be wildcard topic filters.
+    """
+    mqtt_module.topic_callbacks = {
+        "avr/pcm/servo/+": mqtt_module.test_handler,
+    }
+    mqtt_module.recieve_message("avr/pcm/servo/open", '{"servo": 2}')
+
+    mqtt_module.test_handler.assert_called_once_with(AVRPCMServo(servo=2))
+
+
+def test_on_message_skips_decoding(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure messages without a callback are not deserialized.
+    """
+    mqtt_module.topic_callbacks = {
+        "avr/pcm/servo/open": mqtt_module.test_handler,
+    }
+    mqtt_module.subscribe_to_all_avr_topics = True
+
+    # not valid for this topic, but nothing cares about it
+    mqtt_module.recieve_message("avr/fcm/battery", "not json")
+    mqtt_module.recieve_message("avr/pcm/servo/open", '{"servo": 2}')
+
+    assert mqtt_module.decode_stats.skipped == 1
+    assert mqtt_module.decode_stats.decoded == 1
+    mqtt_module.test_handler.assert_called_once_with(AVRPCMServo(servo=2))
+
+
+def test_on_message_callback_workers(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure callbacks can be run by a worker pool, in order per topic.
+    """
+    mqtt_module.callback_workers = 2
+    mqtt_module.topic_callbacks = {
+        "avr/pcm/servo/+": mqtt_module.test_handler,
+    }
+
+    for servo in range(10):
+        mqtt_module.recieve_message("avr/pcm/servo/open", f'{{"servo": {servo}}}')
+
+    assert mqtt_module.callback_executor is not None
+    mqtt_module.stop()
+    assert mqtt_module.callback_executor is None
+
+    assert [call.args[0].servo for call in mqtt_module.test_handler.call_args_list] == (
+        list(range(10))
+    )
+    assert mqtt_module.decode_stats.decoded == 10
+
+
+def test_on_message_conflate(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure conflated topics only deliver the newest waiting message.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    servos: List[int] = []
+
+    def handler(payload: AVRPCMServo) -> None:
+        started.set()
+        release.wait()
+        servos.append(payload.servo)
+
+    mqtt_module.conflate_topics = {"avr/pcm/servo/+"}
+    mqtt_module.topic_callbacks = {"avr/pcm/servo/open": handler}
+
+    mqtt_module.recieve_message("avr/pcm/servo/open", '{"servo": 0}')
+    started.wait()
+    for servo in range(1, 5):
+        mqtt_module.recieve_message("avr/pcm/servo/open", f'{{"servo": {servo}}}')
+
+    release.set()
+    mqtt_module.stop()
+
+    assert servos == [0, 4]
+    assert mqtt_module.decode_stats.conflated == {"avr/pcm/servo/open": 3}
+    # replaced messages are never deserialized
+    assert mqtt_module.decode_stats.decoded == 2
+
+
+def test_send_message_publish_policy(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure publish policies suppress messages sent too quickly.
+    """
+    mqtt_module.publish_policies = {"avr/pcm/servo/#": PublishPolicy(max_rate=0.001)}
+
+    for servo in range(3):
+        mqtt_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=servo))
+    mqtt_module.send_message("avr/pcm/laser/fire")
+
+    assert mqtt_module._mqtt_client.publish.call_count == 2
+    assert mqtt_module.publish_stats.published == 2
+    assert mqtt_module.publish_stats.suppressed == {"avr/pcm/servo/open": 2}
+    # the cache only holds what was published
+    assert mqtt_module.message_cache["avr/pcm/servo/open"] == AVRPCMServo(servo=0)
+
+
+def test_send_message_coalesced_cache(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure coalesced messages are cached when they are published, and are
+    published without writing to the socket from the timer thread.
+    """
+    flushes = []
+    mqtt_module._publish_throttle.call_later = lambda delay, fn: flushes.append(fn)
+    mqtt_module.publish_policies = {
+        "avr/pcm/servo/#": PublishPolicy(max_rate=0.001, coalesce=True)
+    }
+    mqtt_module._looped_forever = True
+    mqtt_module._loop_thread = threading.get_ident()
+
+    for servo in range(3):
+        mqtt_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=servo))
+    assert mqtt_module.message_cache["avr/pcm/servo/open"] == AVRPCMServo(servo=0)
+    assert mqtt_module._mqtt_client.loop_write.call_count == 1
+
+    flusher = threading.Thread(target=flushes.pop())
+    flusher.start()
+    flusher.join()
+
+    assert mqtt_module._mqtt_client.publish.call_count == 2
+    assert mqtt_module.message_cache["avr/pcm/servo/open"] == AVRPCMServo(servo=2)
+    assert mqtt_module._mqtt_client.loop_write.call_count == 1
+
+
+def test_send_message_cache(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure the message cache and the sent cache hold snapshots of what was
+    sent, which later changes to the payload don't affect.
+    """
+    payload = {"servo": 2}
+    mqtt_module.send_message("avr/pcm/servo/open", payload)  # type: ignore
+    payload["servo"] = 3
+
+    assert isinstance(mqtt_module.message_cache, dict)
+    assert mqtt_module.message_cache["avr/pcm/servo/open"] == {"servo": 2}
+    assert mqtt_module.sent_cache.get("avr/pcm/servo/open") == AVRPCMServo(servo=2)
+
+    mqtt_module.send_message("avr/pcm/laser/fire")
+    assert mqtt_module.message_cache["avr/pcm/laser/fire"] is None
+
+    servo = AVRPCMServo(servo=1)
+    mqtt_module.send_message("avr/unknown", servo)  # type: ignore
+    servo.servo = 4
+    assert mqtt_module.message_cache["avr/unknown"] == AVRPCMServo(servo=1)  # type: ignore
+
+    # nested values are copied too
+    values = {"values": [1, 2]}
+    mqtt_module.send_message("avr/unknown", values)  # type: ignore
+    values["values"].append(3)
+    assert mqtt_module.message_cache["avr/unknown"] == {"values": [1, 2]}  # type: ignore
+
+
+def test_on_message_receive_cache(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure messages are cached even without a callback.
+    """
+    mqtt_module.subscribe_topics = {"avr/pcm/servo/open"}
+    mqtt_module.receive_cache_topics = {"avr/pcm/+/open"}
+    mqtt_module.on_connect(mqtt_module._mqtt_client, None, None, None)  # type: ignore
+    mqtt_module._mqtt_client.subscribe.assert_called_once_with(
+        "avr/pcm/servo/open", qos=0
+    )
+
+    mqtt_module.recieve_message("avr/pcm/servo/open", '{"servo": 2}')
+
+    assert mqtt_module.decode_stats.skipped == 1
+    assert mqtt_module.receive_cache.get_fresh("avr/pcm/servo/open", 10) == (
+        AVRPCMServo(servo=2)
+    )
+
+
+def test_receive_cache_opt_in(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure only topics in receive_cache_topics are cached, and payloads
+    decoded for callbacks are cached as is.
+    """
+    mqtt_module.topic_callbacks = {
+        "avr/pcm/servo/open": mqtt_module.test_handler,
+        "avr/pcm/servo/close": mqtt_module.test_handler,
+    }
+    mqtt_module.receive_cache_topics = {"avr/pcm/servo/open"}
+
+    mqtt_module.recieve_message("avr/pcm/servo/open", '{"servo": 2}')
+    mqtt_module.recieve_message("avr/pcm/servo/close", '{"servo": 2}')
+
+    assert list(mqtt_module.receive_cache) == ["avr/pcm/servo/open"]
+    payload = mqtt_module.test_handler.call_args_list[0].args[0]
+    assert mqtt_module.receive_cache["avr/pcm/servo/open"] is payload
+
+
+def test_latency_tracking(mqtt_v5_module: MQTTModuleTest) -> None:
+    """
+    Ensure sent messages carry their send time, and received messages are timed.
+    """
+    mqtt_v5_module.latency_tracking = True
+    mqtt_v5_module.topic_callbacks = {"avr/pcm/servo/open": mqtt_v5_module.test_handler}
+
+    mqtt_v5_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+    call = mqtt_v5_module._mqtt_client.publish.call_args
+    topic, payload = call.args
+    # the payload itself is untouched
+    assert payload == '{"servo":2}'
+    properties = call.kwargs["properties"]
+    assert [name for name, _ in properties.UserProperty] == ["avr-sent"]
+
+    mqtt_v5_module.recieve_message(topic, payload, properties)
+    mqtt_v5_module.test_handler.assert_called_once_with(AVRPCMServo(servo=2))
+
+    summary = mqtt_v5_module.latency.summary()["avr/pcm/servo/open"]
+    assert set(summary) == {"network", "dispatch", "decode", "handler", "total"}
+    assert all(stage["count"] == 1 for stage in summary.values())
+
+
+def test_latency_tracking_disabled(mqtt_v5_module: MQTTModuleTest) -> None:
+    """
+    Ensure send times are ignored, and payloads passed on as is, without
+    latency tracking.
+    """
+    mqtt_v5_module.topic_callbacks = {"avr/unknown": mqtt_v5_module.test_handler}
+
+    mqtt_v5_module.send_message("avr/unknown", {"_avr_ts": 1})  # type: ignore
+    properties = mqtt_v5_module._mqtt_client.publish.call_args.kwargs["properties"]
+    assert not hasattr(properties, "UserProperty")
+
+    properties.UserProperty = ("avr-sent", "1.0")
+    mqtt_v5_module.recieve_message("avr/unknown", '{"_avr_ts": 1}', properties)
+
+    mqtt_v5_module.test_handler.assert_called_once_with({"_avr_ts": 1})
+    assert mqtt_v5_module.latency.summary() == {}
+
+
+def test_latency_report(mqtt_module: MQTTModuleTest, mocker: MockerFixture) -> None:
+    """
+    Ensure latency reports are published from a timer until stopped.
+    """
+    call_later = mqtt_module._publish_throttle.call_later = mocker.Mock()
+    mqtt_module.latency_tracking = True
+    mqtt_module.latency_report_interval = 10
+
+    mqtt_module._start_latency_reports()
+    mqtt_module._start_latency_reports()
+    call_later.assert_called_once_with(10, mqtt_module._report_latency)
+    mqtt_module._mqtt_client.publish.assert_not_called()
+
+    # the timer fires
+    call_later.call_args.args[1]()
+    topic, payload = mqtt_module._mqtt_client.publish.call_args.args
+    assert topic == "avr/latency/MQTTModuleTest"
+    assert json.loads(payload) == {}
+    assert call_later.call_count == 2
+
+    mqtt_module.stop()
+    call_later.call_args.args[1]()
+    assert mqtt_module._mqtt_client.publish.call_count == 1
+
+
+def test_mqtt_v5_topic_aliases(mqtt_v5_module: MQTTModuleTest) -> None:
+    """
+    Ensure frequently published topics get aliases, which reset on reconnect.
+    """
+    properties = Properties(PacketTypes.CONNACK)
+    properties.TopicAliasMaximum = 1
+    mqtt_v5_module.on_connect(mqtt_v5_module._mqtt_client, None, {}, 0, properties)
+
+    for _ in range(4):
+        mqtt_v5_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+    for _ in range(3):
+        mqtt_v5_module.send_message("avr/pcm/servo/close", AVRPCMServo(servo=2))
+
+    calls = mqtt_v5_module._mqtt_client.publish.call_args_list
+    topics = [call.args[0] for call in calls]
+    aliases = [getattr(call.kwargs["properties"], "TopicAlias", None) for call in calls]
+
+    # only one alias is allowed, so the second topic doesn't get one
+    assert topics == ["avr/pcm/servo/open"] * 3 + [""] + ["avr/pcm/servo/close"] * 3
+    assert aliases == [None, None, 1, 1, None, None, None]
+
+    mqtt_v5_module.on_disconnect(mqtt_v5_module._mqtt_client, None, 0)
+    assert mqtt_v5_module._topic_aliases == {}
+
+    mqtt_v5_module.on_connect(mqtt_v5_module._mqtt_client, None, {}, 0, properties)
+    mqtt_v5_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+    assert mqtt_v5_module._mqtt_client.publish.call_args.args[0] == "avr/pcm/servo/open"
+
+
+def test_mqtt_v5_protocol(mocker: MockerFixture) -> None:
+    """
+    Ensure the client is created with the chosen protocol, which can't change
+    once connecting.
+    """
+    module = MQTTModuleTest()
+    module.mqtt_v5 = True
+    assert module._mqtt_client._protocol == MQTTv5
+
+    module.retry_connect = True
+    reconnect_delay_set = mocker.spy(module._mqtt_client, "reconnect_delay_set")
+    module.connect_("localhost", 1883)
+
+    initial_delay, max_delay = reconnect_delay_set.call_args.args
+    assert 0.05 <= initial_delay <= 0.1
+    assert max_delay == 30
+
+    with pytest.raises(ValueError):
+        module.mqtt_v5 = False
+
+
+def test_mqtt_v5_message_expiry(mqtt_v5_module: MQTTModuleTest) -> None:
+    """
+    Ensure message expiry is set for matching topics.
+    """
+    mqtt_v5_module.message_expiry = {"avr/pcm/#": 2}
+
+    mqtt_v5_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+    properties = mqtt_v5_module._mqtt_client.publish.call_args.kwargs["properties"]
+    assert properties.MessageExpiryInterval == 2
+
+    mqtt_v5_module.send_message("avr/fusion/heading", {"hdg": 1.0})
+    properties = mqtt_v5_module._mqtt_client.publish.call_args.kwargs["properties"]
+    assert not hasattr(properties, "MessageExpiryInterval")
+
+
+def test_delivery_policies(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure messages are published with the QoS and retain flag for their topic.
+    """
+    publish = mqtt_module._mqtt_client.publish
+
+    mqtt_module.send_message("avr/fcm/action/kill", {})
+    assert publish.call_args.kwargs == {"qos": 1, "retain": False}
+
+    # state is only retained when asked for
+    mqtt_module.send_message("avr/fcm/armed", {"armed": True})
+    assert publish.call_args.kwargs == {"qos": 0, "retain": False}
+
+    mqtt_module.delivery_policies = {"avr/fcm/armed": DeliveryPolicy(retain=True)}
+    mqtt_module.send_message("avr/fcm/armed", {"armed": True})
+    assert publish.call_args.kwargs == {"qos": 0, "retain": True}
+
+    mqtt_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+    assert publish.call_args.kwargs == {"qos": 0, "retain": False}
+
+    mqtt_module.delivery_policies = {
+        "avr/pcm/#": DeliveryPolicy(qos=2),
+        "avr/fcm/action/kill": DeliveryPolicy(qos=0),
+    }
+    mqtt_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+    assert publish.call_args.kwargs == {"qos": 2, "retain": False}
+
+    mqtt_module.send_message("avr/fcm/action/kill", {})
+    assert publish.call_args.kwargs == {"qos": 0, "retain": False}
+
+
+def test_delivery_subscription_qos(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure subscriptions use the highest QoS of the topics they cover.
+    """
+    mqtt_module.subscribe_topics = {"avr/fcm/action/+", "avr/fcm/battery"}
+    mqtt_module.delivery_policies = {"avr/fcm/battery": DeliveryPolicy(qos=2)}
+    mqtt_module.on_connect(mqtt_module._mqtt_client, None, None, None)  # type: ignore
+
+    subscribe = mqtt_module._mqtt_client.subscribe
+    subscribe.assert_any_call("avr/fcm/action/+", qos=1)
+    subscribe.assert_any_call("avr/fcm/battery", qos=2)
+
+
+def test_delivery_stats(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure delivery stats count in flight, queued and rejected messages.
+    """
+    client = mqtt_module._mqtt_client
+    mqtt_module.max_inflight_messages = 2
+
+    for mid in range(1, 5):
+        client.publish.return_value = MQTTMessageInfo(mid)
+        mqtt_module.send_message("avr/fcm/action/kill", {})
+
+    # QoS 0 messages are never waiting
+    client.publish.return_value = MQTTMessageInfo(5)
+    mqtt_module.send_message("avr/pcm/laser/fire")
+
+    client.publish.return_value.rc = MQTT_ERR_QUEUE_SIZE
+    mqtt_module.send_message("avr/fcm/action/kill", {})
+
+    stats = mqtt_module.delivery_stats
+    assert (stats.in_flight, stats.queued, stats.rejected) == (2, 2, 1)
+
+    mqtt_module.on_publish(client, None, 1)
+    mqtt_module.on_publish(client, None, 2)
+    mqtt_module.on_publish(client, None, 5)
+
+    stats = mqtt_module.delivery_stats
+    assert (stats.in_flight, stats.queued, stats.rejected) == (2, 0, 1)
+
+
+def test_connection_shards(mqtt_module: MQTTModuleTest, mocker: MockerFixture) -> None:
+    """
+    Ensure topics are published and subscribed to on their shard's connection.
+    """
+    main = mqtt_module._mqtt_client
+    shard = mocker.Mock()
+    mqtt_module.connection_shards = {"images": {"avr/thermal/#"}}
+    mqtt_module._shard_clients = {"images": shard}
+    mqtt_module.topic_callbacks = {
+        "avr/thermal/reading": mqtt_module.test_handler,
+        "avr/pcm/servo/open": mqtt_module.test_handler,
+    }
+
+    mqtt_module.on_connect(main, None, {}, 0)
+    main.subscribe.assert_called_once_with("avr/pcm/servo/open", qos=0)
+
+    mqtt_module.on_connect(shard, None, {}, 0)
+    shard.subscribe.assert_called_once_with("avr/thermal/reading", qos=0)
+
+    mqtt_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+    mqtt_module._publish("avr/thermal/reading", "{}")
+    assert main.publish.call_args.args[0] == "avr/pcm/servo/open"
+    assert shard.publish.call_args.args[0] == "avr/thermal/reading"
+    assert main.publish.call_count == shard.publish.call_count == 1
+
+
+def test_retry_connect_offline_queue(mqtt_module: MQTTModuleTest) -> None:
+    """
+    Ensure messages published while disconnected are held, then sent in order
+    once connected.
+    """
+    client = mqtt_module._mqtt_client
+    mqtt_module.retry_connect = True
+    mqtt_module.offline_policies = {"avr/pcm/#": "drop_oldest"}
+
+    mqtt_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=1))
+    mqtt_module.send_message("avr/fusion/heading", {"hdg": 1.0})
+    mqtt_module.send_message("avr/fcm/action/kill", {})
+    mqtt_module.send_message("avr/fusion/heading", {"hdg": 2.0})
+    mqtt_module.send_message("avr/pcm/servo/open", AVRPCMServo(servo=2))
+
+    client.publish.assert_not_called()
+    assert mqtt_module.delivery_stats.offline == 4
+
+    mqtt_module.on_connect(client, None, {}, 0)
+    sent = [call.args for call in client.publish.call_args_list]
+    assert sent == [
+        ("avr/pcm/servo/open", '{"servo":1}'),
+        ("avr/fcm/action/kill", "{}"),
+        ("avr/fusion/heading", '{"hdg":2.0}'),
+        ("avr/pcm/servo/open", '{"servo":2}'),
+    ]
+    assert mqtt_module.delivery_stats.offline == 0
+
+    mqtt_module.send_message("avr/fusion/heading", {"hdg": 3.0})
+    assert client.publish.call_count == 5
+
+    mqtt_module.on_disconnect(client, None, 1)
+    mqtt_module.send_message("avr/fusion/heading", {"hdg": 4.0})
+    assert client.publish.call_count == 5
+    assert mqtt_module.delivery_stats.offline == 1
+
+
+def test_topic_callbacks_class_attribute(mocker: MockerFixture) -> None:
+    """
+    Ensure a class attribute doesn't hide the topic_callbacks property.
+    """
+    handler = mocker.Mock()
+
+    class Module(MQTTModuleTest):
+        topic_callbacks = {"avr/pcm/servo/close": handler}
+
+        def __init__(self) -> None:
+            super().__init__()
+
+            self.topic_callbacks = {"avr/pcm/servo/open": handler}
+
+    module = Module()
+    # like any attribute set in __init__, the class attribute is replaced
+    assert list(module.topic_callbacks) == ["avr/pcm/servo/open"]
+
+    module.recieve_message("avr/pcm/servo/open", '{"servo": 2}')
+    module.recieve_message("avr/pcm/servo/close", '{"servo": 2}')
+    handler.assert_called_once_with(AVRPCMServo(servo=2))
@@ -0,0 +1,72 @@
+import pytest
+
+from bell.avr.mqtt.offline import OfflineQueue, ReconnectBackoff
+
+
+def test_backoff_delays() -> None:
+    backoff = ReconnectBackoff(initial_delay=1, max_delay=10, jitter=0)
+    assert backoff.delays() == (1, 10)
+
+
+def test_backoff_jitter() -> None:
+    backoff = ReconnectBackoff(initial_delay=1, max_delay=10, jitter=0.5)
+    delays = [backoff.delays()[0] for _ in range(100)]
+
+    assert all(0.5 <= delay <= 1 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_backoff_validation() -> None:
+    with pytest.raises(ValueError):
+        ReconnectBackoff(initial_delay=0)
+
+    with pytest.raises(ValueError):
+        ReconnectBackoff(jitter=2)
+
+
+def test_queue_keep_latest() -> None:
+    queue = OfflineQueue(10)
+    queue.put("avr/fcm/battery", "1", "keep_latest")
+    queue.put("avr/fcm/status", "a", "keep_latest")
+    queue.put("avr/fcm/battery", "2", "keep_latest")
+
+    assert len(queue) == 2
+    assert queue.dropped == 0
+    # replaced messages move to the end
+    assert queue.drain() == [("avr/fcm/status", "a"), ("avr/fcm/battery", "2")]
+    assert len(queue) == 0
+
+
+def test_queue_drop_oldest() -> None:
+    queue = OfflineQueue(3)
+    for i in range(5):
+        queue.put("avr/pcm/servo/open", str(i), "drop_oldest")
+
+    assert len(queue) == 3
+    assert queue.dropped == 2
+    assert [payload for _, payload in queue.drain()] == ["2", "3", "4"]
+
+
+def test_queue_never_drop() -> None:
+    queue = OfflineQueue(2)
+    queue.put("avr/fcm/action/arm", "{}", "never_drop")
+    queue.put("avr/fusion/heading", "1", "drop_oldest")
+    queue.put("avr/fcm/action/kill", "{}", "never_drop")
+    queue.put("avr/fcm/action/land", "{}", "never_drop")
+
+    # only the droppable message goes, even though the queue is over its size
+    assert queue.dropped == 1
+    assert [topic for topic, _ in queue.drain()] == [
+        "avr/fcm/action/arm",
+        "avr/fcm/action/kill",
+        "avr/fcm/action/land",
+    ]
+
+
+def test_queue_compacts_replaced() -> None:
+    queue = OfflineQueue(10)
+    for i in range(1000):
+        queue.put("avr/fusion/heading", str(i), "keep_latest")
+
+    assert len(queue._entries) < 20
+    assert queue.drain() == [("avr/fusion/heading", "999")]
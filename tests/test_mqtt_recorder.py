@@ -0,0 +1,138 @@
+import os
+import time
+from pathlib import Path
+from typing import List
+
+import paho.mqtt.client as paho_mqtt
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from bell.avr.mqtt.recorder import (
+    FlightRecorder,
+    RecordedMessage,
+    RecordingReader,
+    RecordingWriter,
+)
+
+TOPICS = ["avr/fcm/battery", "avr/fusion/position/local", "avr/vio/confidence"]
+
+
+def write_recording(path: Path, compress: bool) -> List[RecordedMessage]:
+    messages = []
+
+    with RecordingWriter(path, compress=compress, chunk_size=256) as writer:
+        for i in range(100):
+            # the battery topic only appears at the start
+            topic = TOPICS[i % 3] if i < 30 else TOPICS[1 + i % 2]
+            message = RecordedMessage(1000.0 + i / 10, topic, f'{{"i": {i}}}'.encode())
+            writer.write(message.topic, message.payload, message.timestamp)
+            messages.append(message)
+
+    return messages
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_recording_roundtrip(tmp_path: Path, compress: bool) -> None:
+    path = tmp_path / "flight.avrrec"
+    messages = write_recording(path, compress)
+
+    with RecordingReader(path) as reader:
+        assert len(reader._chunks) > 1
+        assert len(reader) == 100
+        assert reader.topics == TOPICS
+        assert reader.start_time == 1000.0
+        assert reader.end_time == 1009.9
+
+        assert list(reader.messages()) == messages
+
+
+def test_recording_seek_and_filter(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = tmp_path / "flight.avrrec"
+    messages = write_recording(path, compress=True)
+
+    with RecordingReader(path) as reader:
+        records = mocker.spy(reader, "_records")
+
+        window = list(reader.messages(start=1005.0, end=1006.0))
+        assert window == [m for m in messages if 1005.0 <= m.timestamp <= 1006.0]
+        # only the chunks covering the window are read
+        assert records.call_count < len(reader._chunks) / 2
+
+        records.reset_mock()
+        battery = list(reader.messages(topics=["avr/fcm/+"]))
+        assert battery == [m for m in messages if m.topic == "avr/fcm/battery"]
+        # chunks without the topic are skipped
+        assert records.call_count < len(reader._chunks)
+
+
+def test_recording_without_index(tmp_path: Path) -> None:
+    path = tmp_path / "flight.avrrec"
+    messages = write_recording(path, compress=True)
+
+    # simulate a crash part way through writing a chunk
+    os.remove(str(path) + ".idx")
+    with open(path, "ab") as fp:
+        fp.write(b"C\x01\xff\xff")
+
+    with RecordingReader(path) as reader:
+        assert reader.topics == TOPICS
+        assert list(reader.messages(start=1002.0)) == messages[20:]
+
+
+def test_recording_truncated_chunk(tmp_path: Path) -> None:
+    path = tmp_path / "flight.avrrec"
+    messages = write_recording(path, compress=True)
+
+    with RecordingReader(path) as reader:
+        last = reader._chunks[-1]
+
+    # simulate a crash after the index entry, part way through the chunk
+    with open(path, "r+b") as fp:
+        fp.truncate(last.offset + 10)
+
+    with RecordingReader(path) as reader:
+        assert len(reader) == 100 - last.count
+        assert list(reader.messages()) == messages[: 100 - last.count]
+
+
+def test_recording_idle_flush(tmp_path: Path) -> None:
+    path = tmp_path / "flight.avrrec"
+
+    with RecordingWriter(path, chunk_interval=0.05) as writer:
+        writer.write("avr/fcm/battery", b"{}", 1000.0)
+
+        # written by the writer thread, without any more messages
+        deadline = time.monotonic() + 5
+        while not writer._written_count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        with RecordingReader(path) as reader:
+            assert list(reader.messages()) == [
+                RecordedMessage(1000.0, "avr/fcm/battery", b"{}")
+            ]
+
+
+def test_recording_not_recording(tmp_path: Path) -> None:
+    path = tmp_path / "flight.avrrec"
+    path.write_bytes(b"not a recording")
+
+    with pytest.raises(ValueError):
+        RecordingReader(path)
+
+
+def test_flight_recorder(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = tmp_path / "flight.avrrec"
+
+    recorder = FlightRecorder(path)
+    mocker.patch.object(recorder, "_mqtt_client")
+    assert recorder.subscribe_to_all_avr_topics
+
+    msg = paho_mqtt.MQTTMessage(topic=b"avr/fcm/battery")
+    msg.payload = b"not even json"
+    recorder.on_message(None, None, msg)  # type: ignore
+    recorder.stop()
+
+    with RecordingReader(path) as reader:
+        assert [(m.topic, m.payload) for m in reader.messages()] == [
+            ("avr/fcm/battery", b"not even json")
+        ]
@@ -0,0 +1,105 @@
+import json
+from pathlib import Path
+from typing import List
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from bell.avr.mqtt.payloads import AVRPCMServo
+from bell.avr.mqtt.recorder import RecordedMessage, RecordingWriter
+from bell.avr.mqtt.replay import load_messages, replay
+from tests.models import MQTTModuleTest
+
+
+def test_replay_recording(mqtt_module: MQTTModuleTest, tmp_path: Path) -> None:
+    path = tmp_path / "flight.avrrec"
+    with RecordingWriter(path) as writer:
+        for servo in range(5):
+            writer.write("avr/pcm/servo/open", f'{{"servo": {servo}}}'.encode(), servo)
+        writer.write("avr/fcm/battery", b"not json", 5)
+
+    mqtt_module.topic_callbacks = {"avr/pcm/servo/open": mqtt_module.test_handler}
+    stats = replay(mqtt_module, path, speed=None)
+
+    assert [call.args[0] for call in mqtt_module.test_handler.call_args_list] == [
+        AVRPCMServo(servo=servo) for servo in range(5)
+    ]
+    assert stats.messages == 6
+    assert stats.topics["avr/pcm/servo/open"].count == 5
+    assert stats.topics["avr/pcm/servo/open"].mean > 0
+    assert stats.throughput > 0
+
+
+def test_replay_json_lines(tmp_path: Path) -> None:
+    path = tmp_path / "flight.jsonl"
+    path.write_text(
+        json.dumps({"timestamp": 1, "topic": "a", "payload": {"servo": 1}})
+        + "\n\n"
+        + json.dumps({"timestamp": 2, "topic": "b", "payload": '{"servo": 2}'})
+        + "\n"
+    )
+
+    assert list(load_messages(path)) == [
+        RecordedMessage(1.0, "a", b'{"servo": 1}'),
+        RecordedMessage(2.0, "b", b'{"servo": 2}'),
+    ]
+
+
+class FakeTime:
+    """
+    Stands in for the time module, so replays don't depend on the real clock.
+    """
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps: List[float] = []
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_replay_speed(mqtt_module: MQTTModuleTest, mocker: MockerFixture) -> None:
+    fake_time = mocker.patch("bell.avr.mqtt.replay.time", FakeTime())
+    messages = [RecordedMessage(i * 0.1, "avr/pcm/laser/fire", b"") for i in range(4)]
+
+    stats = replay(mqtt_module, messages, speed=4)
+
+    # 0.3 seconds of messages at 4x
+    assert fake_time.sleeps == pytest.approx([0.025, 0.025, 0.025])
+    assert stats.elapsed == pytest.approx(0.075)
+    assert stats.max_lag == 0
+
+    with pytest.raises(ValueError):
+        replay(mqtt_module, messages, speed=0)
+
+
+def test_replay_lag(mqtt_module: MQTTModuleTest, mocker: MockerFixture) -> None:
+    fake_time = mocker.patch("bell.avr.mqtt.replay.time", FakeTime())
+    messages = [RecordedMessage(i * 0.1, "avr/pcm/laser/fire", b"") for i in range(3)]
+
+    # every message takes longer to handle than the time until the next one
+    def slow_handler() -> None:
+        fake_time.now += 0.25
+
+    mqtt_module.topic_callbacks = {"avr/pcm/laser/fire": slow_handler}
+    stats = replay(mqtt_module, messages)
+
+    assert fake_time.sleeps == []
+    assert stats.max_lag == pytest.approx(0.3)
+    assert stats.topics["avr/pcm/laser/fire"].max == pytest.approx(0.25)
+
+
+def test_replay_on_message(mqtt_module: MQTTModuleTest, mocker: MockerFixture) -> None:
+    """
+    Ensure messages go through on_message, like live ones.
+    """
+    on_message = mocker.spy(mqtt_module, "on_message")
+    replay(mqtt_module, [RecordedMessage(0, "avr/pcm/servo/open", b"{}")], None)
+
+    client, userdata, msg = on_message.call_args.args
+    assert (client, userdata) == (None, None)
+    assert (msg.topic, msg.payload) == ("avr/pcm/servo/open", b"{}")
@@ -2,8 +2,12 @@ from typing import Any
 
 import pytest
 
-from bell.avr.mqtt.payloads import AVREmptyMessage, AVRPCMServo
-from bell.avr.mqtt.serializer import deserialize_payload, serialize_payload
+from bell.avr.mqtt.payloads import (
+    AVREmptyMessage,
+    AVRFusionPositionLocal,
+    AVRPCMServo,
+)
+from bell.avr.mqtt.serializer import deserialize_payload, get_codec, serialize_payload
 
 
 @pytest.mark.parametrize(
@@ -194,3 +198,71 @@ def test_deserialize_payload(topic: str, payload: Any, expected: str) -> None:
 def test_deserialize_payload_exception(topic: str, payload: Any) -> None:
     with pytest.raises(ValueError):
         deserialize_payload(topic, payload)
+
+
+def test_get_codec_known_topic() -> None:
+    codec = get_codec("avr/pcm/servo/open")
+
+    # codecs are built once and reused
+    assert codec is get_codec("avr/pcm/servo/open")
+    assert codec.klass is AVRPCMServo
+
+    assert codec.decode(b'{"servo": 2}') == AVRPCMServo(servo=2)
+    assert codec.encode({"servo": 2}) == '{"servo":2}'
+
+
+def test_get_codec_unknown_topic() -> None:
+    # all unknown topics share a codec
+    codec = get_codec("notreal")
+    assert codec is get_codec("alsonotreal")
+    assert codec.klass is None
+
+    assert codec.decode(b'{"servo": 2}') == {"servo": 2}
+    assert codec.encode({"servo": 2}) == '{"servo": 2}'
+
+
+@pytest.mark.parametrize(
+    "topic, payload",
+    [
+        ("avr/fusion/position/local", AVRFusionPositionLocal(n=1.5, e=-2.25, d=3)),
+        (
+            "avr/fusion/attitude/quaternion",
+            {"w": 0.7071067811865476, "x": 0.0, "y": 0.7071067811865476, "z": 0.0},
+        ),
+        ("avr/pcm/color/set", '{"wrgb": [1, 2, 3, 4]}'),
+    ],
+)
+def test_binary_payload_roundtrip(topic: str, payload: Any) -> None:
+    binary = serialize_payload(topic, payload, binary=True)
+    assert isinstance(binary, bytes)
+
+    # binary is automatically detected, and matches the JSON result
+    text = serialize_payload(topic, payload)
+    assert len(binary) < len(text)
+    assert deserialize_payload(topic, binary) == deserialize_payload(topic, text)  # type: ignore
+
+
+@pytest.mark.parametrize(
+    "topic, payload",
+    [
+        ("notreal", {"servo": 2}),  # unknown topic
+        ("avr/fcm/flight_mode", {"flight_mode": "HOLD"}),  # has a string
+    ],
+)
+def test_binary_payload_unsupported(topic: str, payload: Any) -> None:
+    with pytest.raises(ValueError):
+        serialize_payload(topic, payload, binary=True)
+
+
+def test_binary_payload_wrong_layout() -> None:
+    binary = serialize_payload(
+        "avr/fusion/position/local", {"n": 1, "e": 2, "d": 3}, binary=True
+    )
+
+    # payload from a different topic layout
+    with pytest.raises(ValueError):
+        deserialize_payload("avr/fusion/attitude/quaternion", binary)  # type: ignore
+
+    # truncated payload
+    with pytest.raises(ValueError):
+        deserialize_payload("avr/fusion/position/local", binary[:-1])  # type: ignore
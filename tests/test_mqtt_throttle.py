@@ -0,0 +1,75 @@
+from typing import Any, Callable, List, Tuple
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from bell.avr.mqtt.throttle import PublishPolicy, PublishStats, PublishThrottle
+
+
+@pytest.fixture()
+def clock(mocker: MockerFixture) -> List[float]:
+    """
+    Controllable time for the throttle.
+    """
+    now = [100.0]
+    mocker.patch("bell.avr.mqtt.throttle.time.monotonic", side_effect=lambda: now[0])
+    return now
+
+
+def make_throttle() -> Tuple[PublishThrottle, List[Any], List[Callable]]:
+    published: List[Any] = []
+    scheduled: List[Callable] = []
+
+    throttle = PublishThrottle(
+        lambda topic, payload, force_write, context: published.append((topic, payload)),
+        PublishStats(),
+    )
+    throttle.call_later = lambda delay, fn: scheduled.append(fn)
+
+    return throttle, published, scheduled
+
+
+def test_throttle_drop(clock: List[float]) -> None:
+    throttle, published, scheduled = make_throttle()
+    throttle.policies = {"avr/pcm/servo/+": PublishPolicy(max_rate=10)}
+
+    for i in range(5):
+        throttle.publish("avr/pcm/servo/open", str(i))
+        clock[0] += 0.04
+
+    # 0 at 0.00 and 3 at 0.12
+    assert published == [("avr/pcm/servo/open", "0"), ("avr/pcm/servo/open", "3")]
+    assert throttle._stats.suppressed == {"avr/pcm/servo/open": 3}
+    assert scheduled == []
+
+
+def test_throttle_coalesce(clock: List[float]) -> None:
+    throttle, published, scheduled = make_throttle()
+    throttle.policies = {"avr/pcm/color/set": PublishPolicy(max_rate=10, coalesce=True)}
+
+    for i in range(4):
+        throttle.publish("avr/pcm/color/set", str(i))
+
+    assert published == [("avr/pcm/color/set", "0")]
+    assert len(scheduled) == 1
+
+    # at the window edge, only the last value is sent
+    clock[0] += 0.1
+    scheduled.pop()()
+    assert published == [("avr/pcm/color/set", "0"), ("avr/pcm/color/set", "3")]
+    assert throttle._stats.suppressed == {"avr/pcm/color/set": 2}
+
+
+def test_throttle_no_policy(clock: List[float]) -> None:
+    throttle, published, _ = make_throttle()
+    throttle.policies = {"avr/pcm/color/set": PublishPolicy(max_rate=1)}
+
+    for i in range(3):
+        throttle.publish("avr/pcm/servo/open", str(i))
+
+    assert len(published) == 3
+
+
+def test_policy_invalid_rate() -> None:
+    with pytest.raises(ValueError):
+        PublishPolicy(max_rate=0)